@@ -0,0 +1,127 @@
+""" Compare the time per sample of on-the-fly augmentation (HorizontalFlip and
+AffineTransform, compiled) with sampling precomputed variants from the
+augmentation bank (data.augmentation_bank), and check that the variants are
+identical to the on-the-fly transforms with the same parameters. Also times
+building the bank and a background refresh.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_augmentation_bank --n_images 16 --n_variants 8
+"""
+import os
+import time
+import json
+import shutil
+from argparse import ArgumentParser
+
+import numpy as np
+import SimpleITK as sitk
+
+from data.data_loader import UnpairedDataset
+from data.transforms import (AffineTransform, HorizontalFlip, Normalize, ToTensor,
+                             compile_transform)
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+def time_samples(dataset, n_samples: int) -> float :
+    """Return the mean time of __getitem__."""
+    np.random.seed(0)
+    t0 = time.perf_counter()
+    for k in range(n_samples) :
+        dataset[k % len(dataset)]
+    return (time.perf_counter() - t0) / n_samples
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, "images")
+    df = make_nrrd_cohort(image_dir, args.n_images, size=[512, 512, 48])
+    x_df, y_df = df.iloc[: len(df) // 2], df.iloc[len(df) // 2 :]
+    cache_dir = os.path.join(args.work_dir, "cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    kwargs = {"image_dir": image_dir, "cache_dir": cache_dir, "file_type": "nrrd",
+              "image_size": args.image_size, "image_spacing": [2.0, 1.0, 1.0],
+              "cache_format": args.cache_format}
+
+    on_the_fly = UnpairedDataset(x_df, y_df, **kwargs,
+                                 transform=compile_transform([
+                                        HorizontalFlip(),
+                                        AffineTransform(max_angle=30.0, max_pixels=[20, 20]),
+                                        Normalize(-1000.0, 1000.0), ToTensor()]))
+    t0 = time.perf_counter()
+    banked = UnpairedDataset(x_df, y_df, **kwargs,
+                             transform=compile_transform([Normalize(-1000.0, 1000.0), ToTensor()]),
+                             bank_variants=args.n_variants, bank_spare=args.n_spare,
+                             bank_transform=AffineTransform(max_angle=30.0, max_pixels=[20, 20]))
+    build_s = time.perf_counter() - t0
+    bank = banked.bank
+
+    # Same parameters, same images as the on-the-fly transforms
+    identical = True
+    for variant in range(bank.n_variants) :
+        for patient_id in df.index[:4] :
+            params = bank.get_params(patient_id, variant)
+            image = on_the_fly._read_cached(patient_id)
+            if params["flip"] :
+                image = sitk.Flip(image, [True, False, False])
+            affine = AffineTransform(max_angle=30.0, max_pixels=[20, 20])
+            rotation = affine.get_transform(image, params["angle"],
+                                            np.array(params["translation"]))
+            ref = sitk.Resample(image, image, rotation, sitk.sitkLinear, affine.fill_value)
+            identical &= np.array_equal(sitk.GetArrayViewFromImage(ref),
+                                        bank.get_array(patient_id, variant))
+    print(f"Variants are identical to the on-the-fly transforms: {identical}")
+
+    on_the_fly_s = time_samples(on_the_fly, args.n_samples)
+    banked_s = time_samples(banked, args.n_samples)
+    print(f"On the fly {1000 * on_the_fly_s:6.1f} ms/sample, bank {1000 * banked_s:6.1f} "
+          f"ms/sample ({on_the_fly_s / banked_s:.2f}x)")
+
+    # Refresh in the background while sampling
+    before = [bank.get_params(df.index[0], v) for v in range(bank.n_variants)]
+    t0 = time.perf_counter()
+    bank.start_refresh()
+    during_s = time_samples(banked, args.n_samples)
+    bank.wait_refresh()
+    refresh_s = time.perf_counter() - t0
+    changed = sum(before[v] != bank.get_params(df.index[0], v) for v in range(bank.n_variants))
+    # Each patient's variants have their own parameters
+    distinct = len({json.dumps(bank.get_params(id, 0)) for id in df.index})
+    print(f"Variant 0 has {distinct} distinct parameters over {len(df)} patients, "
+          f"{len(bank.history)} variants (initial and refreshed) in the history.")
+    size_mb = os.path.getsize(bank.data_path) / 2**20
+    print(f"Bank of {len(bank)} images x {bank.n_groups} groups ({size_mb:.0f} MB) built "
+          f"in {build_s:.1f} s. Refresh of {changed} variants took {refresh_s:.1f} s, "
+          f"{1000 * during_s:.1f} ms/sample meanwhile.")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump({"identical": bool(identical), "on_the_fly_ms": 1000 * on_the_fly_s,
+                       "bank_ms": 1000 * banked_s, "bank_during_refresh_ms": 1000 * during_s,
+                       "build_s": build_s, "refresh_s": refresh_s,
+                       "refreshed_variants": int(changed), "distinct_params": distinct,
+                       "bank_mb": size_mb}, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=16,
+                        help="Number of synthetic images in the cohort.")
+    parser.add_argument("--n_samples", type=int, default=64,
+                        help="Number of samples loaded for the timings.")
+    parser.add_argument("--n_variants", type=int, default=8,
+                        help="Number of variants of every image in the bank.")
+    parser.add_argument("--n_spare", type=int, default=2,
+                        help="Number of variants regenerated by a refresh.")
+    parser.add_argument("--cache_format", type=str, default="memmap")
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_augmentation_bank",
+                        help="Where to write the cohort and the caches.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the cached subvolumes [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
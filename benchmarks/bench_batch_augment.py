@@ -0,0 +1,102 @@
+""" Compare the per-sample SimpleITK augmentation (HorizontalFlip and
+AffineTransform on each pair of images) with BatchAffineTransform applied to
+whole batches of tensors, and check that both give the same images for the
+same random parameters.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_batch_augment --batch_sizes 1 4 8
+"""
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import SimpleITK as sitk
+
+from data.transforms import AffineTransform, HorizontalFlip, BatchAffineTransform
+from benchmarks.synthetic import make_ct_image
+
+
+
+
+def sitk_reference(image: sitk.Image, flip: bool, angle: float, translation) -> np.ndarray :
+    """Apply a flip and an affine transform with fixed parameters, exactly like
+    HorizontalFlip and AffineTransform do."""
+    if flip :
+        image = sitk.Flip(image, [True, False, False])
+    centre = image.TransformContinuousIndexToPhysicalPoint(
+                                    (np.array(image.GetSize()) / 2).tolist())
+    rotation = sitk.Euler3DTransform(centre, 0, 0, float(angle),
+                                     (float(translation[0]), float(translation[1]), 0.0))
+    image = sitk.Resample(image, image, rotation, sitk.sitkLinear, -1050.0)
+    return sitk.GetArrayFromImage(image)
+
+
+
+def main(args) :
+    size = args.image_size[::-1] # (x, y, z)
+    images = []
+    for seed in range(max(args.batch_sizes)) :
+        image, _ = make_ct_image(size, [1.0, 1.0, 2.0], seed=seed)
+        images.append(sitk.Cast(image, sitk.sitkFloat32))
+    batch_augment = BatchAffineTransform(max_angle=30.0, max_pixels=[20, 20],
+                                         spacing=[1.0, 1.0])
+    flip, affine = HorizontalFlip(), AffineTransform(max_angle=30.0, max_pixels=[20, 20])
+
+    # Same parameters, same result
+    params = batch_augment.sample_params(len(images))
+    X = torch.from_numpy(np.stack([sitk.GetArrayFromImage(im) for im in images]))[:, None]
+    X_batch, _ = batch_augment.apply_batch((X, X.clone()), params)
+    max_diff = 0.0
+    for k, image in enumerate(images) :
+        ref = sitk_reference(image, params["flip"][k], params["angle"][k],
+                             params["translation"][k])
+        max_diff = max(max_diff, float(np.abs(ref - X_batch[k, 0].numpy()).max()))
+    print(f"Max difference from the SimpleITK transforms: {max_diff:.2e} HU")
+
+    results = {"max_abs_diff": max_diff, "timings": []}
+    for batch_size in args.batch_sizes :
+        pairs = [(images[k], images[-1 - k]) for k in range(batch_size)]
+        t0 = time.perf_counter()
+        for _ in range(args.n_repeats) :
+            for pair in pairs :
+                affine(flip(pair))
+        sitk_s = (time.perf_counter() - t0) / args.n_repeats
+
+        X = torch.from_numpy(np.stack([sitk.GetArrayFromImage(x) for x, _ in pairs]))[:, None]
+        Y = torch.from_numpy(np.stack([sitk.GetArrayFromImage(y) for _, y in pairs]))[:, None]
+        t0 = time.perf_counter()
+        for _ in range(args.n_repeats) :
+            batch_augment.apply_batch((X, Y))
+        batch_s = (time.perf_counter() - t0) / args.n_repeats
+
+        results["timings"].append({"batch_size": batch_size, "sitk_ms": 1000 * sitk_s,
+                                   "batch_ms": 1000 * batch_s})
+        print(f"Batch size {batch_size:2d}: SimpleITK {1000 * sitk_s:7.1f} ms, batched "
+              f"{1000 * batch_s:7.1f} ms ({sitk_s / batch_s:.2f}x), "
+              f"{batch_size / batch_s:.1f} pairs/s")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--n_repeats", type=int, default=10,
+                        help="Number of times each batch is augmented for the timings.")
+    parser.add_argument("--n_threads", type=int, default=0,
+                        help="Number of threads for torch and ITK. 0 keeps the defaults.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the images [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    if args.n_threads > 0 :
+        torch.set_num_threads(args.n_threads)
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(args.n_threads)
+    main(args)
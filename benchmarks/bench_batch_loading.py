@@ -0,0 +1,91 @@
+""" Compare the time per batch of the default DataLoader (one __getitem__ per
+sample, then collate) with batched loading (one __getitems__ per batch, see
+data.data_loader.batch_loader), and check that both give the same batches.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_batch_loading --batch_sizes 1 4 8
+"""
+import os
+import time
+import json
+from argparse import ArgumentParser
+
+import torch
+import torchvision
+from torch.utils.data import DataLoader
+
+from data.data_loader import PairedDataset, batch_loader
+from data.transforms import Normalize, ToTensor
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+def time_loader(loader, n_epochs: int) -> float :
+    """Return the mean time per batch over a number of epochs."""
+    n_batches, t0 = 0, time.perf_counter()
+    for _ in range(n_epochs) :
+        for X, Y in loader :
+            n_batches += 1
+    return (time.perf_counter() - t0) / n_batches
+
+
+
+def main(args) :
+    df = make_nrrd_cohort(os.path.join(args.work_dir, "images"), args.n_images,
+                          size=[512, 512, 48])
+    transform = torchvision.transforms.Compose([Normalize(-1000.0, 1000.0), ToTensor()])
+    results = []
+
+    for cache_format in args.cache_formats :
+        # A paired dataset gives deterministic batches to compare
+        x_df, y_df = df.iloc[: len(df) // 2], df.iloc[len(df) // 2 :]
+        dataset = PairedDataset(x_df, y_df,
+                                image_dir=os.path.join(args.work_dir, "images"),
+                                cache_dir=os.path.join(args.work_dir, cache_format),
+                                file_type="nrrd",
+                                image_size=args.image_size,
+                                image_spacing=[2.0, 1.0, 1.0],
+                                transform=transform,
+                                cache_format=cache_format)
+
+        for batch_size in args.batch_sizes :
+            kwargs = {"num_workers": args.num_workers, "drop_last": True}
+            default = DataLoader(dataset, batch_size=batch_size, **kwargs)
+            batched = batch_loader(dataset, batch_size=batch_size, **kwargs)
+            for (X0, Y0), (X1, Y1) in zip(default, batched) :
+                assert torch.equal(X0, X1) and torch.equal(Y0, Y1)
+
+            default_s = time_loader(default, args.n_epochs)
+            batched_s = time_loader(batched, args.n_epochs)
+            results.append({"cache_format": cache_format, "batch_size": batch_size,
+                            "default_ms": 1000 * default_s, "batched_ms": 1000 * batched_s})
+            print(f"{cache_format:>6}, batch size {batch_size:2d}: default "
+                  f"{1000 * default_s:7.1f} ms/batch, batched {1000 * batched_s:7.1f} "
+                  f"ms/batch ({default_s / batched_s:.2f}x)")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=16,
+                        help="Number of synthetic images in the cohort.")
+    parser.add_argument("--n_epochs", type=int, default=5,
+                        help="Number of passes over the dataset for the timings.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--cache_formats", type=str, nargs="+", default=["nrrd", "memmap"])
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Number of DataLoader worker processes.")
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_batch_loading",
+                        help="Where to write the cohort and the caches.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the cached subvolumes [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,90 @@
+""" Compare loading and splitting the label CSVs with load_image_data_frame
+(text parsed on every call) with the same queries on a PatientCatalog, and
+check that both give the same patients and values.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_catalog --csv_dir datasets
+"""
+import os
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from data.data_loader import load_image_data_frame
+from data.catalog import PatientCatalog, COHORTS, read_label_csv
+
+
+
+
+def time_call(f, n_repeats) -> float :
+    """Return the median time of f in seconds."""
+    times = []
+    for _ in range(n_repeats) :
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times))
+
+
+
+def main(args) :
+    csv_paths = {c: os.path.join(args.csv_dir, f"{c}.csv") for c in COHORTS}
+    path = os.path.join(args.work_dir, f"catalog.{args.format}")
+    os.makedirs(args.work_dir, exist_ok=True)
+    build_s = time_call(lambda : PatientCatalog.from_csvs(csv_paths, path), 1)
+    catalog = PatientCatalog(path)
+
+    # Same patients and values as the CSVs
+    identical = True
+    for cohort, csv_path in csv_paths.items() :
+        df, ref = catalog.cohort(cohort), read_label_csv(csv_path)
+        identical &= bool(df.index.equals(ref.index))
+        for column in ref.columns :
+            identical &= bool(df[column].astype(object).fillna(-1).equals(
+                              ref[column].astype(object).fillna(-1)))
+    split = catalog.split("train_labels", ["2", "1"], ["0"], val_split=0)
+    ref = load_image_data_frame(csv_paths["train_labels"], ["2", "1"], ["0"], val_split=0)
+    identical &= all(a.index.equals(b.index) for a, b in zip(split, ref))
+    print(f"Catalog of {len(catalog)} rows written in {1000 * build_s:.1f} ms, same patients "
+          f"and values as the CSVs: {identical}")
+
+    ids = catalog.cohort("test_labels").index[:100]
+    centres = pd.DataFrame({"img_center_x": np.arange(len(ids), dtype=np.float64)}, index=ids)
+    timings = {
+        "csv_split_ms": lambda : load_image_data_frame(csv_paths["train_labels"], ["2", "1"],
+                                                       ["0"], val_split=0.1),
+        "load_catalog_ms": lambda : PatientCatalog(path),
+        "catalog_split_ms": lambda : catalog.split("train_labels", ["2", "1"], ["0"],
+                                                   val_split=0.1),
+        "catalog_domain_ms": lambda : catalog.domain(["2"], cohort="test_labels"),
+        "catalog_lookup_ms": lambda : catalog.lookup(ids),
+        "catalog_update_and_save_ms": lambda : (catalog.update(centres, "test_labels"),
+                                                catalog.save()),
+    }
+    results = {"rows": len(catalog), "format": args.format, "identical": identical}
+    for name, f in timings.items() :
+        results[name] = 1000 * time_call(f, args.n_repeats)
+        print(f"{name[:-3]:>26}: {results[name]:7.2f} ms")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--csv_dir", type=str, default="datasets",
+                        help="Directory containing the label CSVs.")
+    parser.add_argument("--format", type=str, default="pkl", choices=["parquet", "pkl"])
+    parser.add_argument("--n_repeats", type=int, default=20)
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_catalog",
+                        help="Where to write the catalog.")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
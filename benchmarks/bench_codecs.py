@@ -0,0 +1,123 @@
+""" Compare the cache codecs: bytes on disk, decode throughput and the
+end-to-end latency of UnpairedDataset.__getitem__ for every codec.
+
+A synthetic cohort is written as NRRD, then cached once per codec. Run it on
+the filesystem you want to measure (e.g. local NVMe or the shared cluster
+filesystem) by pointing --work_dir there. Run from the root of the repository:
+$ python -m benchmarks.bench_codecs --n_images 8 --work_dir /tmp/bench_codecs
+"""
+import os
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import SimpleITK as sitk
+import torchvision
+
+from data.data_loader import UnpairedDataset
+from data.transforms import Normalize, ToTensor
+from data.volume_codecs import CODECS, read_volume_array, zstandard, lz4
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+def bench_config(args, df, cache_format: str, codec: str, level) -> dict :
+    """Cache the cohort with one codec and time reading it back."""
+    name = f"{cache_format}_{codec}" + ("" if level is None else f"_{level}")
+    transform = torchvision.transforms.Compose([Normalize(-1000.0, 1000.0), ToTensor()])
+    x_df, y_df = df[df["has_artifact"] == "2"], df[df["has_artifact"] == "0"]
+
+    t0 = time.perf_counter()
+    dataset = UnpairedDataset(x_df, y_df,
+                              image_dir=os.path.join(args.work_dir, "images"),
+                              cache_dir=os.path.join(args.work_dir, name),
+                              file_type="nrrd",
+                              image_size=args.image_size,
+                              image_spacing=args.image_spacing,
+                              transform=transform,
+                              num_workers=1,
+                              cache_format=cache_format,
+                              cache_codec=codec,
+                              cache_codec_level=level)
+    cache_s = time.perf_counter() - t0
+
+    paths = [dataset._cached_path(id) for id in dataset.full_df.index]
+    disk_bytes = sum(os.path.getsize(p) for p in paths)
+
+    # Decode only: file read and decompression, no SITK image or transform
+    t0, n_bytes = time.perf_counter(), 0
+    for _ in range(args.n_repeats) :
+        for path in paths :
+            if cache_format == "vol" :
+                array, _ = read_volume_array(path)
+            else :
+                array = sitk.GetArrayViewFromImage(sitk.ReadImage(path))
+            n_bytes += array.nbytes
+    decode_mb_s = n_bytes / 2**20 / (time.perf_counter() - t0)
+
+    # End to end, as seen by the DataLoader workers
+    latencies = []
+    for _ in range(args.n_repeats) :
+        for index in range(len(dataset)) :
+            t0 = time.perf_counter()
+            dataset[index]
+            latencies.append(time.perf_counter() - t0)
+
+    result = {"config": name,
+              "disk_mb": disk_bytes / 2**20,
+              "ratio": n_bytes / args.n_repeats / disk_bytes,
+              "decode_mb_s": decode_mb_s,
+              "getitem_ms": 1000 * float(np.mean(latencies)),
+              "getitem_p95_ms": 1000 * float(np.percentile(latencies, 95)),
+              "cache_s": cache_s}
+    print(f"{name:>12}: {result['disk_mb']:7.1f} MB on disk ({result['ratio']:.2f}x), "
+          f"decode {decode_mb_s:7.1f} MB/s, __getitem__ {result['getitem_ms']:6.1f} ms "
+          f"(p95 {result['getitem_p95_ms']:.1f} ms), caching {cache_s:.1f} s")
+    return result
+
+
+
+def main(args) :
+    df = make_nrrd_cohort(os.path.join(args.work_dir, "images"), args.n_images)
+
+    configs = [("nrrd", "raw", None), ("nrrd", "gzip", None)]
+    for codec in args.codecs :
+        if (codec == "zstd" and zstandard is None) or (codec == "lz4" and lz4 is None) :
+            print(f"Skipping {codec}: package not installed.")
+            continue
+        levels = args.levels if codec in ["gzip", "zstd"] else [None]
+        configs += [("vol", codec, level) for level in levels]
+
+    results = []
+    for cache_format, codec, level in configs :
+        results.append(bench_config(args, df, cache_format, codec, level))
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=8,
+                        help="Number of synthetic images in the cohort.")
+    parser.add_argument("--n_repeats", type=int, default=3,
+                        help="Number of passes over the cache for the timings.")
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_codecs",
+                        help="Where to write the cohort and the caches.")
+    parser.add_argument("--codecs", type=str, nargs="+", default=CODECS,
+                        help="The codecs of the 'vol' format to compare.")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 6],
+                        help="Compression levels to compare for gzip and zstd.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the cached subvolumes [z, y, x].")
+    parser.add_argument("--image_spacing", type=float, nargs=3, default=[2.0, 1.0, 1.0],
+                        help="Spacing of the cached subvolumes in mm [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,67 @@
+""" Compare the time taken to preprocess one image by resampling the whole
+image before cropping (default) or by resampling only the cropped region
+(crop_first=True), and check that both give the same subvolume.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_crop_first --n_images 5
+"""
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import SimpleITK as sitk
+
+from data.preprocessing import crop_subvolume
+from benchmarks.synthetic import make_ct_image
+
+
+
+
+def main(args) :
+    size = np.array(args.image_size)[::-1]       # Reverse indexing for SITK
+    spacing = np.array(args.image_spacing)[::-1] # Reverse indexing for SITK
+    results = {"full_s": [], "crop_first_s": [], "max_abs_diff": []}
+
+    for seed in range(args.n_images) :
+        image, da_idx = make_ct_image(seed=seed)
+        image = sitk.Cast(image, sitk.sitkFloat32)
+
+        t0 = time.perf_counter()
+        full, full_coords = crop_subvolume(image, da_idx, size, spacing)
+        t1 = time.perf_counter()
+        fast, fast_coords = crop_subvolume(image, da_idx, size, spacing, crop_first=True)
+        t2 = time.perf_counter()
+
+        diff = np.abs(sitk.GetArrayViewFromImage(full) - sitk.GetArrayViewFromImage(fast))
+        assert full_coords == fast_coords, f"{full_coords} != {fast_coords}"
+        assert full.GetOrigin() == fast.GetOrigin()
+        results["full_s"].append(t1 - t0)
+        results["crop_first_s"].append(t2 - t1)
+        results["max_abs_diff"].append(float(diff.max()))
+        print(f"Image {seed}: full {t1 - t0:.3f} s, crop first {t2 - t1:.3f} s, "
+              f"max difference {diff.max():.2e} HU")
+
+    full_s, fast_s = np.mean(results["full_s"]), np.mean(results["crop_first_s"])
+    print(f"Mean time per image: full {full_s:.3f} s, crop first {fast_s:.3f} s "
+          f"({full_s / fast_s:.1f}x faster)")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=5,
+                        help="Number of synthetic images to preprocess.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the subvolume [z, y, x].")
+    parser.add_argument("--image_spacing", type=float, nargs=3, default=[2.0, 1.0, 1.0],
+                        help="Spacing of the subvolume in mm [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the timings.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,108 @@
+""" Compare caching a new image size and spacing from the DICOM series (every
+series decoded again) with caching it from the decoded volume cache, and check
+that both give the same crops.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_decoded_cache --n_images 8 --n_slices 120
+"""
+import os
+import time
+import json
+import shutil
+from argparse import ArgumentParser
+
+import numpy as np
+
+from data.data_loader import UnpairedDataset
+from benchmarks.synthetic import make_dicom_cohort
+
+
+
+
+def dir_size(path: str) -> int :
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(path) for name in files)
+
+
+
+def build(x_df, y_df, image_dir, cache_dir, config, **kwargs) :
+    """Cache one image size/spacing configuration and return the dataset and
+    the time taken."""
+    t0 = time.perf_counter()
+    dataset = UnpairedDataset(x_df, y_df, image_dir=image_dir, cache_dir=cache_dir,
+                              file_type="DICOM", cache_format="vol", image_size=config[0],
+                              image_spacing=config[1], **kwargs)
+    return dataset, time.perf_counter() - t0
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, "images")
+    df = make_dicom_cohort(image_dir, args.n_images, size=[512, 512, args.n_slices],
+                           compress=args.compress)
+    x_df, y_df = df[df["has_artifact"] == "2"], df[df["has_artifact"] == "0"]
+    first = (args.image_size, args.image_spacing)
+    second = (args.new_image_size, args.new_image_spacing)
+    kwargs = {"slab_reads": args.slab_reads, "crop_first": args.crop_first,
+              "num_workers": args.num_workers}
+    tiered = {"decoded_cache": True, "decoded_codec": args.codec,
+              "decoded_slab_mm": args.decoded_slab_mm}
+
+    results = {"n_images": args.n_images, "n_slices": args.n_slices, "codec": args.codec,
+               "crop_first": args.crop_first, "slab_reads": args.slab_reads,
+               "decoded_slab_mm": args.decoded_slab_mm,
+               "first": first, "second": second, "source_mb": dir_size(image_dir) / 2**20}
+    for name, extra in [("dicom", {}), ("decoded", tiered)] :
+        cache_dir = os.path.join(args.work_dir, name)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        _, first_s = build(x_df, y_df, image_dir, cache_dir, first, **kwargs, **extra)
+        dataset, second_s = build(x_df, y_df, image_dir, cache_dir, second, **kwargs, **extra)
+        results[f"{name}_first_s"], results[f"{name}_second_s"] = first_s, second_s
+        results[f"{name}_second_per_image_s"] = second_s / args.n_images
+        if name == "decoded" :
+            results["decoded_mb"] = dir_size(os.path.join(cache_dir, "decoded")) / 2**20
+        else :
+            reference = dataset
+
+    # Same crops from the series and from the decoded volumes
+    identical = all(np.array_equal(reference._read_cached_pixels(id), dataset._read_cached_pixels(id))
+                    and np.allclose(reference.metadata.centre(id), dataset.metadata.centre(id))
+                    for id in df.index)
+    results["identical"] = bool(identical)
+
+    print(f"Source series: {results['source_mb']:.0f} MB, decoded cache "
+          f"({args.codec}): {results['decoded_mb']:.0f} MB")
+    print(f"First configuration {first}: from DICOM {results['dicom_first_s']:.2f} s, "
+          f"with the decoded cache {results['decoded_first_s']:.2f} s")
+    print(f"New configuration {second}: from DICOM {results['dicom_second_s']:.2f} s, "
+          f"from the decoded cache {results['decoded_second_s']:.2f} s "
+          f"({results['dicom_second_s'] / results['decoded_second_s']:.1f}x)")
+    print(f"Same crops and centres: {identical}")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=8)
+    parser.add_argument("--n_slices", type=int, default=120)
+    parser.add_argument("--compress", action="store_true",
+                        help="Compress the pixel data of the synthetic DICOM slices.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256])
+    parser.add_argument("--image_spacing", type=float, nargs=3, default=[2.0, 1.0, 1.0])
+    parser.add_argument("--new_image_size", type=int, nargs=3, default=[16, 192, 192])
+    parser.add_argument("--new_image_spacing", type=float, nargs=3, default=[3.0, 1.5, 1.5])
+    parser.add_argument("--codec", type=str, default="lz4")
+    parser.add_argument("--crop_first", action="store_true")
+    parser.add_argument("--slab_reads", action="store_true")
+    parser.add_argument("--decoded_slab_mm", type=float, default=None)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_decoded_cache")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,77 @@
+""" Compare reading a DICOM series with sitk.ImageSeriesReader (one slice after
+another) and with read_dicom_threaded (slices decoded concurrently), on a
+synthetic series.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_dicom_read --work_dir /tmp/dicom_bench --compress
+"""
+import os
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import SimpleITK as sitk
+
+from data.dicom_index import scan_series
+from data.preprocessing import read_dicom_image, read_dicom_threaded
+from benchmarks.synthetic import make_ct_image, write_dicom_series
+
+
+
+
+def time_read(read, n_repeats) :
+    times = []
+    for _ in range(n_repeats) :
+        t0 = time.perf_counter()
+        image = read()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times)), image
+
+
+
+def main(args) :
+    series_dir = os.path.join(args.work_dir, "series.DICOM")
+    if not os.path.exists(series_dir) :
+        image, _ = make_ct_image(size=[512, 512, args.n_slices])
+        write_dicom_series(image, series_dir, compress=args.compress)
+    file_names = scan_series(series_dir)["files"]
+
+    results = {"n_slices": len(file_names), "compressed": args.compress,
+               "cpu_count": os.cpu_count()}
+    reference_s, reference = time_read(lambda : read_dicom_image(series_dir), args.n_repeats)
+    results["series_reader_s"] = reference_s
+    print(f"ImageSeriesReader: {reference_s:.3f} s")
+
+    for n_threads in args.n_threads :
+        seconds, image = time_read(lambda : read_dicom_threaded(file_names, n_threads),
+                                   args.n_repeats)
+        assert np.array_equal(sitk.GetArrayViewFromImage(image),
+                              sitk.GetArrayViewFromImage(reference))
+        assert np.allclose(image.GetSpacing(), reference.GetSpacing())
+        results[f"threaded_{n_threads}_s"] = seconds
+        print(f"{n_threads} threads: {seconds:.3f} s ({reference_s / seconds:.1f}x)")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--work_dir", type=str, default="/tmp/dicom_bench",
+                        help="Where to write the synthetic series.")
+    parser.add_argument("--n_slices", type=int, default=160,
+                        help="Number of slices in the synthetic series.")
+    parser.add_argument("--compress", action="store_true",
+                        help="Compress the slices of the synthetic series.")
+    parser.add_argument("--n_threads", type=int, nargs="*", default=[1, 2, 4, 8],
+                        help="Numbers of decoding threads to test.")
+    parser.add_argument("--n_repeats", type=int, default=3,
+                        help="Number of times each read is timed (the median is kept).")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the timings.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,246 @@
+""" Latency, activation memory, parameter count and FLOPs of the generators
+(models.generators) and discriminators (models.discriminators), for every
+combination of image size, number of filters, batch size and precision.
+
+For each configuration:
+    forward_ms          median time of a forward pass without autograd
+    train_ms            median time of a forward and backward pass
+    activation_mb       memory of the tensors kept for the backward pass,
+                        i.e. the activation memory at the end of the forward
+                        pass (excluding the parameters)
+    params              number of parameters
+    gflops_per_sample   analytic FLOPs of a forward pass of one sample,
+                        counting the convolutions and linear layers (a
+                        multiply-add is 2 FLOPs). The backward pass costs
+                        about twice as much.
+
+The activation memory is measured with torch.autograd.graph.saved_tensors_hooks
+where it exists (torch >= 1.10), and otherwise approximated by the outputs of
+every layer. Configurations a model does not support (e.g. an input depth
+too small for its number of poolings) are reported with their error.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_models --models UNet3D_3layer CNNnLayer \\
+      --image_sizes 8x128x128 --features 16 32 --batch_sizes 1 2
+"""
+import time
+import json
+from argparse import ArgumentParser
+from typing import Callable, Dict, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models.generators import UNet2D, UNet3D, UNet3D_3layer, ResNetK
+from models.discriminators import CNN_3D, CNNnLayer, PatchGAN_NLayer, VGG2D
+from benchmarks.bench_pipeline import git_commit
+
+
+# name: (kind, function of the number of filters and the image size [z, y, x]
+#        returning the model and the shape of one input sample)
+MODELS: Dict[str, Tuple[str, Callable]] = {
+    "UNet2D": ("generator", lambda f, size : (UNet2D(1, 1, init_features=f), [1] + size[1:])),
+    "UNet3D": ("generator", lambda f, size : (UNet3D(1, 1, init_features=f), [1] + size)),
+    "UNet3D_3layer": ("generator",
+                      lambda f, size : (UNet3D_3layer(1, 1, init_features=f), [1] + size)),
+    "ResNetK": ("generator", lambda f, size : (ResNetK(1, 1, n_filters=f), [1] + size)),
+    "CNN_3D": ("discriminator", lambda f, size : (CNN_3D(1, 1, init_features=f), [1] + size)),
+    "CNNnLayer": ("discriminator",
+                  lambda f, size : (CNNnLayer(1, 1, init_features=f, in_shape=list(size)),
+                                    [1] + size)),
+    "PatchGAN_NLayer": ("discriminator",
+                        lambda f, size : (PatchGAN_NLayer(1, 1, n_filters=f,
+                                                          input_shape=list(size)),
+                                          [1] + size)),
+    # The slices are the input channels of the 2D VGG
+    "VGG2D": ("discriminator", lambda f, size : (VGG2D(size[0], 1, n_filters=f), size)),
+}
+
+PRECISIONS = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+_CONVS = (nn.Conv1d, nn.Conv2d, nn.Conv3d)
+_TRANSPOSED_CONVS = (nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d)
+
+
+
+
+def layer_flops(module: nn.Module, inputs, output) -> int :
+    """Return the FLOPs of one call of a convolutional or linear layer."""
+    if isinstance(module, _CONVS) :
+        per_output = 2 * module.in_channels // module.groups * int(np.prod(module.kernel_size))
+        return output.numel() * (per_output + (module.bias is not None))
+    if isinstance(module, _TRANSPOSED_CONVS) :
+        per_input = 2 * module.out_channels // module.groups * int(np.prod(module.kernel_size))
+        return inputs[0].numel() * per_input + output.numel() * (module.bias is not None)
+    if isinstance(module, nn.Linear) :
+        n = output.numel() // module.out_features
+        return n * module.out_features * (2 * module.in_features + (module.bias is not None))
+    return 0
+
+
+
+def _tensors(obj) :
+    if torch.is_tensor(obj) :
+        yield obj
+    elif isinstance(obj, (tuple, list)) :
+        for o in obj :
+            yield from _tensors(o)
+
+
+
+def forward_stats(model: nn.Module, X: torch.Tensor) -> Dict[str, float] :
+    """ Run one forward pass with autograd and return its FLOPs and the
+    memory of the activations kept for the backward pass.
+    """
+    flops, activations = [0], {}
+    parameters = {p.data_ptr() for p in model.parameters()}
+
+    def record(tensor) :
+        if tensor.data_ptr() not in parameters :
+            activations[tensor.data_ptr()] = max(activations.get(tensor.data_ptr(), 0),
+                                                 tensor.element_size() * tensor.numel())
+
+    graph = getattr(torch.autograd, "graph", None)
+    saved_tensors = hasattr(graph, "saved_tensors_hooks")
+
+    def hook(module, inputs, output) :
+        flops[0] += layer_flops(module, inputs, output)
+        if not saved_tensors : # Every layer output, including in-place ones once
+            for tensor in _tensors(output) :
+                record(tensor)
+
+    leaves = [m for m in model.modules() if len(list(m.children())) == 0]
+    handles = [m.register_forward_hook(hook) for m in leaves]
+    try :
+        if saved_tensors :
+            def pack(tensor) :
+                record(tensor)
+                return tensor
+            with graph.saved_tensors_hooks(pack, lambda tensor : tensor) :
+                model(X)
+        else :
+            record(X)
+            model(X)
+    finally :
+        for handle in handles :
+            handle.remove()
+    return {"flops": flops[0], "activation_bytes": sum(activations.values()),
+            "activation_method": "saved_tensors" if saved_tensors else "layer_outputs"}
+
+
+
+def time_call(f: Callable, n_warmup: int, n_repeats: int, device: torch.device) -> float :
+    """Return the median time of f in seconds."""
+    times = []
+    for k in range(n_warmup + n_repeats) :
+        t0 = time.perf_counter()
+        f()
+        if device.type == "cuda" :
+            torch.cuda.synchronize(device)
+        if k >= n_warmup :
+            times.append(time.perf_counter() - t0)
+    return float(np.median(times))
+
+
+
+def benchmark(name: str, features: int, image_size: Sequence[int], batch_size: int,
+              precision: str, args, device: torch.device) -> Dict :
+    """Measure one model configuration."""
+    kind, build = MODELS[name]
+    torch.manual_seed(0)
+    model, sample_shape = build(features, list(image_size))
+    model = model.to(device=device, dtype=PRECISIONS[precision])
+    X = torch.randn(batch_size, *sample_shape, device=device, dtype=PRECISIONS[precision])
+    r = {"model": name, "kind": kind, "features": features, "image_size": list(image_size),
+         "batch_size": batch_size, "precision": precision,
+         "params": sum(p.numel() for p in model.parameters())}
+
+    model.train()
+    stats = forward_stats(model, X)
+    r["gflops_per_sample"] = stats["flops"] / batch_size / 1e9
+    r["activation_mb"] = stats["activation_bytes"] / 2**20
+    r["activation_method"] = stats["activation_method"]
+
+    def forward() :
+        with torch.no_grad() :
+            model(X)
+
+    def train_step() :
+        model.zero_grad()
+        model(X).float().mean().backward()
+
+    if device.type == "cuda" :
+        torch.cuda.reset_peak_memory_stats(device)
+    r["forward_ms"] = 1000 * time_call(forward, args.n_warmup, args.n_repeats, device)
+    r["train_ms"] = 1000 * time_call(train_step, args.n_warmup, args.n_repeats, device)
+    if device.type == "cuda" :
+        r["cuda_peak_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+    r["train_gflops_per_s"] = 3 * stats["flops"] / (r["train_ms"] / 1000) / 1e9
+    return r
+
+
+
+def main(args) :
+    device = torch.device(args.device)
+    image_sizes = [[int(s) for s in size.split("x")] for size in args.image_sizes]
+    results = {"commit": git_commit(), "config": {k: v for k, v in vars(args).items()
+                                                  if k != "out_path"},
+               "torch": torch.__version__, "threads": torch.get_num_threads(),
+               "results": []}
+
+    for name in args.models :
+        for image_size in image_sizes :
+            for features in args.features :
+                for batch_size in args.batch_sizes :
+                    for precision in args.precisions :
+                        config = (f"{name:>15} {'x'.join(map(str, image_size))}, {features:3d} "
+                                  f"filters, batch {batch_size}, {precision:>8}")
+                        try :
+                            r = benchmark(name, features, image_size, batch_size, precision,
+                                          args, device)
+                        except (RuntimeError, ValueError, TypeError) as e :
+                            error = str(e).split("\n")[0]
+                            results["results"].append({"model": name, "features": features,
+                                                       "image_size": image_size,
+                                                       "batch_size": batch_size,
+                                                       "precision": precision,
+                                                       "error": error})
+                            print(f"{config}: not supported ({error[:80]})")
+                            continue
+                        results["results"].append(r)
+                        print(f"{config}: forward {r['forward_ms']:8.1f} ms, forward+backward "
+                              f"{r['train_ms']:8.1f} ms, activations {r['activation_mb']:7.1f} MB, "
+                              f"{r['params'] / 1e6:6.2f} M params, "
+                              f"{r['gflops_per_sample']:7.2f} GFLOPs/sample")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=list(MODELS),
+                        choices=list(MODELS))
+    parser.add_argument("--image_sizes", type=str, nargs="+", default=["8x128x128"],
+                        help="Input image sizes, as ZxYxX.")
+    parser.add_argument("--features", type=int, nargs="+", default=[16, 32],
+                        help="Numbers of filters of the first layer (init_features or n_filters).")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--precisions", type=str, nargs="+", default=["float32", "bfloat16"],
+                        choices=list(PRECISIONS))
+    parser.add_argument("--n_warmup", type=int, default=1)
+    parser.add_argument("--n_repeats", type=int, default=3,
+                        help="Number of timed passes of each configuration.")
+    parser.add_argument("--n_threads", type=int, default=0,
+                        help="Number of torch threads. 0 keeps the default.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    if args.n_threads > 0 :
+        torch.set_num_threads(args.n_threads)
+    main(args)
@@ -0,0 +1,105 @@
+""" Compare training pairs per second with the bytes read from the image cache
+per second when each read of the cached images gives k pairs
+(crops_per_read, see data.data_loader.BaseDataset).
+
+The bytes are the `rchar` counter of /proc/self/io (bytes returned by read
+calls), so only file caches ("nrrd", "vol") are measured and the DataLoader
+runs in the main process. Linux only.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_multi_crop --crops_per_read 1 2 4
+"""
+import os
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from data.data_loader import UnpairedDataset, batch_loader, concat_collate
+from data.transforms import (AffineTransform, HorizontalFlip, Normalize, ToTensor,
+                             compile_transform)
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+def read_bytes() -> int :
+    """Return the number of bytes read by this process so far."""
+    with open("/proc/self/io", "r") as f :
+        for line in f :
+            if line.startswith("rchar:") :
+                return int(line.split()[1])
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, "images")
+    df = make_nrrd_cohort(image_dir, args.n_images, size=[512, 512, 48])
+    x_df, y_df = df.iloc[: len(df) // 2], df.iloc[len(df) // 2 :]
+    margin = [(c - s) // 2 for c, s in zip(args.cache_size, args.image_size)]
+    results = []
+
+    for cache_format in args.cache_formats :
+        for k in args.crops_per_read :
+            transform = compile_transform([HorizontalFlip(),
+                                           AffineTransform(max_angle=30.0, max_pixels=[20, 20]),
+                                           Normalize(-1000.0, 1000.0), ToTensor()])
+            dataset = UnpairedDataset(x_df, y_df, image_dir=image_dir,
+                                      cache_dir=os.path.join(args.work_dir, cache_format),
+                                      file_type="nrrd", image_size=args.image_size,
+                                      image_spacing=[2.0, 1.0, 1.0], transform=transform,
+                                      cache_format=cache_format, cache_size=args.cache_size,
+                                      crop_jitter=margin, crops_per_read=k)
+            loader = batch_loader(dataset, batch_size=args.batch_size, shuffle=True,
+                                  drop_last=True)
+
+            # A regular DataLoader with concat_collate gives batches of the same shape
+            regular = DataLoader(dataset, batch_size=args.batch_size // k,
+                                 collate_fn=concat_collate)
+            X0, _ = next(iter(loader))
+            X1, _ = next(iter(regular))
+            assert X0.shape == X1.shape == (args.batch_size, 1) + tuple(args.image_size)
+
+            n_pairs, n_bytes, t0 = 0, read_bytes(), time.perf_counter()
+            for _ in range(args.n_epochs) :
+                for X, Y in loader :
+                    n_pairs += len(X)
+            elapsed, n_bytes = time.perf_counter() - t0, read_bytes() - n_bytes
+
+            r = {"cache_format": cache_format, "crops_per_read": k,
+                 "pairs_per_s": n_pairs / elapsed,
+                 "read_mb_per_s": n_bytes / elapsed / 2**20,
+                 "read_mb_per_pair": n_bytes / n_pairs / 2**20}
+            results.append(r)
+            print(f"{cache_format:>5}, {k} pairs per read: {r['pairs_per_s']:6.1f} pairs/s, "
+                  f"read {r['read_mb_per_s']:6.1f} MB/s, {r['read_mb_per_pair']:5.2f} MB/pair")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=16,
+                        help="Number of synthetic images in the cohort.")
+    parser.add_argument("--n_epochs", type=int, default=2,
+                        help="Number of passes over the dataset for the timings.")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--crops_per_read", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--cache_formats", type=str, nargs="+", default=["nrrd", "vol"])
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_multi_crop",
+                        help="Where to write the cohort and the caches.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the training images [z, y, x].")
+    parser.add_argument("--cache_size", type=int, nargs=3, default=[16, 320, 320],
+                        help="Size of the cached slabs [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,95 @@
+""" Compare looking up the DA slice and crop centre of a patient in a pandas
+data frame (`df.at`) with the shared arrays of PatientMetadata, and the size
+of the data frames that a DataLoader worker started with spawn no longer
+unpickles.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_patient_metadata --n_patients 4000
+"""
+import time
+import json
+import pickle
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from data.patient_metadata import PatientMetadata
+
+
+
+
+def make_frame(n_patients: int) -> pd.DataFrame :
+    """A label data frame like the ones of datasets/, with random values."""
+    rng = np.random.RandomState(0)
+    ids = [str(3000000 + k) for k in rng.choice(2000000, n_patients, replace=False)]
+    a_slice = rng.randint(60, 160, n_patients)
+    df = pd.DataFrame({"p_index": np.arange(n_patients),
+                       "has_artifact": rng.choice(["0", "1", "2"], n_patients),
+                       "a_slice": a_slice, "DA_z": 2 * a_slice,
+                       "img_center_x": rng.normal(0, 5, n_patients),
+                       "img_center_y": rng.normal(-35, 10, n_patients),
+                       "img_center_z": rng.normal(-900, 20, n_patients)},
+                      index=pd.Index(ids, name="patient_id"))
+    return df
+
+
+
+def time_lookups(f, ids) -> float :
+    """Return the time per lookup in microseconds."""
+    t0 = time.perf_counter()
+    for patient_id in ids :
+        f(patient_id)
+    return 1e6 * (time.perf_counter() - t0) / len(ids)
+
+
+
+def main(args) :
+    df = make_frame(args.n_patients)
+    metadata = PatientMetadata.from_frame(df)
+    ids = list(np.random.RandomState(1).choice(df.index, args.n_lookups))
+
+    # Same values
+    identical = all(metadata.da_slice(id) == int(df.at[id, "a_slice"]) and
+                    np.array_equal(metadata.centre(id),
+                                   [df.at[id, c] for c in ["img_center_x", "img_center_y",
+                                                           "img_center_z"]])
+                    for id in ids[:1000])
+
+    results = {"n_patients": args.n_patients, "identical": identical}
+    results["frame_da_slice_us"] = time_lookups(lambda id : int(df.at[id, "a_slice"]), ids)
+    results["metadata_da_slice_us"] = time_lookups(metadata.da_slice, ids)
+    results["frame_centre_us"] = time_lookups(
+        lambda id : [float(df.at[id, c]) for c in ["img_center_x", "img_center_y",
+                                                   "img_center_z"]], ids)
+    results["metadata_centre_us"] = time_lookups(metadata.centre, ids)
+
+    # What a worker started with spawn no longer unpickles (X_df, Y_df, full_df)
+    results["pickled_frames_kb"] = len(pickle.dumps([df, df.iloc[:0], df])) / 1024
+    results["metadata_kb"] = (len(metadata._raw_ids) + 8 * (len(metadata._raw_order) +
+                              len(metadata._raw_ints) + len(metadata._raw_centre))) / 1024
+
+    print(f"Same values as the data frame: {identical}")
+    print(f"DA slice: df.at {results['frame_da_slice_us']:5.1f} us, "
+          f"metadata {results['metadata_da_slice_us']:5.1f} us")
+    print(f"Centre:   df.at {results['frame_centre_us']:5.1f} us, "
+          f"metadata {results['metadata_centre_us']:5.1f} us")
+    print(f"Data frames pickled for each spawned worker before: "
+          f"{results['pickled_frames_kb']:.0f} kB. Shared metadata arrays, not copied: "
+          f"{results['metadata_kb']:.0f} kB.")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_patients", type=int, default=4000)
+    parser.add_argument("--n_lookups", type=int, default=20000)
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,301 @@
+""" Throughput of the data pipeline on a synthetic cohort: preprocessing and
+caching (patients/s), then loading batches with `batch_loader` (samples/s)
+for every combination of dataset, number of workers, batch size and
+transform chain, with the peak resident memory of each run.
+
+The results are written as JSON with the commit they were measured on, so
+runs can be compared across commits with --baseline. Memory is sampled from
+/proc, so Linux only.
+
+Transform chains:
+    val     Normalize, ToTensor (validation)
+    train   HorizontalFlip, AffineTransform, Normalize, ToTensor, step by step
+    fused   the train chain compiled into a FusedTransform
+    batch   ToTensor in the dataset, BatchAffineTransform and Normalize on
+            whole batches in the collate function (--batch_augment)
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_pipeline --file_type nrrd --num_workers 0 2 \\
+      --batch_sizes 1 4 --out_path /tmp/pipeline.json
+"""
+import os
+import time
+import json
+import shutil
+import resource
+import threading
+import subprocess
+from argparse import ArgumentParser
+from typing import Dict, List
+
+import numpy as np
+import torch
+import torchvision
+
+from data.data_loader import UnpairedDataset, PairedDataset, batch_loader, BatchCollate
+from data.transforms import (AffineTransform, BatchAffineTransform, HorizontalFlip,
+                             Normalize, ToTensor, compile_transform)
+from benchmarks.synthetic import make_nrrd_cohort, make_dicom_cohort
+
+
+PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 2**20
+
+DATASETS = {"unpaired": UnpairedDataset, "paired": PairedDataset}
+
+
+
+
+def get_transforms(name: str):
+    """Return the transform of the dataset and the collate function of a
+    transform chain (None for the default)."""
+    if name == "val" :
+        return torchvision.transforms.Compose([Normalize(-1000.0, 1000.0), ToTensor()]), None
+    train = [HorizontalFlip(), AffineTransform(max_angle=30.0, max_pixels=[20, 20]),
+             Normalize(-1000.0, 1000.0), ToTensor()]
+    if name == "train" :
+        return torchvision.transforms.Compose(train), None
+    if name == "fused" :
+        return compile_transform(train), None
+    if name == "batch" :
+        collate = BatchCollate([BatchAffineTransform(max_angle=30.0, max_pixels=[20, 20],
+                                                     spacing=[1.0, 1.0]),
+                                Normalize(-1000.0, 1000.0)])
+        return compile_transform([ToTensor()]), collate
+    raise ValueError(f"Unknown transform chain {name}.")
+
+
+
+def _rss_mb(pid: int) -> float :
+    with open(f"/proc/{pid}/statm", "r") as f :
+        return int(f.read().split()[1]) * PAGE_MB
+
+
+
+def _children(pid: int) -> List[int] :
+    children = []
+    for tid in os.listdir(f"/proc/{pid}/task") :
+        with open(f"/proc/{pid}/task/{tid}/children", "r") as f :
+            children.extend(int(c) for c in f.read().split())
+    return children
+
+
+
+class PeakRSS :
+    """Sample the resident memory of this process and of its child processes
+    (the DataLoader workers) in a background thread, and keep the peaks.
+
+    The total counts the pages shared by the workers and the main process
+    (e.g. a cache inherited through fork) once per process, so it is an upper
+    bound on the memory used.
+    """
+    def __init__(self, interval: float = 0.02) :
+        self.interval = interval
+        self.main_mb = self.total_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self) :
+        pid = os.getpid()
+        main = total = _rss_mb(pid)
+        for child in _children(pid) :
+            try :
+                total += _rss_mb(child)
+            except (FileNotFoundError, ProcessLookupError) : # Worker just exited
+                pass
+        self.main_mb = max(self.main_mb, main)
+        self.total_mb = max(self.total_mb, total)
+
+    def _run(self) :
+        while not self._stop.wait(self.interval) :
+            self._sample()
+
+    def __enter__(self) :
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) :
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+
+def git_commit() -> str :
+    """Return the commit of the working tree, with '-dirty' if it has changes."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try :
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                         cwd=root, stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError) :
+        return "unknown"
+    return commit + ("-dirty" if status.strip() else "")
+
+
+
+def make_datasets(args, df) -> Dict[str, Dict] :
+    """Build the cache of every dataset from scratch and time it."""
+    half = len(df) // 2
+    x_df, y_df = df.iloc[: half], df.iloc[half : 2 * half]
+    results = {}
+    for name in args.datasets :
+        cache_dir = os.path.join(args.work_dir, f"cache_{args.file_type}", name)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        kwargs = {"image_dir": os.path.join(args.work_dir, f"images_{args.file_type}"),
+                  "cache_dir": cache_dir, "file_type": args.file_type,
+                  "image_size": args.image_size, "image_spacing": args.image_spacing,
+                  "cache_format": args.cache_format, "num_workers": args.preprocess_workers}
+        with PeakRSS() as rss :
+            t0 = time.perf_counter()
+            dataset = DATASETS[name](x_df, y_df, **kwargs)
+            elapsed = time.perf_counter() - t0
+        n_patients = len(dataset.full_df)
+        results[name] = {"dataset": dataset,
+                         "preprocess": {"dataset": name, "patients": n_patients,
+                                        "seconds": elapsed,
+                                        "patients_per_s": n_patients / elapsed,
+                                        "peak_rss_mb": rss.main_mb,
+                                        "peak_rss_total_mb": rss.total_mb}}
+        print(f"{name:>8}: cached {n_patients} patients in {elapsed:6.1f} s "
+              f"({n_patients / elapsed:5.2f} patients/s), peak RSS {rss.total_mb:7.1f} MB")
+    return results
+
+
+
+def time_loading(dataset, args, num_workers: int, batch_size: int, chain: str) -> Dict :
+    """Iterate over the dataset with batch_loader and time it."""
+    dataset.transform, collate = get_transforms(chain)
+    kwargs = {} if collate is None else {"collate_fn": collate}
+    loader = batch_loader(dataset, batch_size=batch_size, shuffle=True, drop_last=True,
+                          num_workers=num_workers, **kwargs)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    n_samples, n_batches, first_batch_s = 0, 0, None
+    with PeakRSS() as rss :
+        t0 = time.perf_counter()
+        for _ in range(args.n_epochs) :
+            for X, Y in loader :
+                if first_batch_s is None : # Includes starting the workers
+                    first_batch_s = time.perf_counter() - t0
+                n_samples += len(X)
+                n_batches += 1
+        elapsed = time.perf_counter() - t0
+    return {"num_workers": num_workers, "batch_size": batch_size, "transform": chain,
+            "samples": n_samples, "seconds": elapsed,
+            "samples_per_s": n_samples / elapsed,
+            "batches_per_s": n_batches / elapsed,
+            "first_batch_s": first_batch_s,
+            "peak_rss_mb": rss.main_mb,
+            "peak_rss_total_mb": rss.total_mb}
+
+
+
+def compare(results: Dict, baseline_path: str) :
+    """Print the change in throughput from the results of a previous run."""
+    with open(baseline_path, "r") as f :
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline['commit']} ({baseline_path}):")
+    changed = [k for k, v in results["config"].items() if baseline["config"].get(k) != v]
+    if len(changed) > 0 :
+        print(f"Warning: the runs differ in {', '.join(changed)}.")
+    key = lambda r : (r["dataset"], r["num_workers"], r["batch_size"], r["transform"])
+    previous = {key(r): r for r in baseline["loading"]}
+    for r in results["loading"] :
+        if key(r) in previous and previous[key(r)]["samples_per_s"] > 0 :
+            ratio = r["samples_per_s"] / previous[key(r)]["samples_per_s"]
+            print(f"{r['dataset']:>8}, {r['num_workers']} workers, batch {r['batch_size']:2d}, "
+                  f"{r['transform']:>5}: {ratio:5.2f}x samples/s")
+    previous = {r["dataset"]: r for r in baseline["preprocess"]}
+    for r in results["preprocess"] :
+        if r["dataset"] in previous :
+            ratio = r["patients_per_s"] / previous[r["dataset"]]["patients_per_s"]
+            print(f"{r['dataset']:>8}, preprocessing: {ratio:5.2f}x patients/s")
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, f"images_{args.file_type}")
+    size, spacing = args.volume_size[::-1], args.volume_spacing[::-1] # (x, y, z)
+    t0 = time.perf_counter()
+    if args.file_type == "nrrd" :
+        df = make_nrrd_cohort(image_dir, args.n_images, size=size, spacing=spacing)
+    else :
+        df = make_dicom_cohort(image_dir, args.n_images, size=size, spacing=spacing,
+                               compress=args.compress)
+    print(f"Synthetic {args.file_type} cohort of {len(df)} images ready in "
+          f"{time.perf_counter() - t0:.1f} s")
+
+    config = {k: v for k, v in vars(args).items() if k not in ["out_path", "baseline"]}
+    results = {"commit": git_commit(), "config": config,
+               "torch": torch.__version__, "cpus": os.cpu_count(),
+               "preprocess": [], "loading": []}
+    datasets = make_datasets(args, df)
+    for name, d in datasets.items() :
+        results["preprocess"].append(d["preprocess"])
+        for chain in args.transforms :
+            for num_workers in args.num_workers :
+                for batch_size in args.batch_sizes :
+                    r = time_loading(d["dataset"], args, num_workers, batch_size, chain)
+                    r = {"dataset": name, **r}
+                    results["loading"].append(r)
+                    # None (null in the JSON) if the dataset is smaller than a batch
+                    first_batch = ("   none" if r["first_batch_s"] is None
+                                   else f"{r['first_batch_s']:5.2f} s")
+                    print(f"{name:>8}, {num_workers} workers, batch {batch_size:2d}, "
+                          f"{chain:>5}: {r['samples_per_s']:6.1f} samples/s, first batch "
+                          f"{first_batch}, peak RSS {r['peak_rss_mb']:7.1f} MB "
+                          f"(with workers {r['peak_rss_total_mb']:7.1f} MB)")
+
+    # High-water marks of the whole run, for comparison with the samples above
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results["max_rss_children_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    if args.baseline :
+        compare(results, args.baseline)
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--file_type", type=str, default="nrrd", choices=["nrrd", "DICOM"],
+                        help="Format of the synthetic cohort.")
+    parser.add_argument("--compress", action="store_true",
+                        help="Compress the pixel data of the DICOM slices.")
+    parser.add_argument("--n_images", type=int, default=16,
+                        help="Number of synthetic images in the cohort.")
+    parser.add_argument("--volume_size", type=int, nargs=3, default=[48, 512, 512],
+                        help="Size of the synthetic volumes [z, y, x].")
+    parser.add_argument("--volume_spacing", type=float, nargs=3, default=[2.0, 0.98, 0.98],
+                        help="Voxel spacing of the synthetic volumes in mm [z, y, x].")
+    parser.add_argument("--datasets", type=str, nargs="+", default=["unpaired", "paired"],
+                        choices=list(DATASETS))
+    parser.add_argument("--cache_format", type=str, default="nrrd",
+                        choices=["nrrd", "vol", "memmap"])
+    parser.add_argument("--preprocess_workers", type=int, default=1,
+                        help="Number of processes used to build the caches.")
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 2],
+                        help="Numbers of DataLoader worker processes.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--transforms", type=str, nargs="+", default=["val", "train", "fused"],
+                        choices=["val", "train", "fused", "batch"],
+                        help="Transform chains, see the description of the module.")
+    parser.add_argument("--n_epochs", type=int, default=2,
+                        help="Number of passes over the dataset for each timing.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the cached images [z, y, x].")
+    parser.add_argument("--image_spacing", type=float, nargs=3, default=[2.0, 1.0, 1.0],
+                        help="Spacing of the cached images [z, y, x].")
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_pipeline",
+                        help="Where to write the cohort and the caches.")
+    parser.add_argument("--baseline", type=str, default="",
+                        help="Optional results of a previous run (--out_path) to compare with.")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,108 @@
+""" Compare the time per step of a training loop iterating over the DataLoader
+directly with the same loop over a DevicePrefetcher (data.prefetch), and
+report the fraction of the time spent waiting for data.
+
+The training step is simulated: by default the loop is idle for --step_ms,
+like a GPU step during which the CPU waits for the kernels. Use --step conv to
+run a small 3D convolution on the batch instead (on the prefetcher's device).
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_prefetch --step_ms 40
+"""
+import os
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from data.data_loader import UnpairedDataset, batch_loader
+from data.prefetch import DevicePrefetcher
+from data.transforms import (AffineTransform, HorizontalFlip, Normalize, ToTensor,
+                             compile_transform)
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+def run_loop(batches, step) -> dict :
+    """Run the simulated training loop and time it."""
+    n, wait, t0 = 0, 0.0, time.perf_counter()
+    t_request = t0
+    for X, Y in batches :
+        wait += time.perf_counter() - t_request
+        step(X, Y)
+        n += 1
+        t_request = time.perf_counter()
+    total = time.perf_counter() - t0
+    return {"step_ms": 1000 * total / n, "data_wait_fraction": wait / total}
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, "images")
+    df = make_nrrd_cohort(image_dir, args.n_images, size=[512, 512, 48])
+    transform = compile_transform([HorizontalFlip(),
+                                   AffineTransform(max_angle=30.0, max_pixels=[20, 20]),
+                                   Normalize(-1000.0, 1000.0), ToTensor()])
+    dataset = UnpairedDataset(df.iloc[: len(df) // 2], df.iloc[len(df) // 2 :],
+                              image_dir=image_dir,
+                              cache_dir=os.path.join(args.work_dir, "cache"),
+                              file_type="nrrd", image_size=args.image_size,
+                              image_spacing=[2.0, 1.0, 1.0], transform=transform,
+                              cache_format="memmap")
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    loader = batch_loader(dataset, batch_size=args.batch_size, shuffle=True, drop_last=True,
+                          num_workers=args.num_workers, pin_memory=device.type == "cuda")
+
+    if args.step == "sleep" :
+        def step(X, Y) :
+            time.sleep(args.step_ms / 1000)
+    else :
+        conv = torch.nn.Conv3d(1, 8, 3, padding=1).to(device)
+        def step(X, Y) :
+            conv(X.to(device)).sum().item()
+
+    results = {}
+    for name in ["direct", "prefetch"] :
+        torch.manual_seed(0)
+        np.random.seed(0)
+        batches = loader if name == "direct" else DevicePrefetcher(loader, device)
+        r = run_loop(batches, step)
+        for _ in range(args.n_epochs - 1) :
+            rest = run_loop(batches, step)
+            r = {k: (r[k] + rest[k]) for k in r}
+        results[name] = r = {k: v / args.n_epochs for k, v in r.items()}
+        print(f"{name:>8}: {r['step_ms']:6.1f} ms/step, waiting for data "
+              f"{100 * r['data_wait_fraction']:4.1f}% of the time")
+        if name == "prefetch" :
+            print(f"Prefetcher stats: {batches.stats()}")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=16,
+                        help="Number of synthetic images in the cohort.")
+    parser.add_argument("--n_epochs", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Number of DataLoader worker processes.")
+    parser.add_argument("--step", type=str, default="sleep", choices=["sleep", "conv"],
+                        help="How the training step is simulated.")
+    parser.add_argument("--step_ms", type=float, default=40.0,
+                        help="Duration of the simulated step with --step sleep.")
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_prefetch",
+                        help="Where to write the cohort and the cache.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the images [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
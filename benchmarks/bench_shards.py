@@ -0,0 +1,182 @@
+""" Compare one epoch of UnpairedDataset (one file read per image) with
+ShardedUnpairedDataset (whole shards read sequentially) on a synthetic cohort.
+Reports the samples/s and the number of files opened per epoch, and checks
+that every image of domain X is seen exactly once per epoch and that the Y
+partners are random.
+
+The epochs are run with the validation chain (Normalize, ToTensor) and with
+the training chain (HorizontalFlip, AffineTransform, Normalize, ToTensor).
+For the training chain, the windows read from the shards are also checked to
+have the same pixels and geometry as the windows read from the cache, and to
+give the same tensors with the same random parameters.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_shards --n_images 32 --num_workers 0 1
+"""
+import os
+import time
+import json
+import builtins
+from argparse import ArgumentParser
+from collections import Counter
+
+import numpy as np
+import torch
+import SimpleITK as sitk
+from torch.utils.data import DataLoader
+
+from data.data_loader import UnpairedDataset
+from data.shards import ShardedUnpairedDataset, write_shards
+from data.transforms import (AffineTransform, HorizontalFlip, Normalize, ToTensor,
+                             compile_transform)
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+class CountOpens :
+    """Count the files opened with `open` in this process."""
+    def __enter__(self) :
+        self.count, self._open = 0, builtins.open
+        def counted(*args, **kwargs) :
+            self.count += 1
+            return self._open(*args, **kwargs)
+        builtins.open = counted
+        return self
+
+    def __exit__(self, *exc) :
+        builtins.open = self._open
+
+
+
+def epoch(loader) -> tuple :
+    """Return the samples of one epoch and the time taken."""
+    t0 = time.perf_counter()
+    samples = [(x.clone(), y.clone()) for x, y in loader]
+    return samples, time.perf_counter() - t0
+
+
+
+def same_windows(dataset, stream, train_transform, n_images: int = 4) -> bool :
+    """Whether the shards give the same windows, with the same geometry, as the
+    cache, and the same tensors through the training chain."""
+    start = (np.array(stream.shape) - np.array(stream.size)) // 2
+    records = stream._read_shard(stream.x_shards[0])[:n_images]
+    for record, payload in records :
+        from_shard = stream._image(record, payload, start)
+        image = dataset._read_cached(record["patient_id"])
+        stop = start + np.array(stream.size)
+        from_cache = image[start[2] : stop[2], start[1] : stop[1], start[0] : stop[0]]
+        if not (isinstance(from_shard, sitk.Image) and
+                np.array_equal(sitk.GetArrayViewFromImage(from_shard),
+                               sitk.GetArrayViewFromImage(from_cache).astype(np.float32)) and
+                np.allclose(from_shard.GetOrigin(), from_cache.GetOrigin()) and
+                np.allclose(from_shard.GetSpacing(), from_cache.GetSpacing()) and
+                np.allclose(from_shard.GetDirection(), from_cache.GetDirection())) :
+            return False
+        tensors = []
+        for image in [from_shard, sitk.Cast(from_cache, sitk.sitkFloat32)] :
+            np.random.seed(0)
+            torch.manual_seed(0)
+            tensors.append(train_transform((image, image)))
+        if not all(torch.equal(a, b) for a, b in zip(*tensors)) :
+            return False
+    return True
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, "images")
+    df = make_nrrd_cohort(image_dir, args.n_images, size=[512, 512, 48])
+    x_df, y_df = df[df["has_artifact"] == "2"], df[df["has_artifact"] == "0"]
+    transform = compile_transform([Normalize(-1000.0, 1000.0), ToTensor()])
+    dataset = UnpairedDataset(x_df, y_df, image_dir=image_dir, file_type="nrrd",
+                              cache_dir=os.path.join(args.work_dir, "cache"),
+                              cache_format="vol", image_size=args.image_size,
+                              transform=transform)
+    shard_dir = os.path.join(args.work_dir, "shards")
+    t0 = time.perf_counter()
+    index = write_shards(dataset, shard_dir, shard_bytes=args.shard_mb * 2**20)
+    results = {"n_images": args.n_images, "shard_mb": args.shard_mb,
+               "write_s": time.perf_counter() - t0,
+               "n_shards": {d: len(s) for d, s in index["domains"].items()}, "runs": []}
+
+    # The X images of the cache, to recognise them in the samples
+    x_images = {bytes(transform((dataset._read_cached(id), dataset._read_cached(id)))[0]
+                      .numpy().tobytes()) : id for id in dataset.x_ids}
+    y_images = {bytes(transform((dataset._read_cached(id), dataset._read_cached(id)))[0]
+                      .numpy().tobytes()) : id for id in dataset.y_ids}
+
+    # The training chain needs SimpleITK images with the geometry of the windows
+    train_transform = compile_transform([HorizontalFlip(),
+                                         AffineTransform(max_angle=30.0, max_pixels=[20, 20]),
+                                         Normalize(-1000.0, 1000.0), ToTensor()])
+    window = [args.image_size[0], args.image_size[1] - 32, args.image_size[2] - 32]
+    stream = ShardedUnpairedDataset(shard_dir, image_size=window, transform=train_transform)
+    results["train_same_windows"] = same_windows(dataset, stream, train_transform)
+    print(f"Training chain: same windows, geometry and tensors from the shards as from "
+          f"the cache: {results['train_same_windows']}")
+
+    for num_workers in args.num_workers :
+        stream = ShardedUnpairedDataset(shard_dir, transform=transform,
+                                        shuffle_buffer=args.shuffle_buffer)
+        loaders = {"files": DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                       num_workers=num_workers),
+                   "shards": DataLoader(stream, batch_size=args.batch_size,
+                                        num_workers=num_workers)}
+        for name, loader in loaders.items() :
+            with CountOpens() as opens :
+                samples, seconds = epoch(loader)
+            xs = [x_images[bytes(x.numpy().tobytes())] for b in samples for x in b[0]]
+            ys = [y_images[bytes(y.numpy().tobytes())] for b in samples for y in b[1]]
+            run = {"loader": name, "num_workers": num_workers, "chain": "val",
+                   "samples_per_s": len(xs) / seconds,
+                   "x_once": sorted(xs) == sorted(str(id) for id in dataset.x_ids),
+                   "distinct_y": len(set(ys)), "max_y_repeats": max(Counter(ys).values()),
+                   "opens_main_process": opens.count if num_workers == 0 else None}
+            results["runs"].append(run)
+            opens = "" if run["opens_main_process"] is None else \
+                    f", {run['opens_main_process']} files opened"
+            print(f"{name:>6} workers={num_workers}: {run['samples_per_s']:6.1f} samples/s, "
+                  f"each X once: {run['x_once']}, {run['distinct_y']} distinct Y of "
+                  f"{len(dataset.y_ids)}{opens}")
+
+    # One epoch with the training chain, whose samples can't be recognised
+    dataset.transform = train_transform
+    for num_workers in args.num_workers :
+        stream = ShardedUnpairedDataset(shard_dir, transform=train_transform,
+                                        shuffle_buffer=args.shuffle_buffer)
+        loaders = {"files": DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                       num_workers=num_workers),
+                   "shards": DataLoader(stream, batch_size=args.batch_size,
+                                        num_workers=num_workers)}
+        for name, loader in loaders.items() :
+            samples, seconds = epoch(loader)
+            n_samples = sum(len(b[0]) for b in samples)
+            run = {"loader": name, "num_workers": num_workers, "chain": "train",
+                   "samples_per_s": n_samples / seconds,
+                   "all_samples": n_samples == len(dataset.x_ids)}
+            results["runs"].append(run)
+            print(f"{name:>6} workers={num_workers}, training chain: "
+                  f"{run['samples_per_s']:6.1f} samples/s, {n_samples} samples")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=32)
+    parser.add_argument("--image_size", type=int, nargs=3, default=[16, 256, 256])
+    parser.add_argument("--shard_mb", type=int, default=16)
+    parser.add_argument("--shuffle_buffer", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 1])
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_shards")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,100 @@
+""" Check that centred windows taken from a cache of larger slabs
+(cache_size > image_size) are identical to a cache of image_size, and compare
+the time per sample of random windows with each cache format.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_slab_windows --margin 4 32 32
+"""
+import os
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torchvision
+import SimpleITK as sitk
+
+from data.data_loader import PairedDataset
+from data.transforms import Normalize, ToTensor
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+def time_samples(dataset, n_samples: int) -> float :
+    """Return the mean time of __getitem__."""
+    np.random.seed(0)
+    t0 = time.perf_counter()
+    for k in range(n_samples) :
+        dataset[k % len(dataset)]
+    return (time.perf_counter() - t0) / n_samples
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, "images")
+    df = make_nrrd_cohort(image_dir, args.n_images, size=[512, 512, 48])
+    x_df, y_df = df.iloc[: len(df) // 2], df.iloc[len(df) // 2 :]
+    cache_size = [s + 2 * m for s, m in zip(args.image_size, args.margin)]
+    transform = torchvision.transforms.Compose([Normalize(-1000.0, 1000.0), ToTensor()])
+    results = {"cache_size": cache_size, "formats": []}
+
+    for cache_format in args.cache_formats :
+        kwargs = {"image_dir": image_dir, "file_type": "nrrd", "image_size": args.image_size,
+                  "image_spacing": [2.0, 1.0, 1.0], "transform": transform,
+                  "cache_dir": os.path.join(args.work_dir, cache_format),
+                  "cache_format": cache_format}
+        exact = PairedDataset(x_df, y_df, **kwargs)
+        centred = PairedDataset(x_df, y_df, **kwargs, cache_size=cache_size)
+        jittered = PairedDataset(x_df, y_df, **kwargs, cache_size=cache_size,
+                                 crop_jitter=args.margin)
+
+        # Same pixels and same physical position as the exact crop
+        identical = True
+        for k in range(len(exact)) :
+            identical &= all(torch.equal(a, b) for a, b in zip(exact[k], centred[k]))
+            patient_id = exact.x_ids[k]
+            a = exact._read_cached(patient_id)
+            b = centred._read_cached(patient_id, centred._window_start())
+            identical &= (np.allclose(a.GetOrigin(), b.GetOrigin()) and
+                          np.array_equal(sitk.GetArrayViewFromImage(a),
+                                         sitk.GetArrayViewFromImage(b)))
+
+        np.random.seed(0)
+        starts = {tuple(jittered._window_start()) for _ in range(args.n_samples)}
+        exact_s = time_samples(exact, args.n_samples)
+        jittered_s = time_samples(jittered, args.n_samples)
+        batch = jittered.__getitems__(list(range(min(4, len(jittered)))))
+        results["formats"].append({"cache_format": cache_format, "identical": bool(identical),
+                                   "exact_ms": 1000 * exact_s, "window_ms": 1000 * jittered_s,
+                                   "distinct_windows": len(starts)})
+        print(f"{cache_format:>6}: centred windows identical to the exact crop: {identical}. "
+              f"Exact crop {1000 * exact_s:5.1f} ms/sample, random window "
+              f"{1000 * jittered_s:5.1f} ms/sample, {len(starts)} distinct windows in "
+              f"{args.n_samples} samples, batch {tuple(batch[0].shape)}")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=8,
+                        help="Number of synthetic images in the cohort.")
+    parser.add_argument("--n_samples", type=int, default=64,
+                        help="Number of samples loaded for the timings.")
+    parser.add_argument("--cache_formats", type=str, nargs="+", default=["nrrd", "vol", "memmap"])
+    parser.add_argument("--margin", type=int, nargs=3, default=[4, 32, 32],
+                        help="Margin [z, y, x] of the cached slab on each side of the image.")
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_slab_windows",
+                        help="Where to write the cohort and the caches.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the images [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
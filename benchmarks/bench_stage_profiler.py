@@ -0,0 +1,88 @@
+""" Print the per-stage timings of the data pipeline recorded by
+util.profiling.StageProfiler, aggregated over the DataLoader workers, and
+measure the overhead of recording them.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_stage_profiler --num_workers 2
+"""
+import os
+import time
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torchvision
+
+from data.data_loader import UnpairedDataset, batch_loader
+from data.transforms import AffineTransform, HorizontalFlip, Normalize, ToTensor
+from util.profiling import StageProfiler
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+def time_epochs(loader, n_epochs: int) -> float :
+    """Return the mean time per batch."""
+    n, t0 = 0, time.perf_counter()
+    for _ in range(n_epochs) :
+        for batch in loader :
+            n += 1
+    return (time.perf_counter() - t0) / n
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, "images")
+    df = make_nrrd_cohort(image_dir, args.n_images, size=[512, 512, 48])
+    transform = torchvision.transforms.Compose([
+                    HorizontalFlip(), AffineTransform(max_angle=30.0, max_pixels=[20, 20]),
+                    Normalize(-1000.0, 1000.0), ToTensor()])
+    results = {}
+    for name in ["off", "on"] :
+        profiler = StageProfiler() if name == "on" else None
+        dataset = UnpairedDataset(df.iloc[: len(df) // 2], df.iloc[len(df) // 2 :],
+                                  image_dir=image_dir,
+                                  cache_dir=os.path.join(args.work_dir, "cache"),
+                                  file_type="nrrd", image_size=args.image_size,
+                                  image_spacing=[2.0, 1.0, 1.0], transform=transform,
+                                  cache_format=args.cache_format, profiler=profiler)
+        loader = batch_loader(dataset, batch_size=args.batch_size, shuffle=True,
+                              drop_last=True, num_workers=args.num_workers)
+        np.random.seed(0)
+        torch.manual_seed(0)
+        results[f"profiler_{name}_ms_per_batch"] = 1000 * time_epochs(loader, args.n_epochs)
+
+    stats = profiler.snapshot()
+    results["stages"] = stats
+    print(f"{'stage':>16} {'calls':>6} {'ms/call':>8} {'total s':>8} {'MB read':>8} {'MB alloc':>9}")
+    for stage, s in stats.items() :
+        print(f"{stage:>16} {s['calls']:6.0f} {s['ms_per_call']:8.2f} {s['seconds']:8.2f} "
+              f"{s['mb_read']:8.1f} {s['mb_allocated']:9.1f}")
+    print(f"Time per batch: {results['profiler_off_ms_per_batch']:.1f} ms without profiler, "
+          f"{results['profiler_on_ms_per_batch']:.1f} ms with profiler")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=16,
+                        help="Number of synthetic images in the cohort.")
+    parser.add_argument("--n_epochs", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_workers", type=int, default=2,
+                        help="Number of DataLoader worker processes.")
+    parser.add_argument("--cache_format", type=str, default="nrrd")
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_stage_profiler",
+                        help="Where to write the cohort and the cache.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the images [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
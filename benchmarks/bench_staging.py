@@ -0,0 +1,112 @@
+""" Stage the cache of a synthetic cohort to a local directory and report the
+staging time and the local hit ratio: when everything fits, when the cache is
+already staged (a second job on the same node), and when the local disk only
+has room for part of it. Also checks that the staged dataset returns the same
+samples, and that a local copy modified after staging (resized, or corrupted
+in place) is copied again.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_staging --n_images 16 --stage_dir /tmp/local_scratch
+"""
+import os
+import json
+import shutil
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torchvision
+
+from data.data_loader import UnpairedDataset
+from data.staging import CacheStager
+from data.transforms import Normalize, ToTensor
+from benchmarks.synthetic import make_nrrd_cohort
+
+
+
+
+def main(args) :
+    image_dir = os.path.join(args.work_dir, "images")
+    cache_dir = os.path.join(args.work_dir, "cache")
+    df = make_nrrd_cohort(image_dir, args.n_images, size=[512, 512, 48])
+    x_df, y_df = df[df["has_artifact"] == "2"], df[df["has_artifact"] == "0"]
+    transform = torchvision.transforms.Compose([Normalize(-1000.0, 1000.0), ToTensor()])
+    kwargs = {"image_dir": image_dir, "cache_dir": cache_dir, "file_type": "nrrd",
+              "image_size": args.image_size, "cache_format": args.cache_format,
+              "transform": transform}
+    shared = UnpairedDataset(x_df, y_df, **kwargs)
+    shutil.rmtree(args.stage_dir, ignore_errors=True)
+    free = shutil.disk_usage(os.path.dirname(os.path.abspath(args.stage_dir))).free
+    if args.cache_format == "memmap" : # One file for all patients
+        entry_bytes = os.path.getsize(shared.store.data_path)
+    else :
+        entry_bytes = os.path.getsize(shared._cached_path(shared.x_ids[0]))
+
+    results = {"n_images": args.n_images, "cache_format": args.cache_format}
+    runs = [("cold", 2**30), ("warm", 2**30)]
+    if args.cache_format != "memmap" : # Room for half of the images only
+        runs.append(("partial", free - (args.n_images // 2) * entry_bytes))
+    for name, min_free_bytes in runs :
+        if name == "partial" :
+            shutil.rmtree(args.stage_dir, ignore_errors=True)
+        staged = UnpairedDataset(x_df, y_df, **kwargs, stage_dir=args.stage_dir,
+                                 stage_min_free_bytes=min_free_bytes)
+        results[name] = staged.staging_stats
+        np.random.seed(0)
+        a = [staged[k] for k in range(len(staged))]
+        np.random.seed(0)
+        b = [shared[k] for k in range(len(shared))]
+        results[name]["identical"] = all(torch.equal(u, v) for s, t in zip(a, b)
+                                         for u, v in zip(s, t))
+
+    # A local copy that changes after staging has a different size and is copied again
+    if args.cache_format != "memmap" :
+        stager = CacheStager(shared.cache_dir, os.path.join(args.work_dir, "corrupt"))
+        name = os.path.basename(shared._cached_path(shared.x_ids[0]))
+        stager.stage([name])
+        with open(os.path.join(stager.local_dir, name), "ab") as f :
+            f.write(b"\0")
+        paths = stager.stage([name])
+        results["modified_copy_replaced"] = (stager.stats["copied"] == 1 and
+                                              paths[name].startswith(stager.local_dir))
+        # Same size, so only hashing the reused copy finds it
+        with open(os.path.join(stager.local_dir, name), "r+b") as f :
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xFF]))
+        stager = CacheStager(shared.cache_dir, stager.local_dir) # The next job
+        paths = stager.stage([name])
+        results["corrupt_copy_replaced"] = (stager.stats["corrupt"] == 1 and
+                                             stager.stats["copied"] == 1 and
+                                             paths[name].startswith(stager.local_dir))
+
+    for name, _ in runs :
+        stats = results[name]
+        print(f"{name:>8}: {stats['seconds']:6.2f} s, {stats['copied']:3d} copied "
+              f"({stats['copied_bytes'] / 2**20:6.1f} MB), {stats['reused']:3d} reused, "
+              f"{stats['shared']:3d} shared, hit ratio {100 * stats['hit_ratio']:5.1f}%, "
+              f"same samples: {stats['identical']}")
+    if "modified_copy_replaced" in results :
+        print(f"Modified local copy replaced: {results['modified_copy_replaced']}, "
+              f"corrupted local copy replaced: {results['corrupt_copy_replaced']}")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=16)
+    parser.add_argument("--image_size", type=int, nargs=3, default=[16, 256, 256])
+    parser.add_argument("--cache_format", type=str, default="vol",
+                        choices=["nrrd", "vol", "memmap"])
+    parser.add_argument("--work_dir", type=str, default="/tmp/bench_staging")
+    parser.add_argument("--stage_dir", type=str, default="/tmp/bench_staging_local")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
@@ -0,0 +1,123 @@
+""" Measure the allocations of Normalize + ToTensor per sample, compared to
+the previous SimpleITK implementation (two intermediate images per domain,
+then GetArrayFromImage), and check that both give the same tensors.
+
+Two counters are reported per sample:
+- NumPy allocations, from tracemalloc (number of blocks and bytes).
+- Freshly touched memory, from the number of minor page faults. Large blocks
+  are always given their own pages (the dynamic mmap threshold of glibc is
+  disabled), so this also counts the buffers allocated by SimpleITK, which
+  tracemalloc does not see. Linux/glibc only.
+
+Run from the root of the repository:
+$ python -m benchmarks.bench_tensor_conversion --n_samples 50
+"""
+import time
+import json
+import ctypes
+import resource
+import tracemalloc
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import SimpleITK as sitk
+
+from data.transforms import Normalize, ToTensor
+from benchmarks.synthetic import make_ct_image
+
+PAGE_SIZE = resource.getpagesize()
+M_MMAP_THRESHOLD = -3
+
+
+
+
+def legacy_transform(image_xy) :
+    """Normalize and ToTensor as they were implemented with SimpleITK."""
+    clamp = sitk.ClampImageFilter()
+    clamp.SetLowerBound(-1000.0)
+    clamp.SetUpperBound(1000.0)
+    image_x, image_y = image_xy
+    image_x, image_y = clamp.Execute(image_x) / 1000.0, clamp.Execute(image_y) / 1000.0
+    X, Y = sitk.GetArrayFromImage(image_x), sitk.GetArrayFromImage(image_y)
+    return torch.from_numpy(X).unsqueeze(0).float(), torch.from_numpy(Y).unsqueeze(0).float()
+
+
+
+def numpy_transform(image_xy) :
+    return ToTensor()(Normalize(-1000.0, 1000.0)(image_xy))
+
+
+
+def measure(transform, pairs) -> dict :
+    """Return the time, NumPy allocations and touched bytes per sample."""
+    outputs = [transform(pair) for pair in pairs[:2]] # Warm up
+
+    n_faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    t0 = time.perf_counter()
+    outputs = []
+    for pair in pairs :
+        outputs.append(transform(pair))
+        del outputs[-1] # Like a DataLoader that hands the tensors on
+    elapsed = time.perf_counter() - t0
+    n_faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - n_faults
+
+    tracemalloc.start()
+    n_blocks, n_bytes = 0, 0
+    for pair in pairs :
+        before = tracemalloc.take_snapshot()
+        output = transform(pair)
+        stats = tracemalloc.take_snapshot().compare_to(before, "filename")
+        n_blocks += sum(max(s.count_diff, 0) for s in stats)
+        n_bytes += sum(max(s.size_diff, 0) for s in stats)
+        del output
+    tracemalloc.stop()
+
+    n = len(pairs)
+    return {"ms": 1000 * elapsed / n,
+            "numpy_blocks": n_blocks / n,
+            "numpy_mb": n_bytes / n / 2**20,
+            "touched_mb": n_faults * PAGE_SIZE / n / 2**20}
+
+
+
+def main(args) :
+    # Give every large allocation its own pages so that page faults count them
+    libc = ctypes.CDLL(None)
+    libc.mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+
+    pairs = []
+    for seed in range(args.n_samples) :
+        image, _ = make_ct_image(args.image_size[::-1], [1.0, 1.0, 2.0], seed=seed)
+        image = sitk.Cast(image, sitk.sitkFloat32)
+        pairs.append((image, image))
+
+    for (a_x, a_y), (b_x, b_y) in zip(map(legacy_transform, pairs), map(numpy_transform, pairs)) :
+        assert torch.equal(a_x, b_x) and torch.equal(a_y, b_y)
+    image_mb = 2 * sitk.GetArrayViewFromImage(pairs[0][0]).nbytes / 2**20
+    print(f"Outputs are identical. One pair of images is {image_mb:.1f} MB.")
+
+    results = {}
+    for name, transform in [("sitk", legacy_transform), ("numpy", numpy_transform)] :
+        results[name] = measure(transform, pairs)
+        r = results[name]
+        print(f"{name:>6}: {r['ms']:6.2f} ms/sample, NumPy {r['numpy_blocks']:.1f} blocks "
+              f"{r['numpy_mb']:.1f} MB/sample, touched {r['touched_mb']:.1f} MB/sample")
+
+    if args.out_path :
+        with open(args.out_path, "w") as f :
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--n_samples", type=int, default=50,
+                        help="Number of pairs of images to transform.")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[8, 256, 256],
+                        help="Size of the images [z, y, x].")
+    parser.add_argument("--out_path", type=str, default="",
+                        help="Optional path to a JSON file in which to save the results.")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
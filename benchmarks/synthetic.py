@@ -0,0 +1,170 @@
+""" Synthetic CT-like images for benchmarking the data pipeline without
+access to patient data.
+"""
+import os
+import zlib
+import numpy as np
+import pandas as pd
+from typing import Sequence, Tuple
+
+import SimpleITK as sitk
+
+
+
+
+def make_ct_image(size: Sequence[int] = [512, 512, 160],
+                  spacing: Sequence[float] = [0.98, 0.98, 2.0],
+                  seed: int = 0) -> Tuple[sitk.Image, int] :
+    """ Return a CT-like head and neck image (int16, HU) with a streak
+    artifact in one slice.
+
+    Parameters
+    ----------
+    size
+        The image size in voxels [x, y, z].
+    spacing
+        The voxel spacing in mm [x, y, z].
+    seed
+        Seed for the noise and the position of the head.
+
+    Returns
+    -------
+    Tuple[sitk.Image, int]
+        The image and the z-index of the artifact slice.
+    """
+    rng = np.random.RandomState(seed)
+    nx, ny, nz = size
+    z, y, x = np.ogrid[:nz, :ny, :nx]
+    cy, cx = ny / 2 + rng.randint(-20, 20), nx / 2 + rng.randint(-20, 20)
+    ry, rx = 0.35 * ny, 0.3 * nx
+
+    # Air, soft tissue and a ring of bone
+    r = ((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2
+    array = np.full((nz, ny, nx), -1000, dtype=np.int16)
+    array[np.broadcast_to(r < 1.0, array.shape)] = 40
+    array[np.broadcast_to((r > 0.85) & (r < 1.0), array.shape)] = 900
+    array += rng.normal(0, 20, array.shape).astype(np.int16)
+
+    # Streaks from a 'filling' in a single slice
+    a_slice = int(nz // 2 + rng.randint(-nz // 8, nz // 8 + 1))
+    angles = np.arctan2(y[0] - cy, x[0] - cx)
+    array[a_slice] += (800 * np.cos(8 * angles) * (r[0] < 1.0)).astype(np.int16)
+
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing([float(s) for s in spacing])
+    image.SetOrigin([-nx * spacing[0] / 2, -ny * spacing[1] / 2, -nz * spacing[2] / 2])
+    return image, a_slice
+
+
+
+def write_dicom_series(image: sitk.Image, directory: str, compress: bool = False) :
+    """ Write an image as a DICOM series with one file per axial slice.
+
+    Parameters
+    ----------
+    image
+        The image to write. It is cast to int16.
+    directory
+        The directory in which to write the slices. Created if needed.
+    compress
+        Whether to compress the pixel data of each slice.
+    """
+    os.makedirs(directory, exist_ok=True)
+    image = sitk.Cast(image, sitk.sitkInt16)
+    uid = "1.2.826.0.1.3680043.2.1125." + str(zlib.crc32(directory.encode()))
+    d = image.GetDirection()
+
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    writer.SetUseCompression(compress)
+    for i in range(image.GetDepth()) :
+        slice = image[:, :, i]
+        tags = {"0008|0060": "CT",
+                "0020|000d": uid,                                 # Study UID
+                "0020|000e": uid + ".1",                          # Series UID
+                "0008|0018": uid + f".1.{i}",                     # Instance UID
+                "0020|0013": str(i),                              # Instance number
+                "0020|0037": "\\".join(str(v) for v in (d[0], d[3], d[6], d[1], d[4], d[7])),
+                "0020|0032": "\\".join(str(v) for v in image.TransformIndexToPhysicalPoint((0, 0, i)))}
+        for tag, value in tags.items() :
+            slice.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(directory, f"{i:04d}.dcm"))
+        writer.Execute(slice)
+
+
+
+def _cohort_row(patient_id: str, seed: int, a_slice: int) -> dict :
+    return {"patient_id": patient_id, "a_slice": a_slice, "DA_z": a_slice,
+            "has_artifact": "2" if seed % 2 == 0 else "0"}
+
+
+
+def make_nrrd_cohort(directory: str, n_images: int,
+                     size: Sequence[int] = [512, 512, 160],
+                     spacing: Sequence[float] = [0.98, 0.98, 2.0]) -> pd.DataFrame :
+    """ Write a cohort of synthetic images as NRRD files and return a data
+    frame in the format expected by the datasets in data.data_loader.
+
+    Parameters
+    ----------
+    directory
+        The directory in which to write '<patient_id>.nrrd'. Existing files are
+        not rewritten.
+    n_images
+        The number of images. Half of them are labelled as having an artifact.
+    size, spacing
+        The image size in voxels and the voxel spacing in mm [x, y, z].
+
+    Returns
+    -------
+    pd.DataFrame
+        The DA slice and label of every image, indexed by patient ID.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rows = []
+    for seed in range(n_images) :
+        patient_id = f"synthetic_{seed:04d}"
+        path = os.path.join(directory, f"{patient_id}.nrrd")
+        image, a_slice = make_ct_image(size, spacing, seed=seed)
+        if not os.path.exists(path) :
+            sitk.WriteImage(image, path)
+        rows.append(_cohort_row(patient_id, seed, a_slice))
+    return pd.DataFrame(rows).set_index("patient_id")
+
+
+
+def make_dicom_cohort(directory: str, n_images: int,
+                      size: Sequence[int] = [512, 512, 160],
+                      spacing: Sequence[float] = [0.98, 0.98, 2.0],
+                      compress: bool = False) -> pd.DataFrame :
+    """ Write a cohort of synthetic images as DICOM series, laid out like the
+    patient directories read by the datasets with file_type="DICOM", and return
+    a data frame in the format expected by the datasets in data.data_loader.
+
+    Parameters
+    ----------
+    directory
+        The directory in which to write '<patient_id>/CT.DICOM/'. Existing
+        series are not rewritten.
+    n_images
+        The number of images. Half of them are labelled as having an artifact.
+    size, spacing
+        The image size in voxels and the voxel spacing in mm [x, y, z].
+    compress
+        Whether to compress the pixel data of each slice.
+
+    Returns
+    -------
+    pd.DataFrame
+        The DA slice and label of every image, indexed by patient ID.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rows = []
+    for seed in range(n_images) :
+        patient_id = f"synthetic_{seed:04d}"
+        series_dir = os.path.join(directory, patient_id, "CT.DICOM")
+        image, a_slice = make_ct_image(size, spacing, seed=seed)
+        if not os.path.exists(series_dir) :
+            write_dicom_series(image, series_dir, compress=compress)
+        rows.append(_cohort_row(patient_id, seed, a_slice))
+    return pd.DataFrame(rows).set_index("patient_id")
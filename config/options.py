@@ -11,10 +11,80 @@ parser = ArgumentParser()
 
 # Paths to data and logs
 parser.add_argument("--csv_path", type=str, default="",
-                    help="Path to the CSV containing all image DA statuses and DA locations")
+                    help="Path to the CSV containing all image DA statuses and DA locations, or \
+to a patient catalog (.parquet or .pkl, see data/catalog.py).")
+parser.add_argument("--cohort", type=str, default="train_labels",
+                    help="Cohort of the catalog used for training and validation. Ignored for CSVs.")
+parser.add_argument("--test_cohort", type=str, default="test_labels",
+                    help="Cohort of the catalog used for testing. Ignored for CSVs.")
 parser.add_argument("--img_dir", default=img_dir, type=str, help="Path to the input image data.")
 parser.add_argument("--log_dir", default=log_dir, type=str, help='Where to save results.')
 parser.add_argument("--cache_dir", default=cache, type=str, help="Where to cache images for training.")
+parser.add_argument("--cache_format", default="nrrd", type=str,
+                    help="How to store cached images. 'nrrd' (one file per image), 'vol' (one \
+compressed file per image) or 'memmap' (all images packed in one memory-mapped file).")
+parser.add_argument("--cache_codec", default="raw", type=str,
+                    help="Compression of cached images: 'raw', 'gzip', 'zstd' or 'lz4'. NRRD \
+caches only support 'raw' and 'gzip'.")
+parser.add_argument("--cache_codec_level", default=None, type=int,
+                    help="Compression level of the cache codec. Default depends on the codec.")
+parser.add_argument("--shared_cache_mb", default=0, type=int,
+                    help="Size in MB of the LRU cache of decoded images shared by all data \
+loader workers. 0 disables the cache.")
+parser.add_argument("--crop_first", action="store_true",
+                    help="When caching, resample only the cropped region of each image instead \
+of the whole image.")
+parser.add_argument("--cache_size", type=int, nargs=3, default=None,
+                    help="Size [z, y, x] of the slab cached around the DA, at least image_size. \
+Windows of image_size are taken from it, so the image size can change without re-caching.")
+parser.add_argument("--crop_jitter", type=int, nargs=3, default=None,
+                    help="Maximum random offset [z, y, x] in voxels of the training windows \
+from the centre of the cached slab. Validation windows are always centred.")
+parser.add_argument("--crops_per_read", type=int, default=1,
+                    help="Number of training pairs (windows and augmentations) made from each \
+read of the cached images. batch_size must be a multiple of it.")
+parser.add_argument("--slab_reads", action="store_true",
+                    help="When caching DICOM images, only decode the slices around the DA.")
+parser.add_argument("--decoded_cache", action="store_true",
+                    help="Keep every decoded DICOM image in the cache and make the crops of \
+each image size and spacing from it, so that changing them does not decode the series again.")
+parser.add_argument("--decoded_codec", default="lz4", type=str,
+                    help="Compression of the decoded images: 'raw', 'gzip', 'zstd' or 'lz4'.")
+parser.add_argument("--decoded_slab_mm", default=None, type=float,
+                    help="With --slab_reads, keep only a slab of this half-thickness in mm around \
+the DA in the decoded cache instead of the whole image.")
+parser.add_argument("--stage_dir", default=None, type=str,
+                    help="Node-local scratch directory (e.g. $SLURM_TMPDIR) to which the cached \
+images are copied at the start of the job. Images that don't fit are read from cache_dir.")
+parser.add_argument("--stage_min_free_gb", default=1.0, type=float,
+                    help="Space in GB to leave free in stage_dir.")
+parser.add_argument("--shard_dir", default=None, type=str,
+                    help="If given, pack the cached training images into large shard files in \
+this directory and stream them during training instead of reading one file per image.")
+parser.add_argument("--shard_codec", default="raw", type=str,
+                    help="Compression of the shards: 'raw', 'gzip', 'zstd' or 'lz4'.")
+parser.add_argument("--shuffle_buffer", default=64, type=int,
+                    help="Number of training images held in memory to shuffle the shard stream.")
+parser.add_argument("--batch_augment", action="store_true",
+                    help="Flip, rotate and translate whole training batches at once in the \
+data loader's collate function instead of each image with SimpleITK.")
+parser.add_argument("--bank_variants", default=0, type=int,
+                    help="If > 0, precompute this many flipped, rotated and translated variants \
+of every training image and sample from them instead of augmenting on the fly.")
+parser.add_argument("--bank_refresh_epochs", default=0, type=int,
+                    help="Regenerate some bank variants with new parameters in the background \
+every N epochs. 0 never refreshes the bank.")
+parser.add_argument("--bank_refresh_variants", default=2, type=int,
+                    help="Number of bank variants regenerated by each refresh.")
+parser.add_argument("--prefetch", action="store_true",
+                    help="Stage the next training batch on the device while the current step \
+runs, and report the time spent waiting for data.")
+parser.add_argument("--profile_every", default=0, type=int,
+                    help="If > 0, time each stage of the training data pipeline (reading, \
+transforms, collation) and plot the timings on tensorboard every N steps.")
+parser.add_argument("--shared_cache_compression", default=None, type=str,
+                    help="Compression used in the shared image cache. None or a \
+cache codec, e.g. 'lz4'.")
 
 ### Hyperparams for model training ###
 parser.add_argument("--batch_size", type=int, default=1, help="size of the batches")
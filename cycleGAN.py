@@ -30,13 +30,19 @@ import pytorch_lightning as pl
 
 from config.options import get_args
 
-from data.data_loader import load_image_data_frame, UnpairedDataset, PairedDataset
-from data.transforms import AffineTransform, ToTensor, Normalize, HorizontalFlip
+from data.data_loader import (load_image_data_frame, UnpairedDataset, PairedDataset,
+                              batch_loader, BatchCollate)
+from data.prefetch import DevicePrefetcher
+from data.shards import ShardedUnpairedDataset, write_shards, shards_match
+from data.catalog import PatientCatalog, is_catalog
+from data.transforms import (AffineTransform, ToTensor, Normalize, HorizontalFlip,
+                             BatchAffineTransform, compile_transform)
 
 from models.generators import UNet3D, ResNetK, UNet2D, UNet3D_3layer
 from models.discriminators import CNN_3D, PatchGAN_NLayer, CNNnLayer
 from util.helper_functions import set_requires_grad
 from util.loggers import TensorBoardCustom
+from util.profiling import StageProfiler
 
 from torch.optim.lr_scheduler import ReduceLROnPlateau, MultiStepLR
 
@@ -118,6 +124,8 @@ class GAN(pl.LightningModule) :
         self.lam = 10.0   # Coefficient for cycle consistency loss
         self.idt = 25.0   # Coefficient for identity loss
 
+        self.profiler = None # Data pipeline timings, see prepare_data
+
 
 
 
@@ -141,23 +149,47 @@ class GAN(pl.LightningModule) :
         # Get train and test data sets
         # Import CSV containing DA labels
         X_img, Y_img = self.hparams.img_domain_x, self.hparams.img_domain_y
-        test_csv = "/cluster/home/carrowsm/ArtifactNet/datasets/test_labels.csv"
+        if is_catalog(self.hparams.csv_path) : # All cohorts in one catalog
+            test_csv, test_cohort = self.hparams.csv_path, self.hparams.test_cohort
+        else :
+            test_csv = "/cluster/home/carrowsm/ArtifactNet/datasets/test_labels.csv"
+            test_cohort = None
 
         x_df_trg, x_df_val, y_df_trg, y_df_val = load_image_data_frame(
                                             self.hparams.csv_path, X_img, Y_img,
-                                            val_split=0.1) # Use 10% of data for val
+                                            val_split=0.1, # Use 10% of data for val
+                                            cohort=self.hparams.cohort)
         x_df_test, _, y_df_test, _ = load_image_data_frame(test_csv,
                                                            X_img, Y_img,
-                                                           val_split=0)
+                                                           val_split=0,
+                                                           cohort=test_cohort)
         # Define sequence of transforms
-        trg_transform = torchvision.transforms.Compose([
+        # Each chain is compiled into at most one resampling and one
+        # clamp-and-scale pass. The flip before the affine transform is
+        # folded into the resampling, so the training images match the
+        # chain run step by step within transforms.FLIP_TOLERANCE. The
+        # resampling dominates the training chain, which therefore costs
+        # about the same as step by step, the gain is on the val chain and
+        # in writing straight into the batch (see bench_fused_transforms)
+        trg_transform = compile_transform([
                     HorizontalFlip(),
                     AffineTransform(max_angle=30.0, max_pixels=[20, 20]),
                     Normalize(-1000.0, 1000.0),
                     ToTensor()])
-        val_transform = torchvision.transforms.Compose([
-                                                Normalize(-1000.0, 1000.0),
-                                                ToTensor()])
+        # Shared by the DataLoader workers, so created before they start
+        self.profiler = StageProfiler() if self.hparams.profile_every > 0 else None
+        self.trg_collate = None
+        if self.hparams.batch_augment :
+            # Augment and normalize whole batches in the collate function instead
+            trg_transform = compile_transform([ToTensor()])
+            self.trg_collate = BatchCollate([
+                    BatchAffineTransform(max_angle=30.0, max_pixels=[20, 20],
+                                         spacing=[1.0, 1.0]),
+                    Normalize(-1000.0, 1000.0)], profiler=self.profiler)
+        elif self.hparams.bank_variants > 0 :
+            # The flips, rotations and translations are precomputed in the bank
+            trg_transform = compile_transform([Normalize(-1000.0, 1000.0), ToTensor()])
+        val_transform = compile_transform([Normalize(-1000.0, 1000.0), ToTensor()])
         test_transform = val_transform
 
         # Train data loader
@@ -166,17 +198,51 @@ class GAN(pl.LightningModule) :
                                       cache_dir=os.path.join(self.hparams.cache_dir,
                                                              "unpaired"),
                                       file_type="DICOM",
+                                      cache_format=self.hparams.cache_format,
+                                      cache_codec=self.hparams.cache_codec,
+                                      cache_codec_level=self.hparams.cache_codec_level,
+                                      shared_cache_bytes=self.hparams.shared_cache_mb * 2**20,
+                                      shared_cache_compression=self.hparams.shared_cache_compression,
+                                      crop_first=self.hparams.crop_first,
+                                      slab_reads=self.hparams.slab_reads,
+                                      decoded_cache=self.hparams.decoded_cache,
+                                      decoded_codec=self.hparams.decoded_codec,
+                                      decoded_slab_mm=self.hparams.decoded_slab_mm,
+                                      stage_dir=self.hparams.stage_dir,
+                                      stage_min_free_bytes=int(self.hparams.stage_min_free_gb * 2**30),
                                       image_size=self.image_size,
+                                      cache_size=self.hparams.cache_size,
+                                      crop_jitter=self.hparams.crop_jitter,
+                                      crops_per_read=self.hparams.crops_per_read,
+                                      profiler=self.profiler,
                                       image_spacing=[2.0, 1.0, 1.0],
                                       dim=self.dimension,
                                       transform=trg_transform,
+                                      bank_variants=0 if self.hparams.batch_augment
+                                                    else self.hparams.bank_variants,
+                                      bank_spare=self.hparams.bank_refresh_variants,
+                                      bank_transform=AffineTransform(max_angle=30.0,
+                                                                     max_pixels=[20, 20]),
                                       num_workers=self.hparams.n_cpus)
         val_dataset = UnpairedDataset(x_df_val, y_df_val,
                                       image_dir=self.hparams.img_dir,
                                       cache_dir=os.path.join(self.hparams.cache_dir,
                                                              "unpaired"),
                                       file_type="DICOM",
+                                      cache_format=self.hparams.cache_format,
+                                      cache_codec=self.hparams.cache_codec,
+                                      cache_codec_level=self.hparams.cache_codec_level,
+                                      shared_cache_bytes=self.hparams.shared_cache_mb * 2**20,
+                                      shared_cache_compression=self.hparams.shared_cache_compression,
+                                      crop_first=self.hparams.crop_first,
+                                      slab_reads=self.hparams.slab_reads,
+                                      decoded_cache=self.hparams.decoded_cache,
+                                      decoded_codec=self.hparams.decoded_codec,
+                                      decoded_slab_mm=self.hparams.decoded_slab_mm,
+                                      stage_dir=self.hparams.stage_dir,
+                                      stage_min_free_bytes=int(self.hparams.stage_min_free_gb * 2**30),
                                       image_size=self.image_size,
+                                      cache_size=self.hparams.cache_size,
                                       image_spacing=[2.0, 1.0, 1.0],
                                       dim=self.dimension,
                                       transform=val_transform,
@@ -186,22 +252,62 @@ class GAN(pl.LightningModule) :
                                       cache_dir=os.path.join(self.hparams.cache_dir,
                                                              "unpaired"),
                                       file_type="DICOM",
+                                      cache_format=self.hparams.cache_format,
+                                      cache_codec=self.hparams.cache_codec,
+                                      cache_codec_level=self.hparams.cache_codec_level,
+                                      shared_cache_bytes=self.hparams.shared_cache_mb * 2**20,
+                                      shared_cache_compression=self.hparams.shared_cache_compression,
+                                      crop_first=self.hparams.crop_first,
+                                      slab_reads=self.hparams.slab_reads,
+                                      decoded_cache=self.hparams.decoded_cache,
+                                      decoded_codec=self.hparams.decoded_codec,
+                                      decoded_slab_mm=self.hparams.decoded_slab_mm,
+                                      stage_dir=self.hparams.stage_dir,
+                                      stage_min_free_bytes=int(self.hparams.stage_min_free_gb * 2**30),
                                       image_size=self.image_size,
+                                      cache_size=self.hparams.cache_size,
                                       image_spacing=[2.0, 1.0, 1.0],
                                       dim=self.dimension,
                                       transform=test_transform,
                                       num_workers=self.hparams.n_cpus)
 
+        # Stream the training images from a few large shards instead
+        self.trg_stream = None
+        if self.hparams.shard_dir is not None :
+            if trg_dataset.bank is not None or self.hparams.crops_per_read > 1 :
+                raise ValueError("--shard_dir can't be used with --bank_variants or "
+                                 "--crops_per_read.")
+            shard_dir = os.path.join(self.hparams.shard_dir,
+                                     os.path.basename(trg_dataset.cache_dir))
+            if not shards_match(shard_dir, trg_dataset) :
+                write_shards(trg_dataset, shard_dir, codec=self.hparams.shard_codec)
+            self.trg_stream = ShardedUnpairedDataset(shard_dir,
+                                                     image_size=self.image_size,
+                                                     crop_jitter=self.hparams.crop_jitter,
+                                                     dim=self.dimension,
+                                                     transform=trg_transform,
+                                                     shuffle_buffer=self.hparams.shuffle_buffer)
+
         self.trg_dataset = trg_dataset
         self.val_dataset = val_dataset
         self.test_dataset = test_dataset
 
         # If caching data for the first time, save the image centre coordinates
-        if trg_dataset.first_cache and val_dataset.first_cache :
-            df = pd.concat([trg_dataset.full_df, val_dataset.full_df])
-            df.to_csv(self.hparams.csv_path)
-        if test_dataset.first_cache :
-            test_dataset.full_df.to_csv(test_csv)
+        if is_catalog(self.hparams.csv_path) : # Only the centres of these patients
+            catalog = PatientCatalog(self.hparams.csv_path)
+            centres = ["img_center_x", "img_center_y", "img_center_z"]
+            if trg_dataset.first_cache and val_dataset.first_cache :
+                df = pd.concat([trg_dataset.full_df, val_dataset.full_df])
+                catalog.update(df, self.hparams.cohort, columns=centres)
+            if test_dataset.first_cache :
+                catalog.update(test_dataset.full_df, test_cohort, columns=centres)
+            catalog.save()
+        else :
+            if trg_dataset.first_cache and val_dataset.first_cache :
+                df = pd.concat([trg_dataset.full_df, val_dataset.full_df])
+                df.to_csv(self.hparams.csv_path)
+            if test_dataset.first_cache :
+                test_dataset.full_df.to_csv(test_csv)
 
 
 
@@ -213,14 +319,53 @@ class GAN(pl.LightningModule) :
         print(f"Validation: {len(self.val_dataset)}")
 
 
+    def on_epoch_end(self):
+        """ Print the shared image cache counters to help size the cache and
+        the time spent waiting for data, and refresh the augmentation bank in
+        the background if it is time to. """
+        if self.trg_dataset.shared_cache is not None :
+            print(f"Shared image cache: {self.trg_dataset.shared_cache.stats()}")
+        loader = self.trainer.train_dataloader
+        if isinstance(loader, DevicePrefetcher) and loader.n_batches > 0 :
+            stats = loader.stats()
+            print(f"Data wait: {stats['data_wait_s']:.1f} s of {stats['total_s']:.1f} s "
+                  f"({100 * stats['data_wait_fraction']:.1f}%) over {stats['batches']} batches")
+            self.logger.experiment.add_scalar("data/wait_fraction",
+                                              stats["data_wait_fraction"], self.current_epoch)
+            loader.reset_stats()
+        bank, every = self.trg_dataset.bank, self.hparams.bank_refresh_epochs
+        if bank is not None and every > 0 and (self.current_epoch + 1) % every == 0 :
+            bank.start_refresh(self.hparams.bank_refresh_variants)
+
+
+    def on_batch_end(self) :
+        """ Plot the data pipeline timings every profile_every steps """
+        step = self.trainer.global_step
+        if self.profiler is not None and step % self.hparams.profile_every == 0 :
+            self.logger.log_pipeline_stats(self.profiler.delta(), step)
+
+
     @pl.data_loader
     def train_dataloader(self):
-        data_loader = DataLoader(self.trg_dataset,
-                                 batch_size=self.hparams.batch_size,
-                                 shuffle=True,
-                                 num_workers=self.hparams.n_cpus - 1,
-                                 drop_last=True,
-                                 pin_memory=True)
+        if self.trg_stream is not None : # Shuffled by the stream itself
+            data_loader = DataLoader(self.trg_stream,
+                                     batch_size=self.hparams.batch_size,
+                                     num_workers=self.hparams.n_cpus - 1,
+                                     drop_last=True,
+                                     pin_memory=True,
+                                     collate_fn=self.trg_collate)
+        else :
+            data_loader = batch_loader(self.trg_dataset,
+                                       batch_size=self.hparams.batch_size,
+                                       shuffle=True,
+                                       num_workers=self.hparams.n_cpus - 1,
+                                       drop_last=True,
+                                       pin_memory=True,
+                                       collate_fn=self.trg_collate)
+        if self.hparams.prefetch :
+            # Copy the next batch to the GPU while the current step runs
+            data_loader = DevicePrefetcher(data_loader,
+                                           device=lambda : next(self.g_y.parameters()).device)
         self.dataset_size = len(self.trg_dataset)
         return data_loader
 
@@ -228,12 +373,12 @@ class GAN(pl.LightningModule) :
 
     @pl.data_loader
     def val_dataloader(self) :
-        data_loader = DataLoader(self.val_dataset,
-                                 batch_size=self.hparams.batch_size,
-                                 shuffle=False,
-                                 num_workers=self.hparams.n_cpus - 1,
-                                 drop_last=True,
-                                 pin_memory=True)
+        data_loader = batch_loader(self.val_dataset,
+                                   batch_size=self.hparams.batch_size,
+                                   shuffle=False,
+                                   num_workers=self.hparams.n_cpus - 1,
+                                   drop_last=True,
+                                   pin_memory=True)
         return data_loader
 
 
@@ -0,0 +1,436 @@
+import os
+import sys
+import json
+import zlib
+import multiprocessing as mp
+import numpy as np
+from typing import Callable, Dict, Iterable, Optional, Sequence
+
+import SimpleITK as sitk
+
+from data.preprocess_engine import run_preprocessing
+from data.transforms import AffineTransform
+
+
+# Settings shared by all tasks in a worker process
+_bank_config = {}
+
+def _init_bank_worker(config: dict) :
+    global _bank_config
+    _bank_config = config
+
+
+
+def _make_variants_task(payload) :
+    """Write the variants of one patient into the given groups of the bank."""
+    patient_id, groups = payload
+    bank = _bank_config["bank"]
+    image = _bank_config["read_image"](patient_id)
+    for group in groups :
+        bank.write(patient_id, group,
+                   make_variant(image, bank.get_group_params(patient_id, group), bank.affine))
+    return patient_id
+
+
+
+def make_variant(image: sitk.Image, params: Sequence[float],
+                 affine: AffineTransform) -> sitk.Image :
+    """ Flip, rotate and translate an image exactly like HorizontalFlip followed
+    by AffineTransform would with the given parameters.
+
+    Parameters
+    ----------
+    image
+        The image to transform.
+    params
+        The (flip, angle, x translation, y translation) of the variant. The
+        angle is in radians and the translation in mm.
+    affine
+        The AffineTransform giving the fill value.
+    """
+    flip, angle, tx, ty = params
+    if flip :
+        image = sitk.Flip(image, [True, False, False])
+    transform = affine.get_transform(image, float(angle), np.array([tx, ty]))
+    return sitk.Resample(image, image, transform, sitk.sitkLinear, affine.fill_value)
+
+
+
+
+class AugmentationBank :
+    """Precomputed randomly flipped, rotated and translated variants of every
+    cached image.
+
+    Resampling each image with a random affine transform often dominates the
+    data loading time on CPU-only runs. The bank instead stores `n_variants`
+    augmented copies of every image in a memory-mapped file, and the dataset
+    picks one at random for each sample.
+
+    Every variant of every patient has its own flip, rotation and translation,
+    drawn from a random generator seeded with the bank's seed, the draw
+    number of the variant's slot group and the patient's key. Patients that
+    share a key (e.g. both images of a pair, see `build`) get the same
+    parameters, so a sample of a paired dataset is transformed together. The
+    draw number of each group is recorded, so the bank can be replayed
+    exactly.
+
+    To keep the augmentations diverse, `start_refresh` regenerates some of
+    the variants with new parameters in a background process while training
+    goes on. The new variants are written to spare slot groups that no reader
+    uses. Each variant is then switched to its new group in a small
+    memory-mapped table that every process reads, and the old group becomes
+    spare. A refresh is only recorded in the history once all of its variants
+    are written and switched.
+    """
+    def __init__(self, root: str,
+                 shape: Sequence[int],
+                 n_variants: int = 8,
+                 n_spare: int = 2,
+                 affine: Optional[AffineTransform] = None,
+                 flip: bool = True,
+                 seed: int = 0) :
+        """ Initialize the bank.
+
+        Parameters
+        ----------
+        root : str
+            The directory containing the bank files.
+        shape : Sequence[int]
+            The shape of every image in numpy (z, y, x) order.
+        n_variants : int
+            The number of variants of every image used for training.
+        n_spare : int
+            The number of spare slot groups, i.e. the maximum number of
+            variants regenerated by one refresh. Disk usage is proportional to
+            n_variants + n_spare.
+        affine : AffineTransform
+            The transform giving the range of the random rotations and
+            translations and the fill value. If None, AffineTransform(30.0,
+            [20, 20]) is used.
+        flip : bool
+            Whether half of the variants are also flipped about the vertical axis.
+        seed : int
+            The seed of the parameters of the variants.
+        """
+        self.root = root
+        self.shape = tuple(int(s) for s in shape)
+        self.n_variants = int(n_variants)
+        self.n_groups = self.n_variants + int(n_spare)
+        self.affine = affine if affine is not None else AffineTransform(30.0, [20, 20])
+        self.flip = flip
+        self.seed = int(seed)
+        self.slot_size = int(np.prod(self.shape))
+
+        self.data_path   = os.path.join(root, "bank.dat")
+        self.params_path = os.path.join(root, "bank.params")
+        self.map_path    = os.path.join(root, "bank.map")
+        self.index_path  = os.path.join(root, "bank.json")
+
+        self.patients = {} # patient_id -> position in the bank
+        self.keys = {}     # patient_id -> key of its parameters, if not its ID
+        self.valid = set() # Patients whose variants are all written
+        self.refresh_count, self.next_variant, self.history = 0, 0, []
+        self._data, self._params, self._map = None, None, None # Opened lazily in each process
+        self._process, self._read_image, self._pending = None, None, None
+
+        if os.path.exists(self.index_path) :
+            self._load_index()
+
+
+    def _config(self) -> Dict :
+        return {"shape": list(self.shape),
+                "n_variants": self.n_variants,
+                "n_groups": self.n_groups,
+                "max_angle": self.affine.max_angle,
+                "max_pixels": [float(p) for p in self.affine.max_pixels],
+                "fill_value": self.affine.fill_value,
+                "flip": self.flip,
+                "seed": self.seed,
+                "params": "per_patient"}
+
+
+    def _load_index(self) :
+        with open(self.index_path, "r") as f :
+            index = json.load(f)
+        if index["config"] != json.loads(json.dumps(self._config())) :
+            print(f"Augmentation bank {self.root} was made with {index['config']}, "
+                  f"expected {self._config()}. It will be rebuilt.")
+            self.reset()
+            return
+        self.patients = {str(k): int(v) for k, v in index["patients"].items()}
+        self.keys = index["keys"]
+        self.valid = set(index["valid"])
+        self.refresh_count = index["refresh_count"]
+        self.next_variant = index["next_variant"]
+        self.history = index["history"]
+
+
+    def save_index(self) :
+        """Atomically write the index to disk."""
+        index = {"config": self._config(),
+                 "patients": self.patients,
+                 "keys": self.keys,
+                 "valid": sorted(self.valid),
+                 "refresh_count": self.refresh_count,
+                 "next_variant": self.next_variant,
+                 "history": self.history}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f :
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+
+    def reset(self) :
+        """Remove every variant from the bank."""
+        for path in [self.data_path, self.params_path, self.map_path, self.index_path] :
+            if os.path.exists(path) :
+                os.remove(path)
+        self.patients, self.keys, self.valid = {}, {}, set()
+        self.refresh_count, self.next_variant, self.history = 0, 0, []
+        self._close()
+
+
+    def _open(self, mode: str = "r") :
+        n_patients = max(len(self.patients), 1)
+        self._data = np.memmap(self.data_path, dtype=np.float32, mode=mode,
+                               shape=(n_patients, self.n_groups) + self.shape)
+        self._params = np.memmap(self.params_path, dtype=np.int64, mode=mode,
+                                 shape=(self.n_groups,)) # Draw number of each group
+        self._map = np.memmap(self.map_path, dtype=np.int64, mode=mode,
+                              shape=(self.n_variants,))
+        self._mode = mode
+
+
+    def _close(self) :
+        self._data, self._params, self._map = None, None, None
+
+
+    @staticmethod
+    def _resize(path: str, nbytes: int) :
+        mode = "r+b" if os.path.exists(path) else "w+b"
+        with open(path, mode) as f :
+            f.seek(0, os.SEEK_END)
+            if f.tell() < nbytes : # Only ever grow the file
+                f.truncate(nbytes)
+
+
+    def _draw_params(self, key: str, draw: int) -> np.ndarray :
+        """Draw the parameters of a variant of the patients with a given key."""
+        rng = np.random.RandomState([self.seed, draw, zlib.crc32(key.encode())])
+        params = np.zeros(4) # flip, angle, x translation, y translation
+        if self.flip :
+            params[0] = rng.random_sample() > 0.5
+        params[1] = rng.uniform(-self.affine.max_angle, self.affine.max_angle)
+        for axis in range(2) :
+            max_pixel = self.affine.max_pixels[axis]
+            params[2 + axis] = rng.uniform(-max_pixel, max_pixel)
+        return params
+
+
+    def _set_group_params(self, variants: Sequence[int], groups: Sequence[int]) -> list :
+        """Give new parameters to the variants of some groups with a new draw
+        number. Return the history entries, to be recorded once the variants
+        are written and in use."""
+        self._params[list(groups)] = self.refresh_count
+        self._params.flush()
+        entries = [{"refresh": self.refresh_count, "variant": int(variant), "group": int(group)}
+                   for variant, group in zip(variants, groups)]
+        self.refresh_count += 1
+        return entries
+
+
+    def build(self, patient_ids: Iterable[str], read_image: Callable,
+              stale_ids: Iterable[str] = (), num_workers: int = 1,
+              keys: Optional[Dict[str, str]] = None) :
+        """ Make the variants of every patient that is missing from the bank
+        or whose cached image changed. Must be called in the main process.
+
+        Parameters
+        ----------
+        patient_ids : Iterable[str]
+            The patients of the dataset.
+        read_image : Callable
+            Called as read_image(patient_id) to load a cached image.
+        stale_ids : Iterable[str]
+            Patients whose cached image was rebuilt since the bank was made.
+        num_workers : int
+            The number of parallel processes used to make the variants.
+        keys : Dict[str, str]
+            The key of the parameters of some patients. Patients with the same
+            key get the same parameters, e.g. both images of a pair. The other
+            patients get their own.
+        """
+        self.wait_refresh()
+        self._read_image = read_image
+        os.makedirs(self.root, exist_ok=True)
+        patient_ids = [str(id) for id in patient_ids]
+        self.valid -= set(str(id) for id in stale_ids)
+        keys = {str(k): str(v) for k, v in (keys or {}).items()}
+        for patient_id in patient_ids :
+            key = keys.get(patient_id, patient_id)
+            if self.keys.get(patient_id, patient_id) != key : # New parameters, new variants
+                self.valid.discard(patient_id)
+            if key == patient_id :
+                self.keys.pop(patient_id, None)
+            else :
+                self.keys[patient_id] = key
+        for patient_id in patient_ids :
+            if patient_id not in self.patients :
+                self.patients[patient_id] = len(self.patients)
+
+        n_patients = len(self.patients)
+        new = not os.path.exists(self.map_path)
+        self._resize(self.data_path, n_patients * self.n_groups * self.slot_size * 4)
+        self._resize(self.params_path, self.n_groups * 8) # One draw number per group
+        self._resize(self.map_path, self.n_variants * 8)
+        self._open(mode="r+")
+        entries = []
+        if new : # Initial variants in the first groups, the others are spare
+            self._map[:] = np.arange(self.n_variants)
+            self._map.flush()
+            entries = self._set_group_params(range(self.n_variants), range(self.n_variants))
+
+        missing = [id for id in patient_ids if id not in self.valid]
+        if len(missing) > 0 :
+            print(f"Making {self.n_variants} augmented variants of {len(missing)} images.")
+            groups = [int(g) for g in self._map]
+            run_preprocessing(_make_variants_task, [(id, (id, groups)) for id in missing],
+                              num_workers=num_workers,
+                              initializer=_init_bank_worker,
+                              initargs=({"bank": self, "read_image": read_image},),
+                              on_result=lambda key, result : self.valid.add(key),
+                              checkpoint=self.save_index)
+        self.history += entries
+        self._close()
+        self.save_index()
+
+
+    def write(self, patient_id: str, group: int, image: sitk.Image) :
+        """Write a variant into its slot. Safe to call from several worker
+        processes at once."""
+        if self._data is None or self._mode != "r+" :
+            self._open(mode="r+")
+        self._data[self.patients[str(patient_id)], group] = sitk.GetArrayViewFromImage(image)
+        self._data.flush()
+
+
+    def sample_variant(self) -> int :
+        """Return a random variant index."""
+        return np.random.randint(self.n_variants)
+
+
+    def get_group_params(self, patient_id: str, group: int) -> np.ndarray :
+        """Return the parameters of a patient's variant in a slot group."""
+        if self._params is None :
+            self._open()
+        patient_id = str(patient_id)
+        return self._draw_params(self.keys.get(patient_id, patient_id), int(self._params[group]))
+
+
+    def get_params(self, patient_id: str, variant: int) -> Dict[str, float] :
+        """Return the flip, angle (radians) and translation (mm) of a variant
+        of a patient's image."""
+        if self._map is None :
+            self._open()
+        flip, angle, tx, ty = self.get_group_params(patient_id, int(self._map[variant]))
+        return {"flip": bool(flip), "angle": angle, "translation": [tx, ty]}
+
+
+    def get_array(self, patient_id: str, variant: int) -> np.ndarray :
+        """Return a read-only view of a variant of a patient's image, (z, y, x)."""
+        if self._data is None :
+            self._open()
+        return self._data[self.patients[str(patient_id)], int(self._map[variant])]
+
+
+    def start_refresh(self, n_variants: Optional[int] = None, read_image: Optional[Callable] = None,
+                      num_workers: int = 1) -> bool :
+        """ Start regenerating the oldest variants with new parameters in a
+        background process. Training can go on meanwhile: readers keep using
+        the old variants until the new ones are complete.
+
+        Parameters
+        ----------
+        n_variants : int
+            The number of variants to regenerate, at most the number of spare
+            groups. If None, regenerate as many as there are spare groups.
+        read_image : Callable
+            Called as read_image(patient_id) to load a cached image. If None,
+            the reader given to `build` is used.
+        num_workers : int
+            The number of processes used to make the variants.
+
+        Returns
+        -------
+        bool
+            Whether a refresh was started. It is not if the previous one is
+            still running.
+        """
+        if self._process is not None and self._process.is_alive() :
+            print("The previous refresh of the augmentation bank is still running.")
+            return False
+        self.wait_refresh()
+
+        n_spare = self.n_groups - self.n_variants
+        n = n_spare if n_variants is None else min(n_variants, n_spare)
+        if n <= 0 :
+            return False
+        self._open(mode="r+")
+        spare = sorted(set(range(self.n_groups)) - set(int(g) for g in self._map))[:n]
+        variants = [(self.next_variant + i) % self.n_variants for i in range(n)]
+        self._pending = self._set_group_params(variants, spare)
+        self._close()
+        self.save_index() # Keep the draw numbers unique if the job restarts
+        if read_image is None :
+            read_image = self._read_image
+
+        # Fork so that the reader does not need to be pickled
+        context = mp.get_context("fork")
+        self._process = context.Process(target=self._refresh,
+                                        args=(variants, spare, read_image, num_workers))
+        self._process.start()
+        return True
+
+
+    def _refresh(self, variants: Sequence[int], groups: Sequence[int],
+                 read_image: Callable, num_workers: int) :
+        """Make the new variants, then switch to them (background process)."""
+        tasks = [(id, (id, list(groups))) for id in self.patients]
+        errors = run_preprocessing(_make_variants_task, tasks,
+                                   num_workers=num_workers,
+                                   initializer=_init_bank_worker,
+                                   initargs=({"bank": self, "read_image": read_image},),
+                                   report_every=600.0)
+        if len(errors) > 0 : # Keep the old variants
+            sys.exit(1)
+        self._open(mode="r+")
+        for variant, group in zip(variants, groups) :
+            self._map[variant] = group # A single aligned 8 byte write
+        self._map.flush()
+
+
+    def wait_refresh(self) :
+        """Wait for the background refresh to finish, if one is running, and
+        record it in the history if it succeeded."""
+        if self._process is None :
+            return
+        self._process.join()
+        if self._process.exitcode == 0 :
+            self.history += self._pending
+            self.next_variant = (self.next_variant + len(self._pending)) % self.n_variants
+        else :
+            print("The refresh of the augmentation bank failed, the old variants are kept.")
+        self._process, self._pending = None, None
+        self.save_index()
+
+
+    def __len__(self) :
+        return len(self.patients)
+
+
+    def __getstate__(self) :
+        # Memory maps and processes can't be pickled; each process reopens the maps
+        state = self.__dict__.copy()
+        state["_data"], state["_params"], state["_map"] = None, None, None
+        state["_process"], state["_read_image"], state["_pending"] = None, None, None
+        return state
@@ -0,0 +1,138 @@
+import os
+import json
+import numpy as np
+from typing import Dict, Optional, Sequence
+
+
+# Increment this whenever a change to the preprocessing would change the
+# contents of the cached images. Every entry written by an older version is
+# then treated as stale and rebuilt.
+CACHE_VERSION = 1
+
+
+
+
+def cache_config_name(image_size: Sequence[int], image_spacing: Sequence[float]) -> str :
+    """ Return the name of the cache subdirectory used for one image size and
+    spacing configuration, e.g. '8x256x256_2.0x1.0x1.0'. Both are expected in
+    (z, y, x) order.
+    """
+    size    = "x".join(str(int(s)) for s in image_size)
+    spacing = "x".join(str(float(s)) for s in image_spacing)
+    return f"{size}_{spacing}"
+
+
+
+def source_signature(path: str) -> Dict :
+    """ Return the modification time and size of a raw image. If path is a
+    directory (a DICOM series), the latest modification time and the total size
+    of all files below it are used, so adding, removing or rewriting any slice
+    changes the signature.
+    """
+    if os.path.isdir(path) :
+        mtime, size = os.stat(path).st_mtime, 0
+        for root, dirs, files in os.walk(path) :
+            for name in files :
+                stat = os.stat(os.path.join(root, name))
+                mtime, size = max(mtime, stat.st_mtime), size + stat.st_size
+    else :
+        stat = os.stat(path)
+        mtime, size = stat.st_mtime, stat.st_size
+    return {"source_mtime": mtime, "source_size": size}
+
+
+
+
+class CacheManifest :
+    """Record of how every entry of a preprocessed image cache was made.
+
+    For each cached patient the manifest stores the path and signature
+    (modification time and size) of the raw image it was made from, the image
+    size and spacing, the DA slice the crop was centred on, how the crop was
+    made (crop_first, slab_reads), the centre of the crop in physical
+    coordinates and the version of the preprocessing code. An entry is only
+    considered fresh if all of these still match, which lets the dataset
+    rebuild just the stale or missing patients instead of the whole cache.
+    """
+    def __init__(self, path: str,
+                 image_size: Sequence[int],
+                 image_spacing: Sequence[float]) :
+        """ Initialize the manifest.
+
+        Parameters
+        ----------
+        path : str
+            Path to the manifest JSON file. It is created on the first save.
+        image_size : Sequence[int]
+            The size of the cached images (z, y, x).
+        image_spacing : Sequence[float]
+            The voxel spacing of the cached images (z, y, x).
+        """
+        self.path = path
+        self.image_size = [int(s) for s in image_size]
+        self.image_spacing = [float(s) for s in image_spacing]
+        self.entries = {}
+
+        if os.path.exists(self.path) :
+            with open(self.path, "r") as f :
+                self.entries = json.load(f)["entries"]
+
+
+    def is_fresh(self, patient_id: str, source_path: str, signature: Dict,
+                 da_idx: int = -1, crop_first: bool = False, slab_reads: bool = False,
+                 cache_format: str = "nrrd", cache_codec: str = "raw") -> bool :
+        """Whether the cached entry of a patient is up to date. Entries written
+        before the DA slice, crop settings and cache format were recorded are
+        stale."""
+        entry = self.entries.get(str(patient_id))
+        if entry is None :
+            return False
+        return (entry["version"] == CACHE_VERSION and
+                entry["source"] == source_path and
+                entry["source_mtime"] == signature["source_mtime"] and
+                entry["source_size"] == signature["source_size"] and
+                entry["image_size"] == self.image_size and
+                np.allclose(entry["image_spacing"], self.image_spacing) and
+                entry.get("da_idx") == int(da_idx) and
+                entry.get("crop_first") == bool(crop_first) and
+                entry.get("slab_reads") == bool(slab_reads) and
+                entry.get("cache_format") == cache_format and
+                entry.get("cache_codec") == cache_codec)
+
+
+    def update(self, patient_id: str, source_path: str, signature: Dict,
+               centre: Sequence[float], da_idx: int = -1,
+               crop_first: bool = False, slab_reads: bool = False,
+               cache_format: str = "nrrd", cache_codec: str = "raw") :
+        """Record a freshly cached entry."""
+        self.entries[str(patient_id)] = {"source": source_path,
+                                         "source_mtime": signature["source_mtime"],
+                                         "source_size": signature["source_size"],
+                                         "image_size": self.image_size,
+                                         "image_spacing": self.image_spacing,
+                                         "da_idx": int(da_idx),
+                                         "crop_first": bool(crop_first),
+                                         "slab_reads": bool(slab_reads),
+                                         "cache_format": cache_format,
+                                         "cache_codec": cache_codec,
+                                         "centre": [float(c) for c in centre],
+                                         "version": CACHE_VERSION}
+
+
+    def remove(self, patient_id: str) :
+        self.entries.pop(str(patient_id), None)
+
+
+    def centre(self, patient_id: str) -> Optional[Sequence[float]] :
+        """Return the physical (x, y, z) crop centre of a cached patient."""
+        entry = self.entries.get(str(patient_id))
+        return None if entry is None else entry["centre"]
+
+
+    def save(self) :
+        """Atomically write the manifest to disk."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f :
+            json.dump({"version": CACHE_VERSION, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
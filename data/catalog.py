@@ -0,0 +1,296 @@
+""" A typed patient catalog merging the label CSVs of every cohort.
+
+Build it once from the CSVs in datasets/:
+$ python -m data.catalog --csv_dir datasets --out_path datasets/catalog.pkl
+
+Parquet catalogs (.parquet) are also supported, but need the optional
+pyarrow package, which is not in environment.yml.
+"""
+import os
+import time
+import warnings
+from argparse import ArgumentParser
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+try :
+    import pyarrow
+except ImportError :
+    pyarrow = None
+
+
+# The type of every known column. Other columns are kept as strings.
+SCHEMA = {"patient_id": str,
+          "has_artifact": str,      # DA label, '0' (none), '1' (weak), '2' (strong)
+          "p_index": "Int32",
+          "a_slice": "Int32",
+          "DA_z": "Int32",
+          "img_center_x": np.float64,
+          "img_center_y": np.float64,
+          "img_center_z": np.float64,
+          "MRN": str}
+
+# The label CSVs in datasets/ merged by default, one cohort each
+COHORTS = ["train_labels", "test_labels", "gtv_segment_imgs", "oar_segment_imgs",
+           "radcure_challenge_test", "phantoms"]
+
+FORMATS = {".parquet": "parquet", ".pkl": "pickle"}
+
+
+
+
+def check_format(path: str) -> str :
+    """Return the storage format of a catalog path, from its extension, and
+    raise an error if it is unknown or its package is not installed."""
+    ext = os.path.splitext(path)[1]
+    if ext not in FORMATS :
+        raise ValueError(f"Catalog extension {ext} not accepted. Use one of {list(FORMATS)}.")
+    if FORMATS[ext] == "parquet" and pyarrow is None :
+        raise ImportError("Parquet catalogs require the pyarrow package. Use a .pkl path.")
+    return FORMATS[ext]
+
+
+
+def is_catalog(path: str) -> bool :
+    """Whether a path is a catalog rather than a CSV."""
+    return os.path.splitext(path)[1] in FORMATS
+
+
+
+def read_label_csv(path: str) -> pd.DataFrame :
+    """ Read a label CSV with the columns of SCHEMA cast to their types,
+    indexed by patient ID (a string, e.g. '3722150', never a number).
+    """
+    df = pd.read_csv(path, dtype=str, na_values=['nan', 'NaN', ''])
+    df = df.loc[:, [c for c in df.columns if not c.startswith("Unnamed")]]
+    for column, dtype in SCHEMA.items() :
+        if column in df.columns and dtype is not str :
+            df[column] = pd.to_numeric(df[column]).astype(dtype)
+    return df.set_index("patient_id")
+
+
+
+def _index(column: pd.Series) -> Dict[str, np.ndarray] :
+    """Return the rows of every value of a column."""
+    codes, values = pd.factorize(column, sort=False)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+    return {str(v): order[bounds[i] : bounds[i + 1]] for i, v in enumerate(values)}
+
+
+
+
+class PatientCatalog :
+    """Labels and metadata of the patients of every cohort in one typed table.
+
+    Each row is one patient of one cohort (a patient can be in several
+    cohorts, e.g. train_labels and gtv_segment_imgs), with the cohort stored as
+    a categorical column. The table is kept in a columnar file (Parquet if
+    pyarrow is installed, otherwise a pickled data frame), so loading it does
+    not parse any text and every column already has its type.
+
+    Lookups by patient ID and by DA label use indices built when the catalog
+    is loaded, and return data frames indexed by patient ID like
+    load_image_data_frame. Metadata updates (e.g. the image centres found
+    while caching) change only the given patients and columns, and are
+    written atomically by `save`.
+    """
+    def __init__(self, path: str, table: Optional[pd.DataFrame] = None) :
+        """ Initialize the catalog.
+
+        Parameters
+        ----------
+        path : str
+            Path to the catalog file (.parquet or .pkl).
+        table : pd.DataFrame
+            The rows of the catalog, with 'cohort' and 'patient_id' columns. If
+            None, the catalog is read from path.
+        """
+        self.path = path
+        self.format = check_format(path)
+        if table is None :
+            if self.format == "parquet" :
+                table = pd.read_parquet(path)
+            else :
+                table = pd.read_pickle(path)
+        self._set_table(table)
+
+
+    @classmethod
+    def from_csvs(cls, csv_paths: Dict[str, str], path: str) -> "PatientCatalog" :
+        """ Merge label CSVs into a new catalog and save it.
+
+        Parameters
+        ----------
+        csv_paths : Dict[str, str]
+            The path of the CSV of every cohort, by cohort name. CSVs without
+            patient_id and has_artifact columns are skipped with a warning.
+        path : str
+            Path of the catalog file to write.
+        """
+        tables = []
+        for cohort, csv_path in csv_paths.items() :
+            df = read_label_csv(csv_path)
+            if "has_artifact" not in df.columns :
+                warnings.warn(f"Skipping {csv_path}, which has no DA labels.")
+                continue
+            tables.append(df.reset_index().assign(cohort=cohort))
+        table = pd.concat(tables, ignore_index=True, sort=False)
+        catalog = cls(path, table=table)
+        catalog.save()
+        return catalog
+
+
+    def _set_table(self, table: pd.DataFrame) :
+        table = table.reset_index(drop=True)
+        table["cohort"] = table["cohort"].astype("category")
+        self.table = table
+        self._rows = _index(table["patient_id"])
+        self._cohorts = _index(table["cohort"])
+        self._labels = _index(table["has_artifact"])
+
+
+    @property
+    def cohorts(self) -> list :
+        return list(self._cohorts)
+
+
+    def _frame(self, rows: np.ndarray, with_cohort: bool = False) -> pd.DataFrame :
+        df = self.table.iloc[np.sort(rows)]
+        if not with_cohort :
+            df = df.drop(columns="cohort")
+        return df.set_index("patient_id")
+
+
+    def _select(self, rows: np.ndarray, cohort: Optional[str]) -> np.ndarray :
+        if cohort is None :
+            return rows
+        if cohort not in self._cohorts :
+            raise KeyError(f"Unknown cohort {cohort}. The catalog has {self.cohorts}.")
+        return np.intersect1d(rows, self._cohorts[cohort], assume_unique=True)
+
+
+    def cohort(self, cohort: str) -> pd.DataFrame :
+        """Return the patients of a cohort, indexed by patient ID."""
+        return self._frame(self._select(np.arange(len(self.table)), cohort))
+
+
+    def lookup(self, patient_ids: Sequence[str], cohort: Optional[str] = None) -> pd.DataFrame :
+        """ Return the rows of some patients, indexed by patient ID. Without a
+        cohort, a patient in several cohorts has one row per cohort and the
+        'cohort' column is kept.
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([empty] + [self._rows.get(str(id), empty) for id in patient_ids])
+        rows = np.unique(rows)
+        return self._frame(self._select(rows, cohort), with_cohort=cohort is None)
+
+
+    def domain(self, labels: Sequence[str], cohort: Optional[str] = None) -> pd.DataFrame :
+        """Return the patients with one of the given DA labels (e.g. ['1', '2']
+        for DA+), indexed by patient ID."""
+        empty = np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([empty] + [self._labels.get(str(l), empty) for l in labels])
+        return self._frame(self._select(rows, cohort), with_cohort=cohort is None)
+
+
+    def split(self, cohort: str, img_X: Sequence[str], img_Y: Sequence[str],
+              label_col: str = "has_artifact", val_split: float = 0.1,
+              seed: Optional[int] = None) -> Tuple[pd.DataFrame, ...] :
+        """ Split a cohort into training and validation sets stratified by DA
+        label, and each of them into domains X and Y. Same as
+        load_image_data_frame.
+
+        Returns
+        -------
+        split data: Tuple, length = 4
+            The X-domain and Y-domain data for the train and validation sets.
+        """
+        df = self.cohort(cohort)
+        if val_split == 0 :
+            trg_df, val_df = df, df.iloc[:0]
+        else :
+            trg_df, val_df = train_test_split(df, test_size=val_split, random_state=seed,
+                                              stratify=df[label_col].values)
+        return (trg_df[trg_df[label_col].isin(img_X)], val_df[val_df[label_col].isin(img_X)],
+                trg_df[trg_df[label_col].isin(img_Y)], val_df[val_df[label_col].isin(img_Y)])
+
+
+    def update(self, df: pd.DataFrame, cohort: str, columns: Optional[Sequence[str]] = None) :
+        """ Set metadata of some patients of a cohort in memory. Call `save` to
+        write it.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            The new values, indexed by patient ID. Patients that are not in the
+            cohort are ignored.
+        cohort : str
+            The cohort of the patients.
+        columns : Sequence[str]
+            The columns to set, e.g. ['img_center_x', 'img_center_y',
+            'img_center_z']. New columns are added. If None, all columns of df.
+        """
+        columns = list(df.columns) if columns is None else list(columns)
+        rows = self._select(np.arange(len(self.table)), cohort)
+        ids = self.table["patient_id"].values[rows]
+        df = df[~df.index.duplicated(keep="last")]
+        found = pd.Index(df.index.astype(str)).get_indexer(ids)
+        rows, found = rows[found >= 0], found[found >= 0]
+        for column in columns :
+            values = df[column].values[found]
+            if column not in self.table.columns :
+                self.table[column] = pd.Series([None] * len(self.table), dtype=object)
+            dtype = SCHEMA.get(column)
+            if dtype is not None and dtype is not str :
+                values = pd.array(values).astype(dtype)
+            self.table.loc[rows, column] = values
+
+
+    def save(self) :
+        """Atomically write the catalog to disk."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp" + os.path.splitext(self.path)[1]
+        if self.format == "parquet" :
+            self.table.to_parquet(tmp_path, index=False)
+        else :
+            self.table.to_pickle(tmp_path)
+        os.replace(tmp_path, self.path)
+
+
+    def __len__(self) :
+        return len(self.table)
+
+
+    def __contains__(self, patient_id) :
+        return str(patient_id) in self._rows
+
+
+    def __repr__(self) :
+        return f"{self.__class__.__name__}({self.path}, {len(self)} rows, cohorts={self.cohorts})"
+
+
+
+
+def main(args) :
+    csv_paths = {c: os.path.join(args.csv_dir, f"{c}.csv") for c in args.cohorts}
+    t0 = time.perf_counter()
+    catalog = PatientCatalog.from_csvs(csv_paths, args.out_path)
+    print(f"Wrote {catalog} in {time.perf_counter() - t0:.2f} s")
+
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--csv_dir", type=str, default="datasets",
+                        help="Directory containing the label CSV of every cohort.")
+    parser.add_argument("--cohorts", type=str, nargs="+", default=COHORTS,
+                        help="Names of the CSVs to merge, without '.csv'.")
+    parser.add_argument("--out_path", type=str, default="datasets/catalog.pkl",
+                        help="Path of the catalog (.pkl, or .parquet with pyarrow).")
+    args, unparsed = parser.parse_known_args()
+
+    main(args)
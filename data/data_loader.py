@@ -1,32 +1,46 @@
 import os
 import sys
+import time
 import warnings
 from typing import Callable, Optional, Tuple, Sequence
-from multiprocessing import Pool
 from joblib import Parallel, delayed
 
 import numpy as np
 import pandas as pd
-from skimage.filters import threshold_otsu
-from scipy import ndimage
 import SimpleITK as sitk
 from sklearn.model_selection import train_test_split
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import (Dataset, DataLoader, BatchSampler, RandomSampler,
+                              SequentialSampler, get_worker_info)
+from torch.utils.data.dataloader import default_collate
 import torchvision
 
-from data.preprocessing import read_nrrd_image, read_dicom_image, resample_image
-from data.transforms import AffineTransform
+from data.preprocessing import read_nrrd_image, read_dicom_image, crop_subvolume
+from data.transforms import AffineTransform, HorizontalFlip
+from data.volume_store import VolumeStore
+from data.cache_manifest import CacheManifest, cache_config_name, source_signature
+from data.shared_cache import SharedVolumeCache
+from data.preprocess_engine import run_preprocessing
+from data.dicom_index import DicomSeriesIndex
+from data.decoded_cache import DecodedVolumeCache
+from data.staging import CacheStager
+from data.volume_codecs import check_codec, write_volume, read_volume, read_volume_array
+from data.augmentation_bank import AugmentationBank
+from data.catalog import PatientCatalog, is_catalog, read_label_csv
+from data.patient_metadata import PatientMetadata
+from util.profiling import StageProfiler, profile, nbytes
 
 
 def load_image_data_frame(path, img_X: Sequence[str], img_Y: Sequence[str],
-                          label_col="has_artifact", val_split=0.1) :
+                          label_col="has_artifact", val_split=0.1,
+                          cohort: Optional[str] = None) :
     """ Load data Frame containing the DA label and location of each patient
     Parameters :
     ------------
     path (str)
-        Full path to the CSV containing the image IDs and corresponding labels.
+        Full path to the CSV containing the image IDs and corresponding labels,
+        or to a patient catalog (.parquet or .pkl, see data.catalog).
     img_X (list) :
         The CSV label for images in domain X. Must be a list of labels as strings.
         The union of all labels in the list will be used.
@@ -37,20 +51,21 @@ def load_image_data_frame(path, img_X: Sequence[str], img_Y: Sequence[str],
     val_split (float)
         Proportion of data to use for validation set. If 0.0, return empty
         validation dataframes.
+    cohort (str)
+        The cohort to load if path is a catalog, e.g. 'train_labels'.
     Returns :
     ---------
     split data: Tuple, length = 4
         The X-domain and Y-domain data for the train and validation sets
         (total of 4 data frames).
     """
-    df = pd.read_csv(path,
-                     # usecols=["patient_id", label_col, "DA_z", "a_slice"],
-                     dtype=str, na_values=['nan', 'NaN', ''])
-    df.set_index("patient_id", inplace=True)
-    df["DA_z"] = df["DA_z"].astype(int)
+    if is_catalog(path) :
+        return PatientCatalog(path).split(cohort, img_X, img_Y, label_col=label_col,
+                                          val_split=val_split)
+    df = read_label_csv(path) # Typed columns, indexed by patient ID
 
     if val_split == 0 : # Create only a training set
-        trg_df, val_df = df, pd.DataFrame(data={label_col: []}) # Empty DF for val set
+        trg_df, val_df = df, df.iloc[:0] # Empty DF for val set
     else :             # Get patient IDs for traing and val sets
         trg_df, val_df = train_test_split(df, test_size=val_split,
                                             stratify=df[label_col].values)
@@ -61,6 +76,222 @@ def load_image_data_frame(path, img_X: Sequence[str], img_Y: Sequence[str],
 
     return x_df_trg, x_df_val, y_df_trg, y_df_val
 
+# Settings shared by all preprocessing tasks in a worker process
+_preprocess_config = {}
+
+def _init_preprocess_worker(config: dict) :
+    global _preprocess_config
+    _preprocess_config = config
+    # Share the cores between the worker processes instead of letting every
+    # worker start one ITK thread per core
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(config["decode_threads"])
+
+
+
+def _preprocess_task(payload) :
+    """ Preprocess one image (unpaired) or one pair of images (paired).
+
+    The payload is (patient_id, path, da_slice) for a single image, or a tuple
+    of two of these for a pair. A pair is preprocessed in exactly the same way:
+    image y is cropped around the same physical point as image x.
+    """
+    if isinstance(payload[0], tuple) :
+        x_task, y_task = payload
+        # Preprocess image x and get physical coords of img center
+        x_coords = _preprocess_image(*x_task)
+
+        # Load image y and crop it around the same place as image x
+        y_coords = _preprocess_image(*y_task, center_coords=x_coords)
+
+        return x_coords, y_coords
+    return _preprocess_image(*payload)
+
+
+
+def _preprocess_image(patient_id: str, path: str, da_idx: int, center_coords=None) :
+    """Preprocess and cache a single image."""
+    config = _preprocess_config
+    img_size, img_spacing = config["img_size"], config["img_spacing"]
+
+    # Load image and DA index in original voxel spacing
+    image = _load_source(config, patient_id, path, da_idx, center_coords)
+    geometry = None
+    if config["dicom_index"] is not None and config["slab_reads"] :
+        geometry = config["dicom_index"][patient_id]
+
+    # Resample to the desired voxel spacing and crop around the DA
+    subvol, coords = crop_subvolume(image, da_idx, img_size, img_spacing,
+                                    center_coords=center_coords,
+                                    crop_first=config["crop_first"],
+                                    geometry=geometry)
+
+    _write_cached(config, patient_id, subvol)
+    return coords
+
+
+
+def _load_source(config: dict, patient_id: str, path: str, da_idx: int,
+                 center_coords=None) -> sitk.Image :
+    """ Load the source image of a patient, or the slab of it needed for the
+    crop. If the config has a decoded volume cache, the image is read from it
+    when possible, and saved in it after being decoded otherwise.
+    """
+    img_size, img_spacing = config["img_size"], config["img_spacing"]
+    index, decoded = config["dicom_index"], config["decoded"]
+    slab = index is not None and config["slab_reads"]
+
+    needed = None # Slices of the series needed for the crop and the anti-aliasing
+    if slab :
+        half_extent = (img_size[2] / 2 + 2) * img_spacing[2]
+        needed = index.slab_range(patient_id, half_extent, da_idx=da_idx,
+                                  center_coords=center_coords)
+
+    if decoded is not None :
+        signature = config["signatures"][patient_id]
+        image = decoded.read(patient_id, signature, slices=needed)
+        if image is not None :
+            return image
+
+    # Without decoded_slab_mm, the decoded cache keeps whole images
+    if slab and (decoded is None or config["decoded_slab_mm"] is not None) :
+        # Only decode the slices needed, or the thicker slab kept in the decoded cache
+        if decoded is not None :
+            half_extent = max(half_extent, config["decoded_slab_mm"])
+        image = index.read_slab(patient_id, half_extent, da_idx=da_idx,
+                                center_coords=center_coords,
+                                n_threads=config["decode_threads"])
+        slices = index.slab_range(patient_id, half_extent, da_idx=da_idx,
+                                  center_coords=center_coords)
+    elif index is not None :
+        image, slices = index.read_image(patient_id, n_threads=config["decode_threads"]), None
+    else :
+        image, slices = config["load_img"](path), None
+
+    if decoded is not None :
+        decoded.write(patient_id, image, signature, slices=slices)
+    return image
+
+
+
+def _write_cached(config: dict, patient_id: str, image: sitk.Image) :
+    """Save a preprocessed image in the cache format of the config."""
+    if config["store"] is not None :
+        config["store"].write(patient_id, image)
+    elif config["cache_format"] == "vol" :
+        write_volume(os.path.join(config["cache_dir"], f"{patient_id}.vol"), image,
+                     codec=config["cache_codec"], level=config["cache_codec_level"])
+    else : # NRRD only supports gzip, at the default level
+        sitk.WriteImage(image, os.path.join(config["cache_dir"], f"{patient_id}.nrrd"),
+                        config["cache_codec"] == "gzip")
+
+
+
+def _crop_window(image, start: Optional[np.ndarray], size: Sequence[int]) :
+    """Take the window of the given (z, y, x) size starting at the (z, y, x)
+    index start from an SITK image or an array. Arrays are sliced without
+    copying. If start is None, the whole image is returned."""
+    if start is None :
+        return image
+    stop = np.asarray(start) + np.asarray(size)
+    if isinstance(image, sitk.Image) : # Keeps the physical position of the window
+        return image[int(start[2]) : int(stop[2]), int(start[1]) : int(stop[1]),
+                     int(start[0]) : int(stop[0])]
+    return image[start[0] : stop[0], start[1] : stop[1], start[2] : stop[2]]
+
+
+
+def _spatial_steps(transform) -> list :
+    """Return the HorizontalFlip and AffineTransform steps of a transform, a
+    torchvision.transforms.Compose, a list of transforms or a FusedTransform."""
+    steps = getattr(transform, "steps", None) # FusedTransform
+    if steps is None :
+        steps = getattr(transform, "transforms", transform) # Compose
+    if not isinstance(steps, (list, tuple)) :
+        steps = [steps]
+    return [t for t in steps if isinstance(t, (HorizontalFlip, AffineTransform))]
+
+
+
+def _copy_into(out: np.ndarray, image) :
+    """Copy an image (SITK image, tensor or array) into a slot of a batch."""
+    if isinstance(image, sitk.Image) :
+        array = sitk.GetArrayViewFromImage(image)
+    elif torch.is_tensor(image) :
+        array = image.numpy()
+    else :
+        array = image
+    np.copyto(out, array.reshape(out.shape), casting="unsafe")
+
+
+
+def batch_loader(dataset: Dataset, batch_size: int, shuffle: bool = False,
+                 drop_last: bool = False, **kwargs) -> DataLoader :
+    """ Return a DataLoader that fetches each batch with a single call to
+    dataset.__getitems__ instead of one call to __getitem__ per sample.
+
+    The batch sampler hands the list of indices of a batch to __getitem__ and
+    automatic batching is disabled (batch_size=None), so the batch returned by
+    the dataset is not collated again. Other keyword arguments (num_workers,
+    pin_memory, ...) are passed to the DataLoader.
+
+    If the dataset returns several pairs per read (crops_per_read = k > 1),
+    each batch is made of batch_size / k samples, so it still holds batch_size
+    pairs of images.
+    """
+    crops_per_read = getattr(dataset, "crops_per_read", 1)
+    if batch_size % crops_per_read != 0 :
+        raise ValueError(f"batch_size {batch_size} is not a multiple of "
+                         f"crops_per_read {crops_per_read}.")
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset,
+                      sampler=BatchSampler(sampler, batch_size // crops_per_read, drop_last),
+                      batch_size=None, **kwargs)
+
+
+
+def concat_collate(batch) -> Tuple[torch.Tensor, torch.Tensor] :
+    """ Collate samples that each hold several pairs of images (datasets with
+    crops_per_read > 1) by concatenating them along the batch dimension,
+    instead of stacking them in a new dimension like default_collate. Use it
+    with a regular DataLoader whose batch_size is the number of samples.
+    """
+    if torch.is_tensor(batch[0]) : # Already batched by dataset.__getitems__
+        return tuple(batch)
+    return tuple(torch.cat(images, dim=0) for images in zip(*batch))
+
+
+
+
+class BatchCollate :
+    """Collate function applying batch transforms to every batch.
+
+    The transforms (e.g. BatchAffineTransform, Normalize) are applied with
+    their `apply_batch` method in the DataLoader workers, after the samples
+    are collated with `collate` (default_collate, or concat_collate for
+    datasets with crops_per_read > 1). Works both with a regular DataLoader
+    and with `batch_loader`, whose batches are already collated by the dataset.
+    If a profiler is given, the time spent in it is recorded as 'collate'.
+    """
+    def __init__(self, transforms: Sequence, collate: Callable = default_collate,
+                 profiler: Optional[StageProfiler] = None) :
+        self.transforms = transforms
+        self.collate = collate
+        self.profiler = profiler
+
+    def __call__(self, batch) -> Tuple[torch.Tensor, torch.Tensor] :
+        with profile(self.profiler, "collate") : # Includes the batch transforms
+            if isinstance(batch, list) : # A list of samples
+                batch = self.collate(batch)
+            batch = tuple(batch)
+            for transform in self.transforms :
+                batch = transform.apply_batch(batch)
+        return batch
+
+    def __repr__(self) :
+        return f"{self.__class__.__name__}({self.transforms})"
+
+
+
 class class1(object):
     """docstring for class1."""
 
@@ -89,6 +320,29 @@ class BaseDataset(Dataset):
                  patient_id_col: str = "patient_id",
                  da_size_col: str = "has_artifact",
                  da_slice_col: str = "a_slice",
+                 cache_format: str = "nrrd",
+                 cache_codec: str = "raw",
+                 cache_codec_level: Optional[int] = None,
+                 shared_cache_bytes: int = 0,
+                 shared_cache_compression: Optional[str] = None,
+                 crop_first: bool = False,
+                 cache_size: Optional[Sequence[int]] = None,
+                 crop_jitter: Optional[Sequence[int]] = None,
+                 dicom_index: Optional[str] = None,
+                 slab_reads: bool = False,
+                 decoded_cache: bool = False,
+                 decoded_codec: str = "lz4",
+                 decoded_slab_mm: Optional[float] = None,
+                 stage_dir: Optional[str] = None,
+                 stage_min_free_bytes: int = 2**30,
+                 decode_threads: int = 0,
+                 pin_batches: bool = False,
+                 crops_per_read: int = 1,
+                 profiler: Optional[StageProfiler] = None,
+                 bank_variants: int = 0,
+                 bank_spare: int = 2,
+                 bank_transform: Optional[AffineTransform] = None,
+                 bank_seed: int = 0,
                  dataset_type=None) :
         """ Initialize the class.
 
@@ -107,6 +361,10 @@ class BaseDataset(Dataset):
             The path to the directory containing the raw image files.
         cache_dir :
             The path to the directory in which to cache preprocessed images.
+            Images are cached in a subdirectory named after the image size and
+            spacing, so caches of different configurations can coexist. A
+            manifest records how each image was made and only missing or stale
+            images are preprocessed.
         file_type: str, (default: "nrrd")
             The file type to load. Can be either "npy" or "nrrd" or "DICOM".
         image_size : int, list, None
@@ -133,6 +391,102 @@ class BaseDataset(Dataset):
             The name of the column containing the magnitude of the DA.
         da_slice_col: str  (default: a_slice)
             The name of the column containing the z-index of the DA.
+        cache_format: str (default: "nrrd")
+            How to store the preprocessed images. Can be "nrrd" (one file per
+            patient) or "memmap" (all patients packed in one memory-mapped
+            array file, see data.volume_store.VolumeStore) or "vol" (one file
+            per patient compressed with `cache_codec`, see
+            data.volume_codecs).
+        cache_codec: str (default: "raw")
+            The compression of the cached images. Can be "raw", "gzip", "zstd"
+            or "lz4" for the "vol" format, "raw" or "gzip" for "nrrd". The
+            "memmap" format is always raw. Changing it does not invalidate an
+            existing cache.
+        cache_codec_level: int (default: None)
+            The compression level of `cache_codec`. If None, the codec's
+            default level is used. Ignored for "nrrd".
+        shared_cache_bytes: int (default: 0)
+            If greater than 0, keep up to this many bytes of decoded images in
+            an LRU cache in shared memory, used by all DataLoader workers.
+        shared_cache_compression: str (default: None)
+            Compression used in the shared memory cache. Can be None or any
+            codec accepted by `cache_codec`.
+        crop_first: bool (default: False)
+            If True, locate the crop on the DA slice and resample only the
+            cropped region instead of the whole image during preprocessing.
+        cache_size: list (default: None)
+            The (z, y, x) size of the slab cached around the DA, at least
+            image_size. Windows of image_size are taken from the cached slabs
+            when loading, so several image sizes can share one cache. If None,
+            image_size is cached.
+        crop_jitter: int or list (default: None)
+            The maximum (z, y, x) offset in voxels of the window from the
+            centre of the cached slab. The offset is drawn uniformly for every
+            sample, the same for its X and Y images, and clipped to the slab.
+            If None, the window is always centred.
+        dicom_index: str (default: None)
+            Path to the DICOM series index (see data.dicom_index). Only used if
+            file_type is "DICOM". If None, 'dicom_index.json' in cache_dir is
+            used. The index is built the first time and updated incrementally.
+        slab_reads: bool (default: False)
+            If True and file_type is "DICOM", only decode the slices around
+            the DA slice needed for the crop instead of the whole series.
+            Implies crop_first.
+        decoded_cache: bool (default: False)
+            If True, keep every patient's decoded source image in
+            'decoded/' in cache_dir (see data.decoded_cache) and make the
+            cached crops from it. Caching another image size or spacing then
+            resamples and crops the decoded images instead of decoding the
+            DICOM series again.
+        decoded_codec: str (default: "lz4")
+            The compression of the decoded images: 'raw', 'gzip', 'zstd' or
+            'lz4'.
+        decoded_slab_mm: float (default: None)
+            With slab_reads, keep only a slab of this half-thickness in mm
+            around the DA in the decoded cache instead of the whole image.
+            Crops that need slices outside of the slab decode the series again.
+        stage_dir: str (default: None)
+            A directory on node-local scratch. If given, the cached images of
+            the dataset are copied there (see data.staging.CacheStager) once
+            the cache is ready, and read from the local copies. Images that
+            don't fit are read from cache_dir.
+        stage_min_free_bytes: int (default: 2**30)
+            The space to leave free in stage_dir.
+        decode_threads: int (default: 0)
+            The number of threads each preprocessing process uses to decode
+            DICOM slices (and to run ITK filters). If 0, the CPUs are split
+            evenly between the num_workers processes.
+        pin_batches: bool (default: False)
+            If True, the batches returned by __getitems__ are allocated in
+            pinned memory when loading in the main process. Batches from
+            DataLoader workers are pinned by the DataLoader (pin_memory=True).
+        crops_per_read: int (default: 1)
+            The number of pairs of images made from each read of the cached
+            images. Each sample loads its X and Y images once and returns k
+            pairs of windows (see cache_size and crop_jitter), each with its
+            own random transform, as tensors of shape (k, 1, z, y, x). An epoch
+            then holds k pairs per image of domain X. Use `batch_loader` or
+            `concat_collate` to make batches of pairs.
+        profiler: StageProfiler (default: None)
+            If given, the time spent reading the cached images, in each
+            transform and in collation, and the bytes read and allocated, are
+            recorded in this profiler (see util.profiling).
+        bank_variants: int (default: 0)
+            If greater than 0, precompute this many randomly flipped, rotated
+            and translated variants of every cached image (see
+            data.augmentation_bank.AugmentationBank) and load a random variant
+            instead of the cached image. Every patient's variants have their
+            own parameters, shared by both images of a pair in paired
+            datasets. The transform must then not contain HorizontalFlip or
+            AffineTransform.
+        bank_spare: int (default: 2)
+            The number of variants that can be regenerated at once by
+            `self.bank.start_refresh`.
+        bank_transform: AffineTransform (default: None)
+            The range of the rotations and translations of the variants. If
+            None, AffineTransform(30.0, [20, 20]) is used.
+        bank_seed: int (default: 0)
+            The seed of the parameters of the variants.
         """
         self.X_df, self.Y_df = X_df, Y_df
         self.img_dir = image_dir
@@ -140,15 +494,44 @@ class BaseDataset(Dataset):
         self.file_type = file_type
         self.img_size = np.array(image_size)[::-1]       # Reverse indexing for SITK
         self.img_spacing = np.array(image_spacing)[::-1] # Reverse indexing for SITK
+        if cache_size is None :
+            cache_size = image_size
+        self.cache_size = np.array(cache_size)[::-1]     # Reverse indexing for SITK
+        if np.any(self.cache_size < self.img_size) :
+            raise ValueError(f"cache_size {cache_size} is smaller than image_size {image_size}.")
+        self.crop_jitter = None
+        if crop_jitter is not None : # (z, y, x)
+            if np.size(crop_jitter) not in [1, 3] :
+                raise ValueError(f"crop_jitter must be one value or 3 values (z, y, x), "
+                                 f"got {crop_jitter}.")
+            self.crop_jitter = np.broadcast_to(np.asarray(crop_jitter, dtype=np.int64), (3,))
+        if bank_variants > 0 and len(_spatial_steps(transform)) > 0 :
+            raise ValueError("The variants of the augmentation bank are already flipped, "
+                             "rotated and translated: the transform must not contain "
+                             f"HorizontalFlip or AffineTransform, got {transform}.")
         self.dim = dim
         # self.transform = transform
         self.num_workers = num_workers
         self.patient_id_col = patient_id_col
         self.da_size_col = da_size_col
         self.da_slice_col = da_slice_col
+        self.cache_format = cache_format
+        self.cache_codec = cache_codec
+        self.cache_codec_level = cache_codec_level
+        self.crop_first = crop_first
+        self.slab_reads = slab_reads
+        self.decoded_slab_mm = decoded_slab_mm
+        if decode_threads == 0 :
+            decode_threads = max(1, (os.cpu_count() or 1) // max(num_workers, 1))
+        self.decode_threads = decode_threads
+        self.pin_batches = pin_batches
+        self.crops_per_read = int(crops_per_read)
+        self.profiler = profiler
         self.first_cache = False
         self.dataset_type = dataset_type
         self.full_df = pd.concat([self.X_df, self.Y_df])
+        # Looked up while loading, instead of the data frames
+        self.metadata = PatientMetadata.from_frame(self.full_df, self.da_slice_col)
 
         # Get the number of images in each domain
         self.x_size, self.y_size = len(X_df), len(Y_df)
@@ -157,32 +540,157 @@ class BaseDataset(Dataset):
         # Get the correct function to load the raw image type
         self.load_img = self._get_img_loader()
 
-        # Create a cache if needed. Check if cache already exists
-        sample_path = os.path.join(self.cache_dir, f"{self.x_ids[0]}.nrrd")
-
-        if os.path.exists(sample_path) :
-            # The sample file exists. Now check that the size is right
-            sample_file = sitk.ReadImage(sample_path)
-            vox, size = sample_file.GetSpacing(), sample_file.GetSize()
-            sample_file = None
-
-            # Check if images are correctly cached. If not, process them again.
-            if (np.array(size) != self.img_size).any() :
-                print(f"Image size {size} different than unexpected: {self.img_size}")
-                self._prepare_data()
-            elif (np.array(vox) != self.img_spacing).any() :
-                print(f"Voxel spacing {vox} different than unexpected: {self.img_spacing}")
-                self._prepare_data()
+        # Each size/spacing configuration is cached in its own subdirectory
+        self.cache_root = cache_dir
+        self.cache_dir = os.path.join(cache_dir,
+                                      cache_config_name(cache_size, image_spacing))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.manifest = CacheManifest(os.path.join(self.cache_dir, "manifest.json"),
+                                      cache_size, image_spacing)
+        self.dicom_index = None
+        if self.file_type == "DICOM" :
+            if dicom_index is None :
+                dicom_index = os.path.join(self.cache_root, "dicom_index.json")
+            self.dicom_index = DicomSeriesIndex(dicom_index)
+            failed = self.dicom_index.update(self.img_dir, self.full_df.index,
+                                             num_workers=self.num_workers)
+            if len(failed) > 0 :
+                failed = set(failed)
+                if self.dataset_type == "paired" : # Drop whole pairs to keep them aligned
+                    failed = failed.union(*[pair for pair in zip(self.x_ids, self.y_ids)
+                                            if not failed.isdisjoint(pair)])
+                warnings.warn(f"Removing {len(failed)} patients whose DICOM series "
+                              f"could not be indexed from the dataset.")
+                self._drop_patients(failed)
+        self._staged_paths = {} # Local copies of the cached images, see _stage_cache
+        self.decoded = None
+        if decoded_cache :
+            self.decoded = DecodedVolumeCache(os.path.join(self.cache_root, "decoded"),
+                                              codec=decoded_codec)
+
+        if self.cache_format == "memmap" :
+            self.store = VolumeStore(self.cache_dir, shape=self.cache_size[::-1],
+                                     spacing=self.img_spacing.tolist())
+        elif self.cache_format in ["nrrd", "vol"] :
+            self.store = None
         else :
-            # The images are not cached. Process them.
-            print(f"cache {sample_path} does not exist")
-            os.makedirs(self.cache_dir, exist_ok=True)
-            self._prepare_data()
+            raise ValueError(f"cache_format {self.cache_format} not accepted.")
+        check_codec(self.cache_codec)
+        if self.cache_format == "nrrd" and self.cache_codec not in ["raw", "gzip"] :
+            raise ValueError(f"cache_codec {self.cache_codec} is not supported by "
+                             "NRRD. Use cache_format='vol'.")
+
+        # Preprocess only the images that are missing or stale in the cache
+        stale_ids = rebuilt_ids = self._get_stale_ids()
+        if len(stale_ids) > 0 :
+            print(f"{len(stale_ids)} of {len(self.full_df)} images in {self.cache_dir} "
+                  "are missing or stale.")
+            if self.store is not None :
+                self.store.reserve(stale_ids)
+            self._prepare_data(stale_ids)
+
+            # Never continue with a partially stale cache
+            stale_ids = self._get_stale_ids()
+            if len(stale_ids) > 0 :
+                raise RuntimeError(f"{len(stale_ids)} images could not be cached, "
+                                   f"e.g. {stale_ids[:5]}.")
+
+        if stage_dir is not None :
+            self._stage_cache(stage_dir, stage_min_free_bytes)
+
+        # Keep track of subvolume center
+        coords_array = np.array([self.manifest.centre(id) for id in self.full_df.index])
+        self.full_df["img_center_x"] = coords_array[:, 0]
+        self.full_df["img_center_y"] = coords_array[:, 1]
+        self.full_df["img_center_z"] = coords_array[:, 2]
+        self.metadata.set_centres(self.full_df.index, coords_array)
+
+        self.bank = None
+        if bank_variants > 0 :
+            self.bank = AugmentationBank(os.path.join(self.cache_dir, "augmentation_bank"),
+                                         shape=self.cache_size[::-1],
+                                         n_variants=bank_variants,
+                                         n_spare=bank_spare,
+                                         affine=bank_transform,
+                                         seed=bank_seed)
+            # Both images of a pair get the same flip, rotation and translation
+            keys = dict(zip(self.y_ids, self.x_ids)) if self.dataset_type == "paired" else None
+            self.bank.build(self.full_df.index, self._read_cached_file,
+                            stale_ids=rebuilt_ids, num_workers=self.num_workers, keys=keys)
 
         print("Data successfully cached\n")
         self.first_cache = True
         self.transform = transform # Defined after preprocess b/c transforms can't be pickled
 
+        # Also defined after preprocessing since shared memory can't be pickled
+        self.shared_cache = None
+        if shared_cache_bytes > 0 :
+            self.shared_cache = SharedVolumeCache(shared_cache_bytes,
+                                                  compression=shared_cache_compression)
+
+
+    def _source_path(self, patient_id: str) -> str :
+        return os.path.join(self.img_dir, f"{patient_id}{self.img_suffix}")
+
+
+    def _is_cached(self, patient_id: str) -> bool :
+        """Whether the cache holds a written image for this patient."""
+        if self.store is not None :
+            return patient_id in self.store
+        return os.path.exists(self._cached_path(patient_id))
+
+
+    def _cached_path(self, patient_id: str) -> str :
+        path = self._staged_paths.get(patient_id)
+        if path is None :
+            path = os.path.join(self.cache_dir, f"{patient_id}.{self.cache_format}")
+        return path
+
+
+    def _stage_cache(self, stage_dir: str, min_free_bytes: int) :
+        """Copy the cached images of the dataset to node-local scratch and read
+        them from there. The local directory mirrors the path of cache_dir."""
+        local_dir = os.path.join(stage_dir, os.path.abspath(self.cache_dir).lstrip(os.sep))
+        stager = CacheStager(self.cache_dir, local_dir, min_free_bytes=min_free_bytes)
+        if self.store is not None : # One set of files for every patient
+            names = ["volumes.dat", "volumes.geom", "volumes.json"]
+            paths = stager.stage(names)
+            if all(paths[name].startswith(local_dir) for name in names) :
+                self.store = VolumeStore(local_dir, shape=self.cache_size[::-1],
+                                         spacing=self.img_spacing.tolist())
+        else :
+            names = {f"{id}.{self.cache_format}": id for id in self.full_df.index}
+            paths = stager.stage(list(names))
+            self._staged_paths = {names[name]: path for name, path in paths.items()}
+        self.staging_stats = stager.stats
+
+
+    def _get_stale_ids(self) -> list :
+        """ Return the IDs of the patients whose cached image is missing or no
+        longer matches its source image, the image size/spacing or the version
+        of the preprocessing code. For paired datasets, both images of a pair are
+        stale if either one is.
+        """
+        self._signatures = {}
+        stale = set()
+        for patient_id in self.full_df.index :
+            path = self._source_path(patient_id)
+            if self.dicom_index is not None : # Avoid walking the series again
+                self._signatures[patient_id] = self.dicom_index.signature(patient_id)
+            else :
+                self._signatures[patient_id] = source_signature(path)
+            if not (self.manifest.is_fresh(patient_id, path, self._signatures[patient_id],
+                                           **self._cache_settings(patient_id))
+                    and self._is_cached(patient_id)) :
+                stale.add(patient_id)
+
+        if self.dataset_type == "paired" :
+            for x_id, y_id in zip(self.x_ids, self.y_ids) :
+                if x_id in stale or y_id in stale :
+                    stale.update([x_id, y_id])
+
+        return [id for id in self.full_df.index if id in stale]
+
 
     def _get_img_loader(self) :
         if self.file_type == "nrrd" :
@@ -196,92 +704,276 @@ class BaseDataset(Dataset):
 
 
 
-    def _prepare_data(self) :
-        """Preprocess and cache the dataset."""
-        if self.dataset_type == "unpaired" :
-            tasks = [patient_id for patient_id in self.full_df.index.values]
+    def _prepare_data(self, patient_ids: Sequence[str]) :
+        """ Preprocess and cache the images of the given patients.
 
+        Each patient's entry is added to the manifest as soon as it is cached,
+        and the manifest is saved regularly, so an interrupted run resumes where
+        it stopped. Patients that fail to preprocess are reported in
+        preprocess_errors.json in the cache directory and removed from the
+        dataset.
+        """
+        if self.dataset_type == "unpaired" :
+            tasks = [(id, self._get_task(id)) for id in patient_ids]
             print(f"Using {self.num_workers} CPUs to preprocess {len(tasks)} images.")
-            print("This may take a moment...")
-            if self.num_workers > 1 :
-                with Pool(processes=self.num_workers) as p:
-                    center_coords = p.map(self._preprocess_image, tasks)
-            else :
-                center_coords = [self._preprocess_image(id) for id in tasks]
-
-            # Keep track of subvolume center
-            coords_array = np.array(center_coords)
-            self.full_df["img_center_x"] = coords_array[:, 0]
-            self.full_df["img_center_y"] = coords_array[:, 1]
-            self.full_df["img_center_z"] = coords_array[:, 2]
 
         if self.dataset_type == "paired" :
-            npairs, ncpus = len(self.X_df), self.num_workers
-            print(f"Using {ncpus} CPUs to preprocess {npairs} image pairs.")
-            print("This may take a moment...")
-
-            tasks = np.array([self.X_df.index.values, self.Y_df.index.values]).reshape(npairs, 2)
-            if self.num_workers > 1 :
-                with Pool(processes=ncpus) as p:
-                    center_coords = p.map(self._preprocess_pair, tasks)
-            else :
-                center_coords = [self._preprocess_pair(id) for id in tasks]
-            print(center_coords)
-
-
-    def _preprocess_pair(self, ids) :
-        """ A function to create a pair of images preprocessed in exactly
-        the same way.
+            stale = set(patient_ids)
+            tasks = [((x_id, y_id), (self._get_task(x_id), self._get_task(y_id)))
+                     for x_id, y_id in zip(self.x_ids, self.y_ids) if x_id in stale]
+            print(f"Using {self.num_workers} CPUs to preprocess {len(tasks)} image pairs.")
+        print("This may take a moment...")
+
+        errors = run_preprocessing(_preprocess_task, tasks,
+                                   num_workers=self.num_workers,
+                                   initializer=_init_preprocess_worker,
+                                   initargs=(self._get_preprocess_config(),),
+                                   on_result=self._record_cached,
+                                   checkpoint=self.manifest.save,
+                                   error_path=os.path.join(self.cache_dir,
+                                                           "preprocess_errors.json"))
+
+        if len(errors) > 0 :
+            failed = set()
+            for key in errors :
+                failed.update(key if self.dataset_type == "paired" else [key])
+            warnings.warn(f"Removing {len(failed)} patients that could not be "
+                          f"preprocessed from the dataset.")
+            self._drop_patients(failed)
+
+
+    def _get_preprocess_config(self) -> dict :
+        """Return the settings shared by all preprocessing tasks. They are sent
+        to each worker process once instead of with every task."""
+        return {"load_img": self.load_img,
+                "img_size": self.cache_size,
+                "img_spacing": self.img_spacing,
+                "crop_first": self.crop_first,
+                "slab_reads": self.slab_reads,
+                "decode_threads": self.decode_threads,
+                "dicom_index": self.dicom_index,
+                "decoded": self.decoded,
+                "decoded_slab_mm": self.decoded_slab_mm,
+                "signatures": self._signatures if self.decoded is not None else None,
+                "cache_dir": self.cache_dir,
+                "cache_format": self.cache_format,
+                "cache_codec": self.cache_codec,
+                "cache_codec_level": self.cache_codec_level,
+                "store": self.store}
+
+
+    def _get_task(self, patient_id: str) -> Tuple[str, str, int] :
+        """Return the lightweight payload needed to preprocess one image."""
+        da_idx = self.metadata.da_slice(patient_id)
+        return patient_id, self._source_path(patient_id), da_idx
+
+
+    def _record_cached(self, key, coords) :
+        """Add a freshly cached image (or pair of images) to the manifest."""
+        if self.dataset_type == "paired" :
+            ids, coords = key, coords
+        else :
+            ids, coords = [key], [coords]
+        for patient_id, centre in zip(ids, coords) :
+            self.manifest.update(patient_id, self._source_path(patient_id),
+                                 self._signatures[patient_id], centre,
+                                 **self._cache_settings(patient_id))
+
+
+    def _cache_settings(self, patient_id: str) -> dict :
+        """Return the settings that decide how a patient's image is cropped
+        and stored, which are recorded in the cache manifest. The caches of
+        every format share the manifest of their size and spacing."""
+        return {"da_idx": self.metadata.da_slice(patient_id),
+                "crop_first": self.crop_first,
+                "slab_reads": self.slab_reads,
+                "cache_format": self.cache_format,
+                "cache_codec": self.cache_codec}
+
+
+    def _drop_patients(self, patient_ids) :
+        """Remove patients from the dataset."""
+        self.X_df = self.X_df[~self.X_df.index.isin(patient_ids)]
+        self.Y_df = self.Y_df[~self.Y_df.index.isin(patient_ids)]
+        self.full_df = self.full_df[~self.full_df.index.isin(patient_ids)]
+        self.x_size, self.y_size = len(self.X_df), len(self.Y_df)
+        self.x_ids, self.y_ids = self.X_df.index, self.Y_df.index
+        self.metadata = PatientMetadata.from_frame(self.full_df, self.da_slice_col)
+
+
+    def __getstate__(self) :
+        # The data frames are only used to build the cache. Workers started
+        # with spawn look patients up in the shared metadata instead of
+        # unpickling a copy of every frame.
+        state = self.__dict__.copy()
+        state["X_df"] = state["Y_df"] = state["full_df"] = None
+        return state
+
+
+    def _read_cached(self, patient_id: str, start: Optional[np.ndarray] = None) -> sitk.Image :
+        """Load a preprocessed image from the shared memory cache if possible,
+        otherwise from the cache on disk. If start is given, only the (z, y, x)
+        window of image_size starting there is returned."""
+        if self.shared_cache is not None :
+            image = self.shared_cache.get_image(patient_id)
+            if image is None :
+                image = self._read_cached_file(patient_id)
+                self.shared_cache.put_image(patient_id, image)
+            return _crop_window(image, start, self.img_size[::-1])
+        return self._read_cached_file(patient_id, start)
+
+
+    def _read_cached_file(self, patient_id: str, start: Optional[np.ndarray] = None) -> sitk.Image :
+        """Load a preprocessed image (or a window of it) from the cache on disk."""
+        if self.store is not None :
+            if start is None :
+                return self.store.get_image(patient_id)
+            return self.store.get_image(patient_id, start, self.img_size[::-1])
+        elif self.cache_format == "vol" :
+            image = read_volume(self._cached_path(patient_id))
+        else :
+            image = sitk.ReadImage(self._cached_path(patient_id))
+        return _crop_window(image, start, self.img_size[::-1])
+
+
+    def _read_cached_pixels(self, patient_id: str, start: Optional[np.ndarray] = None) :
+        """Load the pixels of a preprocessed image as an array when possible,
+        skipping the creation of an SITK image. Windows of a memmap cache are
+        read as slices of the memory map."""
+        if self.shared_cache is None and self.store is not None :
+            return _crop_window(self.store.get_array(patient_id), start, self.img_size[::-1])
+        elif self.shared_cache is None and self.cache_format == "vol" :
+            array = read_volume_array(self._cached_path(patient_id))[0]
+            return _crop_window(array, start, self.img_size[::-1])
+        return self._read_cached(patient_id, start)
+
+
+    def _window_start(self) -> Optional[np.ndarray] :
+        """Draw the (z, y, x) start of the window taken from the cached slabs
+        for one sample. None if the slabs have the size of the images."""
+        margin = (self.cache_size - self.img_size)[::-1]
+        if not margin.any() :
+            return None
+        start = margin // 2
+        if self.crop_jitter is not None :
+            start = start + np.random.randint(-self.crop_jitter, self.crop_jitter + 1)
+        return np.clip(start, 0, margin)
+
+
+    def _read_pair(self, x_patient_id: str, y_patient_id: str, pixels: bool = False,
+                   window: bool = True) :
+        """Load the images of a sample, or the same random variant of both
+        from the augmentation bank (as arrays). The same window is taken from
+        both cached slabs, unless window is False. If pixels is True, arrays
+        are returned when possible (see _read_cached_pixels)."""
+        t0 = time.perf_counter()
+        start, size = self._window_start() if window else None, self.img_size[::-1]
+        if self.bank is not None :
+            variant = self.bank.sample_variant()
+            pair = (_crop_window(self.bank.get_array(x_patient_id, variant), start, size),
+                    _crop_window(self.bank.get_array(y_patient_id, variant), start, size))
+        else :
+            read = self._read_cached_pixels if pixels else self._read_cached
+            pair = read(x_patient_id, start), read(y_patient_id, start)
+        if self.profiler is not None : # Memory-mapped pixels are only read when used
+            self.profiler.add("read", time.perf_counter() - t0, bytes_read=nbytes(pair))
+        return pair
+
+
+    def _read_crops(self, x_patient_id: str, y_patient_id: str, pixels: bool = False) -> list :
+        """Load the images of a sample once and return crops_per_read pairs of
+        windows taken from them (see _read_pair)."""
+        if self.crops_per_read == 1 :
+            return [self._read_pair(x_patient_id, y_patient_id, pixels)]
+        x, y = self._read_pair(x_patient_id, y_patient_id, pixels, window=False)
+        crops, size = [], self.img_size[::-1]
+        for _ in range(self.crops_per_read) :
+            start = self._window_start()
+            crops.append((_crop_window(x, start, size), _crop_window(y, start, size)))
+        return crops
+
+
+    def _split_transform(self) :
+        """ Split the transform into the steps applied to every sample and
+        the trailing steps that can be applied to a whole batch at once (those
+        with an `apply_batch` method, e.g. Normalize and ToTensor).
         """
-        x_patient_id, y_patient_id = ids
-        # Preprocess image x and get physical coords of img center
-        x_coords = self._preprocess_image(x_patient_id)
-
-        # Load image y and crop it around the same place as image x
-        y_coords = self._preprocess_image(y_patient_id, center_coords=x_coords)
-
-        return x_coords, y_coords
-
-
-
-    def _preprocess_image(self, patient_id: str, center_coords=None) :
-        """Preprocess and cache a single image."""
-        # Load image and DA index in original voxel spacing
-        path = os.path.join(self.img_dir, f"{patient_id}{self.img_suffix}")
-        image = self.load_img(path)
-        da_idx = int(self.full_df.at[patient_id, self.da_slice_col])
+        if self.transform is None :
+            return [], []
+        if isinstance(self.transform, torchvision.transforms.Compose) :
+            steps = self.transform.transforms
+        else :
+            steps = [self.transform]
+        n = len(steps)
+        while n > 0 and hasattr(steps[n - 1], "apply_batch") :
+            n -= 1
+        return steps[:n], steps[n:]
 
-        # Resample image and DA slice to desired voxel spacing
-        da_coords = image.TransformIndexToPhysicalPoint([150, 150, da_idx])
-        image = resample_image(image, self.img_spacing.tolist())
 
-        ### Cropping ###
-        if center_coords is None :
-            da_z = image.TransformPhysicalPointToIndex(da_coords)[2] # DA z-index
-            # Get the center of the head in the DA slice
-            slice = sitk.GetArrayFromImage(image[:, :, da_z])
-            t = threshold_otsu(np.clip(slice, -1000, 1000))
-            slice = np.array(slice > t, dtype=int)
-            com  = ndimage.measurements.center_of_mass(slice)
-            y, x = int(com[0]) - 25, int(com[1])
-        else :
-            x, y, da_z = image.TransformPhysicalPointToIndex(center_coords)
+    def _pair_ids(self, index: int) -> Tuple[str, str] :
+        """Return the patient IDs of the images from domain X and Y of a sample."""
+        raise NotImplementedError
 
-        crop_size   = self.img_size
-        crop_center = np.array([x, y, da_z])
 
-        # Crop to required size around this point
-        _min = np.floor(crop_center - crop_size / 2).astype(np.int64)
-        _max = np.floor(crop_center + crop_size / 2).astype(np.int64)
-        subvol = image[_min[0] : _max[0], _min[1] : _max[1], _min[2] : _max[2]]
-        ### --------- ###
+    def __getitems__(self, indices: Sequence[int]) -> Tuple[torch.Tensor, torch.Tensor] :
+        """ Load a whole batch of images from domains X and Y.
 
-        # Save the image
-        sitk.WriteImage(subvol, os.path.join(self.cache_dir, f"{patient_id}.nrrd"))
+        The images are written straight into one preallocated tensor per domain
+        instead of being returned one at a time and stacked by the collate
+        function of the DataLoader. The transforms at the end of the transform
+        chain that have an `apply_batch` method are applied once to the whole
+        batch, the others to each sample. A transform with an `apply_into`
+        method (see data.transforms.compile_transform) writes each sample
+        straight into the batch. Use `batch_loader` to create a DataLoader that
+        calls this method. Each sample gives crops_per_read pairs of images.
 
-        # Save the location of the center of the image
-        coords = image.TransformIndexToPhysicalPoint((x, y, da_z))
-        return float(coords[0]), float(coords[1]), float(coords[2])
+        Parameters
+        ----------
+        indices
+            The indices of the samples in the batch.
+
+        Returns
+        -------
+        Tuple[torch.Tensor, torch.Tensor]
+            The batches of images from domain X and Y, of shape
+            (batch_size, 1, z_size, y_size, x_size), or
+            (batch_size, z_size, y_size, x_size) if dim is 2, where batch_size
+            is len(indices) * crops_per_read.
+        """
+        with profile(self.profiler, "batch") :
+            return self._load_batch(indices)
+
+
+    def _load_batch(self, indices: Sequence[int]) -> Tuple[torch.Tensor, torch.Tensor] :
+        fused = hasattr(self.transform, "apply_into")
+        sample_steps, batch_steps = ([], []) if fused else self._split_transform()
+        shape = (len(indices) * self.crops_per_read,) + ((1,) if self.dim == 3 else ()) + tuple(self.img_size[::-1])
+        pin = self.pin_batches and torch.cuda.is_available() and get_worker_info() is None
+        X = torch.empty(shape, dtype=torch.float32, pin_memory=pin)
+        Y = torch.empty(shape, dtype=torch.float32, pin_memory=pin)
+        X_array, Y_array = X.numpy(), Y.numpy()
+
+        i = 0
+        for index in indices :
+            x_patient_id, y_patient_id = self._pair_ids(index)
+            if fused :
+                for x, y in self._read_crops(x_patient_id, y_patient_id) :
+                    self.transform.apply_into((x, y), (X_array[i], Y_array[i]))
+                    i += 1
+                continue
+            for x, y in self._read_crops(x_patient_id, y_patient_id,
+                                         pixels=len(sample_steps) == 0) :
+                for step in sample_steps :
+                    x, y = step((x, y))
+                with profile(self.profiler, "collate") :
+                    _copy_into(X_array[i], x)
+                    _copy_into(Y_array[i], y)
+                i += 1
+
+        batch = X, Y
+        for step in batch_steps :
+            batch = step.apply_batch(batch)
+        return batch
 
 
     def __getitem__(self, index) :
@@ -311,6 +1003,12 @@ class UnpairedDataset(BaseDataset):
         super(UnpairedDataset, self).__init__(*args, **kwargs, dataset_type="unpaired")
 
 
+    def _pair_ids(self, index: int) -> Tuple[str, str] :
+        # Randomize index for images in Y domain to avoid pairs
+        y_index = np.random.randint(0, self.y_size - 1)
+        return self.x_ids[index], self.y_ids[y_index]
+
+
     def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor] :
         """ Get a the image at index from domain X and get an accompanying
         random image from domain Y. Assume the images are preprocessed (sized)
@@ -319,24 +1017,25 @@ class UnpairedDataset(BaseDataset):
         Parameters
         ----------
         index (int)
-            The index of the image to take from domain X.
+            The index of the image to take from domain X. If a list of indices,
+            the whole batch is returned (see __getitems__).
         """
+        if isinstance(index, (list, np.ndarray)) : # A whole batch
+            return self.__getitems__(index)
+        if self.crops_per_read > 1 : # Several pairs from one read
+            return self.__getitems__([index])
+
         # Get size of tensor in torch/np indexing
         tensor_size = self.img_size[::-1]
+        x_patient_id, y_patient_id = self._pair_ids(index)
 
-        # Randomize index for images in Y domain to avoid pairs
-        x_index = index
-        y_index = np.random.randint(0, self.y_size - 1)
-        x_patient_id = self.x_ids[x_index]
-        y_patient_id = self.y_ids[y_index]
+        with profile(self.profiler, "sample") :
+            # Load the sitk image (or bank variant) from each class
+            X, Y = self._read_pair(x_patient_id, y_patient_id)
 
-        # Load the sitk image from each class
-        X = sitk.ReadImage(os.path.join(self.cache_dir, f"{x_patient_id}.nrrd"))
-        Y = sitk.ReadImage(os.path.join(self.cache_dir, f"{y_patient_id}.nrrd"))
-
-        # Apply random transforms
-        if self.transform is not None:
-            X, Y = self.transform((X, Y)) # Apply the same transform to both images
+            # Apply random transforms
+            if self.transform is not None:
+                X, Y = self.transform((X, Y)) # Apply the same transform to both images
 
         if self.dim == 2 : # Use the channels as third dimension
             X = X.reshape(tensor_size[0], tensor_size[1], tensor_size[2])
@@ -354,6 +1053,10 @@ class PairedDataset(BaseDataset):
             raise ValueError("Paired datasets must have the same size.")
 
 
+    def _pair_ids(self, index: int) -> Tuple[str, str] :
+        return self.x_ids[index], self.y_ids[index]
+
+
     def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor] :
         """ Get a the image at index from domain X and get an accompanying
         random image from domain Y. Assume the images are preprocessed (sized)
@@ -362,21 +1065,25 @@ class PairedDataset(BaseDataset):
         Parameters
         ----------
         index (int)
-            The index of the image in both domains.
+            The index of the image in both domains. If a list of indices, the
+            whole batch is returned (see __getitems__).
         """
+        if isinstance(index, (list, np.ndarray)) : # A whole batch
+            return self.__getitems__(index)
+        if self.crops_per_read > 1 : # Several pairs from one read
+            return self.__getitems__([index])
+
         # Get size of tensor in torch/np indexing
         tensor_size = self.img_size[::-1]
+        x_patient_id, y_patient_id = self._pair_ids(index)
 
-        x_patient_id = self.x_ids[index]
-        y_patient_id = self.y_ids[index]
-
-        # Load the sitk image from each class
-        X = sitk.ReadImage(os.path.join(self.cache_dir, f"{x_patient_id}.nrrd"))
-        Y = sitk.ReadImage(os.path.join(self.cache_dir, f"{y_patient_id}.nrrd"))
+        with profile(self.profiler, "sample") :
+            # Load the sitk image (or bank variant) from each class
+            X, Y = self._read_pair(x_patient_id, y_patient_id)
 
-        # Apply random transforms
-        if self.transform is not None: # Apply the same transform to both images
-            X, Y = self.transform((X, Y))
+            # Apply random transforms
+            if self.transform is not None: # Apply the same transform to both images
+                X, Y = self.transform((X, Y))
 
         if self.dim == 2 : # Use the channels as third dimension
             X = X.reshape(tensor_size[0], tensor_size[1], tensor_size[2])
@@ -0,0 +1,153 @@
+import os
+import json
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+import SimpleITK as sitk
+
+from data.volume_codecs import check_codec, write_volume, read_volume
+
+
+# Increment this whenever a change to the image readers would change the
+# decoded volumes. Every entry written by an older version is then re-decoded.
+DECODED_VERSION = 1
+
+
+
+
+class DecodedVolumeCache :
+    """First tier of the image cache: every patient's decoded source image, in
+    its original spacing.
+
+    The preprocessed crops of each size/spacing configuration (the second
+    tier, see CacheManifest) are derived from these volumes. Decoding a DICOM
+    series is the slowest step of preprocessing, so once a patient is in this
+    tier, caching a new image size or spacing only costs reading one
+    compressed file, resampling and cropping.
+
+    Each patient has a cached volume file `<patient_id>.vol` (see
+    data.volume_codecs) and a small JSON sidecar `<patient_id>.json` holding
+    the signature of the source image it was decoded from and, for a slab,
+    the range of slices it holds. Both are written atomically by the
+    preprocessing worker that decoded the image, so no shared index has to be
+    updated. Volumes with integer values (e.g. CT in HU) are stored as int16,
+    which halves their size without changing any voxel.
+    """
+    def __init__(self, root: str, codec: str = "lz4", level: Optional[int] = None) :
+        """ Initialize the cache.
+
+        Parameters
+        ----------
+        root : str
+            The directory containing the decoded volumes.
+        codec : str
+            The compression of the volume files: 'raw', 'gzip', 'zstd' or 'lz4'.
+        level : int
+            The compression level. If None, the codec's default is used.
+        """
+        check_codec(codec)
+        self.root = root
+        self.codec = codec
+        self.level = level
+        os.makedirs(self.root, exist_ok=True)
+
+
+    def _volume_path(self, patient_id: str) -> str :
+        return os.path.join(self.root, f"{patient_id}.vol")
+
+    def _meta_path(self, patient_id: str) -> str :
+        return os.path.join(self.root, f"{patient_id}.json")
+
+
+    def entry(self, patient_id: str, signature: Dict) -> Optional[Dict] :
+        """Return the sidecar of a patient if its volume was decoded from the
+        current source image, otherwise None."""
+        try :
+            with open(self._meta_path(patient_id), "r") as f :
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError) :
+            return None
+        if (entry["version"] != DECODED_VERSION or
+            entry["source_mtime"] != signature["source_mtime"] or
+            entry["source_size"] != signature["source_size"] or
+            not os.path.exists(self._volume_path(patient_id))) :
+            return None
+        return entry
+
+
+    def read(self, patient_id: str, signature: Dict,
+             slices: Optional[Tuple[int, int]] = None) -> Optional[sitk.Image] :
+        """ Read the decoded image of a patient.
+
+        Parameters
+        ----------
+        patient_id : str
+            The patient whose image to read.
+        signature : Dict
+            The current signature of the patient's source image.
+        slices : Tuple[int, int]
+            The first and last z-index of the source series that are needed.
+            If the cached volume is a slab that does not contain all of them,
+            None is returned. If None, the whole image is needed.
+
+        Returns
+        -------
+        sitk.Image or None
+            The image as float32, or None if the patient is missing, stale or
+            its slab is too thin.
+        """
+        entry = self.entry(patient_id, signature)
+        if entry is None :
+            return None
+        if entry["slices"] is not None :
+            first, last = entry["slices"]
+            if slices is None or slices[0] < first or slices[1] > last :
+                return None
+        return sitk.Cast(read_volume(self._volume_path(patient_id)), sitk.sitkFloat32)
+
+
+    def write(self, patient_id: str, image: sitk.Image, signature: Dict,
+              slices: Optional[Tuple[int, int]] = None) :
+        """ Save the decoded image of a patient.
+
+        Parameters
+        ----------
+        patient_id : str
+            The patient whose image to save.
+        image : sitk.Image
+            The decoded image, or a slab of it.
+        signature : Dict
+            The signature of the source image it was decoded from.
+        slices : Tuple[int, int]
+            The first and last z-index in the source series of the slices of a
+            slab. None for a whole image.
+        """
+        array = sitk.GetArrayViewFromImage(image)
+        as_int = array.astype(np.int16)
+        if np.array_equal(as_int, array) : # Lossless
+            stored = sitk.GetImageFromArray(as_int)
+            stored.CopyInformation(image)
+            image = stored
+
+        # The sidecar is removed first and written last, so a crash in
+        # between leaves no sidecar describing the wrong volume
+        meta_path = self._meta_path(patient_id)
+        if os.path.exists(meta_path) :
+            os.remove(meta_path)
+        write_volume(self._volume_path(patient_id), image, codec=self.codec, level=self.level)
+
+        entry = {"source_mtime": signature["source_mtime"],
+                 "source_size": signature["source_size"],
+                 "slices": None if slices is None else [int(s) for s in slices],
+                 "version": DECODED_VERSION}
+        with open(meta_path + ".tmp", "w") as f :
+            json.dump(entry, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+
+    def __contains__(self, patient_id) -> bool :
+        return os.path.exists(self._meta_path(patient_id))
+
+
+    def __repr__(self) :
+        return f"{self.__class__.__name__}({self.root}, codec={self.codec})"
@@ -0,0 +1,304 @@
+import os
+import json
+from collections import Counter
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+
+from data.preprocessing import get_dicom_path, read_dicom_image, read_dicom_threaded
+
+
+
+
+def _read_tag(reader: sitk.ImageFileReader, tag: str) -> Optional[str] :
+    return reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else None
+
+
+
+def _files_signature(paths: Sequence[str]) -> Tuple[float, int] :
+    """Return the latest modification time and the total size of some files."""
+    mtime, size = 0.0, 0
+    for path in paths :
+        stat = os.stat(path)
+        mtime, size = max(mtime, stat.st_mtime), size + stat.st_size
+    return mtime, size
+
+
+
+def scan_series(series_dir: str) -> Dict :
+    """ Read the headers (not the pixels) of every slice in a DICOM series
+    directory and return the sorted slice paths and the geometry of the volume.
+
+    If the directory contains several series, the one with the most slices is
+    used. Slices are sorted by their position along the slice normal, like
+    sitk.ImageSeriesReader.GetGDCMSeriesFileNames does.
+    """
+    slices = []
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("GDCMImageIO")
+    for name in os.listdir(series_dir) :
+        path = os.path.join(series_dir, name)
+        if not os.path.isfile(path) :
+            continue
+        reader.SetFileName(path)
+        try :
+            reader.ReadImageInformation()
+        except RuntimeError : # Not a DICOM file
+            continue
+        position = _read_tag(reader, "0020|0032")
+        if position is None :
+            continue
+        slices.append({"path": path,
+                       "series": _read_tag(reader, "0020|000e"),
+                       "position": [float(p) for p in position.split("\\")],
+                       "orientation": _read_tag(reader, "0020|0037"),
+                       "spacing": _read_tag(reader, "0028|0030"),
+                       "size": reader.GetSize()[:2]})
+    if len(slices) == 0 :
+        raise ValueError(f"No DICOM slices found in {series_dir}")
+
+    # Keep the largest series in the directory
+    series = Counter(s["series"] for s in slices).most_common(1)[0][0]
+    slices = [s for s in slices if s["series"] == series]
+
+    # Sort the slices along the normal to the slice plane
+    orientation = np.array([float(o) for o in slices[0]["orientation"].split("\\")])
+    row_dir, col_dir = orientation[:3], orientation[3:]
+    normal = np.cross(row_dir, col_dir)
+    positions = np.array([s["position"] for s in slices])
+    order = np.argsort(positions @ normal, kind="stable")
+    positions = positions[order]
+    z_positions = positions @ normal
+
+    # DICOM pixel spacing is (row spacing, column spacing), i.e. (y, x)
+    pixel_spacing = [float(p) for p in slices[0]["spacing"].split("\\")]
+    z_spacing = float(np.median(np.diff(z_positions))) if len(slices) > 1 else 1.0
+    direction = np.stack([row_dir, col_dir, normal], axis=1) # Axes as columns
+
+    files = [slices[i]["path"] for i in order]
+    files_mtime, files_size = _files_signature(files)
+    return {"series_dir": series_dir,
+            "dir_mtime": os.stat(series_dir).st_mtime,
+            "files": files,
+            "files_mtime": files_mtime,
+            "files_size": files_size,
+            "origin": positions[0].tolist(),
+            "spacing": [pixel_spacing[1], pixel_spacing[0], z_spacing],
+            "direction": direction.flatten().tolist(),
+            "size": [int(slices[0]["size"][0]), int(slices[0]["size"][1]), len(slices)],
+            "z_positions": z_positions.tolist()}
+
+
+
+def _scan_patient(task) :
+    patient_id, path = task
+    try :
+        if os.path.exists(path) and path.endswith(".DICOM") :
+            series_dir = path
+        else :
+            series_dir = get_dicom_path(path)
+            if series_dir is None :
+                raise FileNotFoundError(f"No .DICOM directory found in {path}")
+        return patient_id, scan_series(series_dir)
+    except Exception as e :
+        return patient_id, str(e)
+
+
+
+
+class DicomSeriesIndex :
+    """Persistent index of the DICOM series of every patient.
+
+    For each patient the index stores the sorted paths of the slices in the
+    series and the geometry of the volume (origin, spacing, direction, size and
+    the position of each slice along the slice normal). The index is built
+    from the slice headers only, in parallel, and saved as JSON. It is updated
+    incrementally: a patient is only rescanned if it is new, if the
+    modification time of its series directory changed (slices added, removed
+    or renamed) or if the latest modification time or total size of its
+    slices changed (a slice rewritten in place). Reading an image
+    through the index skips both the directory walk of `get_dicom_path` and the
+    header scan of `GetGDCMSeriesFileNames`.
+    """
+    def __init__(self, path: str) :
+        """ Initialize the index.
+
+        Parameters
+        ----------
+        path : str
+            Path to the index JSON file. It is created on the first save.
+        """
+        self.path = path
+        self.entries = {}
+        if os.path.exists(self.path) :
+            with open(self.path, "r") as f :
+                self.entries = json.load(f)
+
+
+    def __contains__(self, patient_id) -> bool :
+        return str(patient_id) in self.entries
+
+    def __getitem__(self, patient_id) -> Dict :
+        return self.entries[str(patient_id)]
+
+
+    def is_current(self, patient_id: str) -> bool :
+        """Whether the entry of a patient exists and neither its series
+        directory nor its slices have changed since it was scanned. Only the
+        files are stat'ed, their headers are not read again."""
+        entry = self.entries.get(str(patient_id))
+        if entry is None or "files_mtime" not in entry : # Indexed by an older version
+            return False
+        try :
+            return (os.stat(entry["series_dir"]).st_mtime == entry["dir_mtime"] and
+                    _files_signature(entry["files"]) == (entry["files_mtime"],
+                                                         entry["files_size"]))
+        except FileNotFoundError :
+            return False
+
+
+    def update(self, image_dir: str, patient_ids: Iterable[str],
+               num_workers: int = 1) -> List[str] :
+        """ Scan the series of the patients that are missing from the index or
+        whose series changed.
+
+        Parameters
+        ----------
+        image_dir : str
+            The directory containing one subdirectory per patient.
+        patient_ids : Iterable[str]
+            The patients to index.
+        num_workers : int
+            The number of parallel processes used to read the headers.
+
+        Returns
+        -------
+        List[str]
+            The IDs of the patients whose series could not be scanned.
+        """
+        tasks = [(str(id), os.path.join(image_dir, str(id))) for id in patient_ids
+                 if not self.is_current(id)]
+        if len(tasks) == 0 :
+            return []
+        print(f"Indexing {len(tasks)} DICOM series.")
+
+        if num_workers > 1 :
+            with Pool(processes=num_workers) as p :
+                results = list(p.imap_unordered(_scan_patient, tasks, chunksize=4))
+        else :
+            results = [_scan_patient(task) for task in tasks]
+
+        failed = []
+        for patient_id, entry in results :
+            if isinstance(entry, dict) :
+                self.entries[patient_id] = entry
+            else :
+                print(f"Could not index {patient_id}: {entry}")
+                self.entries.pop(patient_id, None)
+                failed.append(patient_id)
+        self.save()
+        return failed
+
+
+    def save(self) :
+        """Atomically write the index to disk."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f :
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+
+    def signature(self, patient_id: str) -> Dict :
+        """Return the signature of a patient's series for the cache manifest,
+        from the last scan: the latest modification time of the directory and
+        its slices, and the total size of the slices. Adding, removing,
+        renaming or rewriting slices changes it."""
+        entry = self.entries[str(patient_id)]
+        return {"source_mtime": max(entry["dir_mtime"], entry["files_mtime"]),
+                "source_size": entry["files_size"]}
+
+
+    @staticmethod
+    def _read_files(file_names: Sequence[str], pixel_type, n_threads: int) -> sitk.Image :
+        if n_threads > 1 :
+            return read_dicom_threaded(file_names, n_threads=n_threads, pixel_type=pixel_type)
+        return read_dicom_image(None, pixel_type=pixel_type, file_names=file_names)
+
+
+    def read_image(self, patient_id: str, pixel_type=sitk.sitkFloat32,
+                   n_threads: int = 1) -> sitk.Image :
+        """Read a patient's image using the indexed slice paths. If n_threads
+        is greater than 1, the slices are decoded concurrently."""
+        return self._read_files(self.entries[str(patient_id)]["files"],
+                                pixel_type, n_threads)
+
+
+    def read_slab(self, patient_id: str,
+                  half_extent: float,
+                  da_idx: Optional[int] = None,
+                  center_coords: Optional[Sequence[float]] = None,
+                  margin_slices: int = 2,
+                  pixel_type=sitk.sitkFloat32,
+                  n_threads: int = 1) -> sitk.Image :
+        """ Read only the slices of a patient's series within a distance of
+        the DA slice (or of a physical point) along the slice normal.
+
+        The slab is read with sitk.ImageSeriesReader from the indexed slice
+        paths, so its origin and spacing are set from the slices themselves and
+        physical/index conversions stay correct.
+
+        Parameters
+        ----------
+        patient_id : str
+            The patient whose image to read.
+        half_extent : float
+            Half the thickness of the slab in mm.
+        da_idx : int
+            The z-index of the DA slice in the full series. The slab is centred
+            on this slice.
+        center_coords : Sequence[float]
+            A physical (x, y, z) point on which to centre the slab instead.
+        margin_slices : int
+            The number of extra slices to read on each side of the slab, e.g.
+            for interpolation.
+        n_threads : int
+            If greater than 1, the slices are decoded concurrently.
+
+        Returns
+        -------
+        sitk.Image
+            The slab. At least 2 slices are always read.
+        """
+        first, last = self.slab_range(patient_id, half_extent, da_idx=da_idx,
+                                      center_coords=center_coords,
+                                      margin_slices=margin_slices)
+        files = self.entries[str(patient_id)]["files"][first : last + 1]
+        return self._read_files(files, pixel_type, n_threads)
+
+
+    def slab_range(self, patient_id: str,
+                   half_extent: float,
+                   da_idx: Optional[int] = None,
+                   center_coords: Optional[Sequence[float]] = None,
+                   margin_slices: int = 2) -> Tuple[int, int] :
+        """Return the z-index of the first and last slices of the slab read
+        by `read_slab` with the same arguments."""
+        entry = self.entries[str(patient_id)]
+        z_positions = np.array(entry["z_positions"])
+        if center_coords is not None :
+            normal = np.array(entry["direction"]).reshape(3, 3)[:, 2]
+            z_centre = float(np.dot(center_coords, normal))
+        else :
+            z_centre = z_positions[int(da_idx)]
+
+        inside = np.flatnonzero(np.abs(z_positions - z_centre) <= half_extent)
+        if len(inside) == 0 : # Slab thinner than the slice spacing
+            inside = [int(np.argmin(np.abs(z_positions - z_centre)))]
+        first = max(int(inside[0]) - margin_slices, 0)
+        last  = min(int(inside[-1]) + margin_slices, len(z_positions) - 1)
+        if last == first : # ImageSeriesReader needs 2 slices for the spacing
+            first, last = max(first - 1, 0), min(last + 1, len(z_positions) - 1)
+        return first, last
@@ -0,0 +1,172 @@
+import ctypes
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from typing import Optional, Sequence
+
+
+
+
+class PatientMetadata :
+    """Per-patient metadata of a dataset in contiguous shared arrays.
+
+    The DA slice, DA z-index and crop centre of every patient are stored in
+    numpy arrays backed by shared memory, one row per patient, with the
+    patient IDs as a sorted fixed-width byte array (the ID to row index,
+    searched with np.searchsorted). There is no Python object per patient, so
+    passing the metadata to the DataLoader workers neither pickles a data frame
+    nor copies pages when the workers read it, and a lookup costs a binary
+    search instead of a pandas `.at`.
+
+    The shared arrays are passed to workers by inheritance, like
+    SharedVolumeCache. Values set in one process after the workers started
+    (e.g. with set_centres) are seen by all of them.
+    """
+    def __init__(self, patient_ids: Sequence[str],
+                 da_slice: Optional[Sequence[int]] = None,
+                 da_z: Optional[Sequence[int]] = None,
+                 centres: Optional[np.ndarray] = None) :
+        """ Initialize the metadata.
+
+        Parameters
+        ----------
+        patient_ids : Sequence[str]
+            The ID of every patient. If an ID is repeated (e.g. in both domains
+            of a dataset), its first row is used by the lookups.
+        da_slice : Sequence[int]
+            The z-index of the DA slice of every patient. Missing values (NaN
+            or None) are stored as -1. If None, -1.
+        da_z : Sequence[int]
+            The DA z-index in the other slice numbering ('DA_z'). If None, -1.
+        centres : np.ndarray
+            The (n, 3) physical (x, y, z) crop centres. If None, NaN until set
+            with set_centres.
+        """
+        ids = np.array([str(id).encode() for id in patient_ids], dtype=bytes)
+        self.n = len(ids)
+        self.id_width = max(ids.dtype.itemsize, 1)
+
+        n = max(self.n, 1) # Empty buffers can't be viewed
+        self._raw_ids    = mp.RawArray(ctypes.c_char, n * self.id_width)
+        self._raw_order  = mp.RawArray(ctypes.c_int64, n) # Row of each sorted ID
+        self._raw_ints   = mp.RawArray(ctypes.c_int64, n * 2) # DA slice, DA z
+        self._raw_centre = mp.RawArray(ctypes.c_double, n * 3)
+        self._views()
+
+        order = np.argsort(ids, kind="stable") # First row of repeated IDs first
+        self._sorted_ids[:] = ids[order]
+        self._order[:] = order
+        self._ints[:, 0] = _to_int(da_slice, self.n)
+        self._ints[:, 1] = _to_int(da_z, self.n)
+        self._centres[:] = np.nan if centres is None else np.asarray(centres, dtype=np.float64)
+
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, da_slice_col: str = "a_slice",
+                   da_z_col: str = "DA_z") -> "PatientMetadata" :
+        """Create the metadata of the patients of a data frame indexed by
+        patient ID. Missing columns are left unknown. The crop centres are
+        read from the img_center_* columns if there are any."""
+        columns = ["img_center_x", "img_center_y", "img_center_z"]
+        centres = None
+        if all(c in df.columns for c in columns) :
+            centres = df[columns].astype(np.float64).to_numpy()
+        return cls(df.index, df[da_slice_col] if da_slice_col in df.columns else None,
+                   df[da_z_col] if da_z_col in df.columns else None, centres)
+
+
+    def _views(self) :
+        """Create numpy views of the shared arrays in this process."""
+        n = self.n
+        self._sorted_ids = np.frombuffer(self._raw_ids, dtype=f"S{self.id_width}")[:n]
+        self._order   = np.frombuffer(self._raw_order, dtype=np.int64)[:n]
+        self._ints    = np.frombuffer(self._raw_ints, dtype=np.int64)[: 2 * n].reshape(n, 2)
+        self._centres = np.frombuffer(self._raw_centre, dtype=np.float64)[: 3 * n].reshape(n, 3)
+
+
+    def __getstate__(self) :
+        state = self.__dict__.copy()
+        for name in ["_sorted_ids", "_order", "_ints", "_centres"] :
+            del state[name]
+        return state
+
+    def __setstate__(self, state) :
+        self.__dict__.update(state)
+        self._views()
+
+
+    def _find(self, patient_id) -> int :
+        """Return the row of a patient, or -1."""
+        key = str(patient_id).encode()
+        if len(key) > self.id_width :
+            return -1
+        i = np.searchsorted(self._sorted_ids, key)
+        if i < self.n and self._sorted_ids[i] == key :
+            return int(self._order[i])
+        return -1
+
+
+    def row(self, patient_id: str) -> int :
+        """Return the row of a patient in the arrays."""
+        row = self._find(patient_id)
+        if row < 0 :
+            raise KeyError(patient_id)
+        return row
+
+
+    def rows(self, patient_ids: Sequence[str]) -> np.ndarray :
+        """Return the rows of several patients at once."""
+        keys = np.array([str(id).encode() for id in patient_ids], dtype=bytes)
+        i = np.clip(np.searchsorted(self._sorted_ids, keys), 0, max(self.n - 1, 0))
+        missing = (self.n == 0) | (self._sorted_ids[i] != keys)
+        if np.any(missing) :
+            raise KeyError(list(np.asarray(patient_ids)[missing][:5]))
+        return self._order[i]
+
+
+    def da_slice(self, patient_id: str) -> int :
+        """Return the z-index of the DA slice of a patient (-1 if unknown)."""
+        return int(self._ints[self.row(patient_id), 0])
+
+
+    def da_z(self, patient_id: str) -> int :
+        return int(self._ints[self.row(patient_id), 1])
+
+
+    def centre(self, patient_id: str) -> np.ndarray :
+        """Return the physical (x, y, z) crop centre of a patient."""
+        return self._centres[self.row(patient_id)].copy()
+
+
+    def set_centres(self, patient_ids: Sequence[str], centres: np.ndarray) :
+        """Set the crop centres of some patients."""
+        self._centres[self.rows(patient_ids)] = np.asarray(centres, dtype=np.float64)
+
+
+    @property
+    def ids(self) -> np.ndarray :
+        """The patient IDs in row order."""
+        ids = np.empty(self.n, dtype=self._sorted_ids.dtype)
+        ids[self._order] = self._sorted_ids
+        return ids.astype(str)
+
+
+    def __contains__(self, patient_id) :
+        return self._find(patient_id) >= 0
+
+
+    def __len__(self) :
+        return self.n
+
+
+    def __repr__(self) :
+        return f"{self.__class__.__name__}({self.n} patients)"
+
+
+
+def _to_int(values, n: int) -> np.ndarray :
+    """Convert a column with possibly missing values to int64, with -1 for
+    missing values."""
+    if values is None :
+        return np.full(n, -1, dtype=np.int64)
+    return np.array([-1 if pd.isna(v) else int(v) for v in values], dtype=np.int64)
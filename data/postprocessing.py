@@ -2,11 +2,12 @@ import io
 import os
 import numpy as np
 import torch
-from typing import Union, Sequence
+from typing import Optional, Union, Sequence
 
 import SimpleITK as sitk
 
 from data.preprocessing import resample_image, read_dicom_image, read_nrrd_image
+from data.dicom_index import DicomSeriesIndex
 
 
 
@@ -21,7 +22,11 @@ class PostProcessor :
                  input_spacing: Sequence = [1.0, 1.0, 1.0],
                  output_spacing: Union[Sequence, str] = "orig",
                  input_file_type: str = "dicom",
-                 output_file_type: str = "nrrd"):
+                 output_file_type: str = "nrrd",
+                 dicom_index: Optional[str] = None,
+                 output_codec: str = "raw",
+                 patient_ids: Optional[Sequence[str]] = None,
+                 num_workers: int = 1):
         """ Initialize the class
         Parameters
         ----------
@@ -39,6 +44,19 @@ class PostProcessor :
             The file type of the original images. Can be 'dicom' or 'nrrd'.
         output_file_type (str)
             The file type to save the output files. Can be 'DICOM' or 'nrrd'.
+        dicom_index (str)
+            Path to a DICOM series index (see data.dicom_index) used to find the
+            slices of the original images. If None, the series directories are
+            scanned every time.
+        output_codec (str)
+            The compression of the output files. Can be 'raw' or 'gzip'.
+        patient_ids (Sequence[str])
+            The patients that will be processed. Those missing from the DICOM
+            index, or whose series changed, are indexed once here (see
+            index_patients). Patients that are not indexed are read by
+            scanning their series directory.
+        num_workers (int)
+            The number of parallel processes used to index the patients.
         """
         self.input_dir = input_dir
         self.output_dir = output_dir
@@ -46,6 +64,10 @@ class PostProcessor :
         self.output_spacing =  output_spacing
         self.input_file_type = input_file_type
         self.output_file_type = output_file_type
+        if output_codec not in ["raw", "gzip"] :
+            raise ValueError(f"output_codec {output_codec} not accepted. NRRD "
+                             "files can only be 'raw' or 'gzip'.")
+        self.use_compression = output_codec == "gzip"
 
         # Get the correct function to with which to load images
         if self.input_file_type == 'nrrd' :
@@ -54,6 +76,11 @@ class PostProcessor :
         elif self.input_file_type == 'dicom' :
             self.read_original_img = read_dicom_image
             self.input_suffix = "" # Assume file is in directory named patientID
+            self.dicom_index = None
+            if dicom_index is not None :
+                self.dicom_index = DicomSeriesIndex(dicom_index)
+                if patient_ids is not None :
+                    self.index_patients(patient_ids, num_workers)
         else :
             raise NotImplementedError("input_file_type must be 'dicom' or 'nrrd'.")
 
@@ -68,6 +95,15 @@ class PostProcessor :
 
 
 
+    def index_patients(self, patient_ids: Sequence[str], num_workers: int = 1) :
+        """ Add the patients missing from the DICOM index, or whose series
+        changed, to the index in one pass. Patients that can't be indexed are
+        read by scanning their series directory instead.
+        """
+        self.dicom_index.update(self.input_dir, patient_ids, num_workers=num_workers)
+
+
+
     def __call__(self, model_output: torch.Tensor, patient_id: str, img_centre: Sequence) :
         """ Process a single image from the output of a deep learning generator.
         Convert the image to an SITK image, combine it with the original
@@ -96,7 +132,11 @@ class PostProcessor :
 
         # Load original (uncorrected) image
         orig_path = os.path.join(self.input_dir, f"{patient_id}{self.input_suffix}")
-        full_img = self.read_original_img(orig_path)
+        if (self.input_file_type == 'dicom' and self.dicom_index is not None and
+                patient_id in self.dicom_index) :
+            full_img = self.dicom_index.read_image(patient_id)
+        else :
+            full_img = self.read_original_img(orig_path)
         orig_spacing = full_img.GetSpacing()
         full_img = sitk.Clamp(full_img, lowerBound=-1000.0, upperBound=1000.0)
 
@@ -121,4 +161,5 @@ class PostProcessor :
 
         # Save the image
         file_name = f"{patient_id}.{self.output_file_type}"
-        self.save_output_img(full_img, os.path.join(self.output_dir, file_name))
+        self.save_output_img(full_img, os.path.join(self.output_dir, file_name),
+                             self.use_compression)
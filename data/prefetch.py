@@ -0,0 +1,178 @@
+import time
+import queue
+import threading
+from typing import Callable, Dict, Iterable, Union
+
+import torch
+
+
+
+
+def _to_device(batch, device: torch.device, non_blocking: bool = False) :
+    """Move the tensors of a batch (tensor, tuple, list or dict) to a device."""
+    if torch.is_tensor(batch) :
+        return batch.to(device, non_blocking=non_blocking)
+    elif isinstance(batch, (tuple, list)) :
+        return type(batch)(_to_device(b, device, non_blocking) for b in batch)
+    elif isinstance(batch, dict) :
+        return {k: _to_device(v, device, non_blocking) for k, v in batch.items()}
+    return batch
+
+
+
+def _record_stream(batch, stream) :
+    """Tell the caching allocator that the tensors of a batch are used on a
+    stream, so their memory is not reused before the stream is done with it."""
+    if torch.is_tensor(batch) :
+        batch.record_stream(stream)
+    elif isinstance(batch, (tuple, list)) :
+        for b in batch :
+            _record_stream(b, stream)
+    elif isinstance(batch, dict) :
+        for b in batch.values() :
+            _record_stream(b, stream)
+
+
+
+
+class DevicePrefetcher :
+    """Iterate over a DataLoader while the next batch is staged ahead of time.
+
+    With a CUDA device, the next batch is copied to the device with a
+    non-blocking copy on a side stream while the current training step runs,
+    and the step's stream waits for the copy only when it uses the batch. The
+    batches should come from pinned memory (pin_memory=True) for the copy to
+    be asynchronous. On CPU, there is no copy to overlap and pinned memory
+    needs CUDA, so the next batch is fetched by a background thread instead
+    (double buffering), which overlaps loading in the main process
+    (num_workers=0) with the step.
+
+    The time the training loop spends waiting for each batch is recorded. If
+    the data wait time is a large fraction of the total time, training is
+    input-bound.
+    """
+    def __init__(self, loader: Iterable,
+                 device: Union[torch.device, str, Callable, None] = None) :
+        """ Initialize the prefetcher.
+
+        Parameters
+        ----------
+        loader : Iterable
+            The DataLoader to iterate over.
+        device : torch.device, str or Callable
+            The device to move the batches to. A callable is called at the
+            start of every epoch, e.g. to use the device of a model that is
+            moved after the prefetcher is created. If None, the current CUDA
+            device is used if there is one, otherwise the CPU.
+        """
+        self.loader = loader
+        self.device = device
+        self.reset_stats()
+
+
+    def _get_device(self) -> torch.device :
+        device = self.device() if callable(self.device) else self.device
+        if device is None :
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        return torch.device(device)
+
+
+    def reset_stats(self) :
+        """Reset the data wait counters."""
+        self.n_batches = 0
+        self.wait_time = 0.0  # Seconds the loop waited for batches
+        self.total_time = 0.0 # Seconds from the first request to the last batch,
+                              # not counting the step after the last batch
+
+
+    def stats(self) -> Dict[str, float] :
+        """Return the number of batches, the data wait and total time in
+        seconds, and the fraction of the time spent waiting for data."""
+        return {"batches": self.n_batches,
+                "data_wait_s": self.wait_time,
+                "total_s": self.total_time,
+                "data_wait_fraction": self.wait_time / max(self.total_time, 1e-12)}
+
+
+    def __len__(self) :
+        return len(self.loader)
+
+
+    def __iter__(self) :
+        device = self._get_device()
+        if device.type == "cuda" :
+            batches = self._iter_cuda(device)
+        else :
+            batches = self._iter_thread(device)
+
+        t_last = time.perf_counter() # When the previous batch was handed over
+        while True :
+            t0 = time.perf_counter()
+            try :
+                batch = next(batches)
+            except StopIteration :
+                return
+            now = time.perf_counter()
+            self.wait_time += now - t0
+            self.total_time += now - t_last # The previous step and this wait
+            t_last = now
+            self.n_batches += 1
+            yield batch
+
+
+    def _iter_cuda(self, device: torch.device) :
+        stream = torch.cuda.Stream(device=device)
+        loader = iter(self.loader)
+
+        def stage() :
+            batch = next(loader, None)
+            if batch is not None :
+                with torch.cuda.stream(stream) :
+                    batch = _to_device(batch, device, non_blocking=True)
+            return batch
+
+        next_batch = stage()
+        while next_batch is not None :
+            current = torch.cuda.current_stream(device)
+            current.wait_stream(stream) # The copy must be done before the step uses it
+            _record_stream(next_batch, current)
+            batch, next_batch = next_batch, stage()
+            yield batch
+
+
+    def _iter_thread(self, device: torch.device) :
+        buffer = queue.Queue(maxsize=1) # One batch staged while the step runs
+        done, stop = object(), threading.Event()
+
+        def put(item) -> bool :
+            """Wait for a free slot unless the loop stopped."""
+            while not stop.is_set() :
+                try :
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full :
+                    continue
+            return False
+
+        def fetch() :
+            try :
+                for batch in self.loader :
+                    if not put(_to_device(batch, device)) :
+                        return
+                put(done)
+            except Exception as e : # Raised again in the training loop
+                put(e)
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        try :
+            while True :
+                batch = buffer.get()
+                if batch is done :
+                    return
+                if isinstance(batch, Exception) :
+                    raise batch
+                yield batch
+        finally : # Also when the loop stops early
+            stop.set()
+            thread.join()
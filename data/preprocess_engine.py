@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import time
+import traceback
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+
+
+
+def _call_task(fn_task: Tuple[Callable, Tuple[Hashable, Any]]) :
+    """Run one task in a worker. Exceptions are returned instead of raised so a
+    single bad image does not stop the whole run."""
+    fn, (key, payload) = fn_task
+    try :
+        return key, True, fn(payload)
+    except Exception :
+        return key, False, traceback.format_exc()
+
+
+
+def _format_time(seconds: float) -> str :
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+
+
+
+def run_preprocessing(fn: Callable,
+                      tasks: Sequence[Tuple[Hashable, Any]],
+                      num_workers: int = 1,
+                      initializer: Optional[Callable] = None,
+                      initargs: Tuple = (),
+                      on_result: Optional[Callable] = None,
+                      checkpoint: Optional[Callable] = None,
+                      checkpoint_every: int = 20,
+                      report_every: float = 30.0,
+                      error_path: Optional[str] = None) -> Dict[Hashable, str] :
+    """ Run preprocessing tasks in parallel, streaming the results back as
+    they complete.
+
+    Parameters
+    ----------
+    fn : Callable
+        A module-level function called as fn(payload) in the worker processes.
+        Keep the payloads small: they are pickled for every task.
+    tasks : Sequence[Tuple[Hashable, Any]]
+        A list of (key, payload) tuples, e.g. (patient_id, (path, da_slice)).
+    num_workers : int
+        The number of worker processes. If 1, run in this process.
+    initializer, initargs
+        Called as initializer(*initargs) once in every worker. Use this to send
+        the configuration shared by all tasks only once per worker.
+    on_result : Callable
+        Called as on_result(key, result) in the main process for every task
+        that succeeded, in order of completion.
+    checkpoint : Callable
+        Called every `checkpoint_every` successful tasks and at the end, e.g.
+        to save a cache manifest so that an interrupted run can resume.
+    report_every : float
+        The number of seconds between progress reports.
+    error_path : str
+        If given, the tracebacks of failed tasks are written to this JSON file.
+
+    Returns
+    -------
+    Dict[Hashable, str]
+        The traceback of every failed task, indexed by key.
+    """
+    n_tasks = len(tasks)
+    errors = {}
+    n_done, n_since_checkpoint = 0, 0
+    t_start = t_report = time.time()
+
+    def handle(key, ok, result) :
+        nonlocal n_done, n_since_checkpoint, t_report
+        n_done += 1
+        if ok :
+            if on_result is not None :
+                on_result(key, result)
+            n_since_checkpoint += 1
+            if checkpoint is not None and n_since_checkpoint >= checkpoint_every :
+                checkpoint()
+                n_since_checkpoint = 0
+        else :
+            errors[key] = result
+            print(f"Preprocessing {key} failed:\n{result}", file=sys.stderr)
+
+        now = time.time()
+        if now - t_report >= report_every or n_done == n_tasks :
+            rate = n_done / max(now - t_start, 1e-9)
+            eta = (n_tasks - n_done) / rate if rate > 0 else 0.0
+            print(f"Preprocessed {n_done}/{n_tasks} ({len(errors)} failed), "
+                  f"{rate:.2f} tasks/s, elapsed {_format_time(now - t_start)}, "
+                  f"ETA {_format_time(eta)}")
+            t_report = now
+
+    fn_tasks = [(fn, task) for task in tasks]
+    if num_workers > 1 :
+        chunksize = max(1, min(8, n_tasks // (num_workers * 4)))
+        with Pool(processes=num_workers, initializer=initializer, initargs=initargs) as p :
+            for key, ok, result in p.imap_unordered(_call_task, fn_tasks, chunksize) :
+                handle(key, ok, result)
+    else :
+        if initializer is not None :
+            initializer(*initargs)
+        for fn_task in fn_tasks :
+            handle(*_call_task(fn_task))
+
+    if checkpoint is not None :
+        checkpoint()
+
+    if error_path is not None :
+        if len(errors) > 0 :
+            with open(error_path, "w") as f :
+                json.dump({str(k): v for k, v in errors.items()}, f, indent=4)
+            print(f"{len(errors)} of {n_tasks} tasks failed. See {error_path}")
+        elif os.path.exists(error_path) :
+            os.remove(error_path) # Errors from a previous run are now fixed
+
+    return errors
@@ -1,10 +1,13 @@
 import io
 import os
 import numpy as np
-from typing import Callable, Optional, Union, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Union, Sequence, Tuple
 
 import SimpleITK as sitk
 from skimage.transform import resize
+from skimage.filters import threshold_otsu
+from scipy import ndimage
 
 
 def get_dicom_path(path) :
@@ -17,22 +20,76 @@ def get_dicom_path(path) :
 
 
 
-def read_dicom_image(path, pixel_type=sitk.sitkFloat32) :
+def read_dicom_image(path, pixel_type=sitk.sitkFloat32, file_names=None) :
     """Return SITK image given the path to a directory containing
-    a dicom series"""
-    if os.path.exists(path) and path.endswith(".DICOM") :
-        dicom_path = path
-    else :
-        dicom_path = get_dicom_path(path)
+    a dicom series. If the sorted slice paths are already known (e.g. from a
+    data.dicom_index.DicomSeriesIndex), pass them as file_names to skip
+    searching and scanning the directory."""
     reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(dicom_path)
-    reader.SetFileNames(dicom_names)
+    if file_names is None :
+        if os.path.exists(path) and path.endswith(".DICOM") :
+            dicom_path = path
+        else :
+            dicom_path = get_dicom_path(path)
+        file_names = reader.GetGDCMSeriesFileNames(dicom_path)
+    reader.SetFileNames(file_names)
     image = reader.Execute()
     image = sitk.Cast(image, pixel_type) # Change image pixel type
 
     return image
 
 
+def read_dicom_threaded(file_names: Sequence[str], n_threads: int = 4,
+                        pixel_type=sitk.sitkFloat32) -> sitk.Image :
+    """ Read a DICOM series by decoding its slices concurrently.
+
+    Each slice is decoded in a bounded thread pool (SimpleITK releases the GIL
+    while reading) and copied straight into a preallocated volume buffer.
+
+    Parameters
+    ----------
+    file_names
+        The paths to the slices, sorted along the slice normal (e.g. from a
+        data.dicom_index.DicomSeriesIndex).
+    n_threads
+        The number of decoding threads.
+    pixel_type
+        The pixel type of the returned image. Only float types are accepted.
+
+    Returns
+    -------
+    sitk.Image
+        The volume, with the same geometry as read by sitk.ImageSeriesReader.
+    """
+    np_types = {sitk.sitkFloat32: np.float32, sitk.sitkFloat64: np.float64}
+    first = sitk.ReadImage(file_names[0], pixel_type)
+    cols, rows = first.GetSize()[:2]
+    volume = np.empty((len(file_names), rows, cols), dtype=np_types[pixel_type])
+    volume[0] = sitk.GetArrayViewFromImage(first)[0]
+    origins = np.empty((len(file_names), 3))
+    origins[0] = first.GetOrigin()
+
+    def read_slice(i) :
+        image = sitk.ReadImage(file_names[i], pixel_type)
+        volume[i] = sitk.GetArrayViewFromImage(image)[0]
+        origins[i] = image.GetOrigin()
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor :
+        list(executor.map(read_slice, range(1, len(file_names))))
+
+    image = sitk.GetImageFromArray(volume)
+    direction = np.array(first.GetDirection()).reshape(3, 3)
+    spacing = list(first.GetSpacing())
+    if len(file_names) > 1 : # Distance between slices along the normal
+        spacing[2] = float(np.dot(origins[-1] - origins[0], direction[:, 2])
+                           / (len(file_names) - 1))
+    image.SetOrigin(first.GetOrigin())
+    image.SetSpacing(spacing)
+    image.SetDirection(first.GetDirection())
+    return image
+
+
+
 def read_nrrd_image(path, pixel_type=sitk.sitkFloat32) :
     """Return SITK image given the path to an NRRD file."""
     image = sitk.ReadImage(path)
@@ -48,7 +105,8 @@ def resample_image(image: sitk.Image,
              anti_alias: bool = True,
              anti_alias_sigma: Optional[float] = None,
              transform: Optional[sitk.Transform] = None,
-             output_size: Optional[Sequence[float]] = None) -> sitk.Image:
+             output_size: Optional[Sequence[float]] = None,
+             output_origin: Optional[Sequence[float]] = None) -> sitk.Image:
     """Resample image to a given spacing, optionally applying a transformation.
 
     Parameters
@@ -85,6 +143,10 @@ def resample_image(image: sitk.Image,
         Size of the output image. If None, it is computed to preserve the
         whole extent of the input image.
 
+    output_origin, optional
+        Origin of the output image. If None, the origin of the input image is
+        used.
+
     Returns
     -------
     sitk.Image
@@ -114,12 +176,12 @@ def resample_image(image: sitk.Image,
         new_spacing = np.where(spacing == 0, original_spacing, spacing)
 
     if not output_size:
-        new_size = np.floor(original_size * original_spacing / new_spacing).astype(np.int)
+        new_size = np.floor(original_size * original_spacing / new_spacing).astype(int)
     else:
         new_size = np.asarray(output_size)
 
     rif = sitk.ResampleImageFilter()
-    rif.SetOutputOrigin(image.GetOrigin())
+    rif.SetOutputOrigin(image.GetOrigin() if output_origin is None else output_origin)
     rif.SetOutputSpacing(new_spacing)
     rif.SetOutputDirection(image.GetDirection())
     rif.SetSize(new_size.tolist())
@@ -140,3 +202,172 @@ def resample_image(image: sitk.Image,
     resampled_image = rif.Execute(image)
 
     return resampled_image
+
+
+
+
+def resample_region(image: sitk.Image,
+                    spacing: Union[Sequence[float], np.ndarray],
+                    output_origin: Sequence[float],
+                    output_size: Sequence[int],
+                    interpolation: str = "linear",
+                    anti_alias: bool = True) -> sitk.Image :
+    """Resample only a region of an image.
+
+    Equivalent to resampling the whole image with `resample_image` and then
+    cropping the region out of the result, but only the input voxels around the
+    region (plus a margin for anti-aliasing and interpolation) are smoothed
+    and interpolated.
+
+    Parameters
+    ----------
+    image
+        The image to be resampled.
+    spacing
+        The new image spacing [x, y, z].
+    output_origin
+        The physical location of the first voxel of the region.
+    output_size
+        The size of the region in voxels [x, y, z].
+    interpolation, anti_alias
+        See `resample_image`.
+
+    Returns
+    -------
+    sitk.Image
+        The resampled region.
+    """
+    spacing = np.asarray(spacing, dtype=np.float64)
+    output_size = np.asarray(output_size, dtype=np.int64)
+    in_spacing, in_size = np.array(image.GetSpacing()), np.array(image.GetSize())
+
+    # Output grid with the same geometry as the resampled image
+    grid = _geometry_grid(output_origin, spacing, image.GetDirection())
+
+    # Input continuous indices of the corners of the region
+    corners = [grid.TransformContinuousIndexToPhysicalPoint(
+                    ((output_size - 1) * np.array(c)).astype(np.float64).tolist())
+               for c in np.ndindex(2, 2, 2)]
+    corners = np.array([image.TransformPhysicalPointToContinuousIndex(c) for c in corners])
+
+    # Pad by 4 sigma of the anti-aliasing kernel and 2 voxels for interpolation
+    sigma = np.maximum(1e-11, (in_spacing / spacing - 1) / 2)
+    pad = np.ceil(4 * sigma / in_spacing).astype(np.int64) + 2
+    _min = np.clip(np.floor(corners.min(axis=0)).astype(np.int64) - pad, 0, in_size)
+    _max = np.clip(np.ceil(corners.max(axis=0)).astype(np.int64) + pad + 1, 0, in_size)
+    roi = image[int(_min[0]) : int(_max[0]),
+                int(_min[1]) : int(_max[1]),
+                int(_min[2]) : int(_max[2])]
+
+    return resample_image(roi, spacing, interpolation=interpolation,
+                          anti_alias=anti_alias, output_size=output_size.tolist(),
+                          output_origin=output_origin)
+
+
+
+def _geometry_grid(origin, spacing, direction) -> sitk.Image :
+    """Return a 1-voxel image with the given geometry. It can be used to
+    convert between indices and physical points of a grid of any size."""
+    grid = sitk.Image([1, 1, 1], sitk.sitkUInt8)
+    grid.SetOrigin([float(o) for o in origin])
+    grid.SetSpacing([float(s) for s in spacing])
+    grid.SetDirection([float(d) for d in direction])
+    return grid
+
+
+
+def find_head_centre(slice: np.ndarray) -> Tuple[int, int] :
+    """Return the (y, x) index of the centre of the head in an axial slice."""
+    t = threshold_otsu(np.clip(slice, -1000, 1000))
+    slice = np.array(slice > t, dtype=int)
+    com  = ndimage.measurements.center_of_mass(slice)
+    return int(com[0]) - 25, int(com[1])
+
+
+
+def crop_subvolume(image: sitk.Image,
+                   da_idx: int,
+                   size: np.ndarray,
+                   spacing: np.ndarray,
+                   center_coords: Optional[Sequence[float]] = None,
+                   crop_first: bool = False,
+                   geometry: Optional[dict] = None) -> Tuple[sitk.Image, Tuple[float, float, float]] :
+    """Resample an image to a new spacing and crop a subvolume around the
+    dental artifact.
+
+    Parameters
+    ----------
+    image
+        The full image in its original spacing, or a slab of it (see geometry).
+    da_idx
+        The z-index of the slice containing the DA in the original image.
+    size
+        The size of the subvolume [x, y, z].
+    spacing
+        The voxel spacing of the subvolume [x, y, z].
+    center_coords
+        The physical location of the centre of the crop. If None, the crop is
+        centred on the head in the DA slice.
+    crop_first
+        If False, the whole image is resampled before the subvolume is cropped.
+        If True, only the DA slice is resampled to locate the head, then only
+        the subvolume (and a small margin) is resampled. Both give the same
+        result up to interpolation at the image border.
+    geometry
+        If image is only a slab of the full image (e.g. read with
+        DicomSeriesIndex.read_slab), a dict with the 'origin', 'spacing',
+        'direction' and 'size' of the full image. The crop is then made on the
+        same grid as for the full image. Implies crop_first.
+
+    Returns
+    -------
+    Tuple[sitk.Image, Tuple[float, float, float]]
+        The subvolume and the physical location of its centre.
+    """
+    if geometry is None :
+        geometry = {"origin": image.GetOrigin(), "spacing": image.GetSpacing(),
+                    "direction": image.GetDirection(), "size": image.GetSize()}
+    else :
+        crop_first = True
+    full = _geometry_grid(geometry["origin"], geometry["spacing"], geometry["direction"])
+    da_coords = full.TransformIndexToPhysicalPoint([150, 150, int(da_idx)])
+
+    if crop_first :
+        # Geometry of the resampled image, without computing its pixels
+        new_size = np.floor(np.array(geometry["size"]) * np.array(geometry["spacing"])
+                            / spacing).astype(np.int64)
+        grid = _geometry_grid(geometry["origin"], spacing.tolist(), geometry["direction"])
+    else :
+        # Resample image and DA slice to desired voxel spacing
+        image = resample_image(image, spacing.tolist())
+        grid = image
+
+    ### Cropping ###
+    if center_coords is None :
+        da_z = grid.TransformPhysicalPointToIndex(da_coords)[2] # DA z-index
+        # Get the center of the head in the DA slice
+        if crop_first :
+            origin = grid.TransformIndexToPhysicalPoint((0, 0, da_z))
+            slice = resample_region(image, spacing, origin,
+                                    [int(new_size[0]), int(new_size[1]), 1])[:, :, 0]
+        else :
+            slice = image[:, :, da_z]
+        y, x = find_head_centre(sitk.GetArrayFromImage(slice))
+    else :
+        x, y, da_z = grid.TransformPhysicalPointToIndex(center_coords)
+
+    crop_center = np.array([x, y, da_z])
+
+    # Crop to required size around this point
+    _min = np.floor(crop_center - size / 2).astype(np.int64)
+    _max = np.floor(crop_center + size / 2).astype(np.int64)
+    if crop_first :
+        origin = grid.TransformIndexToPhysicalPoint(_min.tolist())
+        subvol = resample_region(image, spacing, origin, (_max - _min).tolist())
+    else :
+        subvol = image[_min[0] : _max[0], _min[1] : _max[1], _min[2] : _max[2]]
+    ### --------- ###
+
+    # Save the location of the center of the image
+    coords = grid.TransformIndexToPhysicalPoint((int(x), int(y), int(da_z)))
+    return subvol, (float(coords[0]), float(coords[1]), float(coords[2]))
@@ -0,0 +1,357 @@
+import os
+import json
+import time
+import numpy as np
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import SimpleITK as sitk
+from torch.utils.data import IterableDataset, get_worker_info
+
+from data.volume_codecs import check_codec, encode, decode
+
+
+# Increment this whenever the shard layout changes. Shards written by an older
+# version are rewritten.
+SHARD_VERSION = 1
+
+# Shard file layout: magic, then the encoded records one after the other
+MAGIC = b"DASHARD1\n"
+
+DOMAINS = ["x", "y"]
+
+# Shards are read sequentially in large blocks, then split into records
+READ_BUFFER_BYTES = 16 * 2**20
+
+
+
+
+def write_shards(dataset, out_dir: str, shard_bytes: int = 256 * 2**20,
+                 codec: str = "raw", level: Optional[int] = None, seed: int = 0) -> Dict :
+    """ Pack the cached images of a dataset into a few large shard files.
+
+    The images of each domain are shuffled once and written one after the
+    other into shards of about shard_bytes, so a shard holds patients from all
+    over the cohort. Every image is stored with its geometry, crop centre and
+    DA slice, and the cache manifest entry it was made from. Any previous
+    index of the shards (`shards.json`) is removed first and the new one is
+    written last, so an interrupted run leaves no index and is started again.
+
+    Parameters
+    ----------
+    dataset : BaseDataset
+        The dataset whose cached images (the whole cached slabs) to pack.
+    out_dir : str
+        The directory in which to write the shards and the index.
+    shard_bytes : int
+        The size of the encoded images in each shard.
+    codec : str
+        The compression of the images: 'raw', 'gzip', 'zstd' or 'lz4'.
+    level : int
+        The compression level. If None, the codec's default is used.
+    seed : int
+        The seed of the order of the images in the shards.
+
+    Returns
+    -------
+    Dict
+        The index of the shards.
+    """
+    check_codec(codec)
+    os.makedirs(out_dir, exist_ok=True)
+    # Shard files are rewritten in place, so the old index must go first
+    index_path = os.path.join(out_dir, "shards.json")
+    if os.path.exists(index_path) :
+        os.remove(index_path)
+    t0 = time.perf_counter()
+    rng = np.random.RandomState(seed)
+    index = {"version": SHARD_VERSION, "codec": codec,
+             "shape": [int(s) for s in dataset.cache_size[::-1]], "dtype": "float32",
+             "spacing": [float(s) for s in dataset.img_spacing],
+             "cache_dir": os.path.abspath(dataset.cache_dir), "domains": {}}
+
+    for domain, ids in zip(DOMAINS, [dataset.x_ids, dataset.y_ids]) :
+        shards, f = [], None
+        for patient_id in rng.permutation(np.asarray(ids, dtype=str)) :
+            image = dataset._read_cached_file(patient_id)
+            array = sitk.GetArrayViewFromImage(image).astype(np.float32, copy=False)
+            payload = encode(np.ascontiguousarray(array).tobytes(), codec, level)
+            if f is None or f.tell() + len(payload) > shard_bytes + len(MAGIC) :
+                if f is not None :
+                    f.close()
+                name = f"{domain}-{len(shards):05d}.shard"
+                shards.append({"file": name, "records": []})
+                f = open(os.path.join(out_dir, name), "wb")
+                f.write(MAGIC)
+            shards[-1]["records"].append({"patient_id": patient_id,
+                                          "offset": f.tell(),
+                                          "nbytes": len(payload),
+                                          "origin": list(image.GetOrigin()),
+                                          "direction": list(image.GetDirection()),
+                                          "centre": dataset.metadata.centre(patient_id).tolist(),
+                                          "da_slice": dataset.metadata.da_slice(patient_id),
+                                          "cache_entry": dataset.manifest.entries.get(patient_id)})
+            f.write(payload)
+        if f is not None :
+            f.close()
+        index["domains"][domain] = shards
+
+    # Shards left over from an earlier, larger set
+    names = {s["file"] for shards in index["domains"].values() for s in shards}
+    for name in os.listdir(out_dir) :
+        if name.endswith(".shard") and name not in names :
+            os.remove(os.path.join(out_dir, name))
+
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f :
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    n_shards = sum(len(s) for s in index["domains"].values())
+    print(f"Wrote {len(dataset.x_ids) + len(dataset.y_ids)} images in {n_shards} "
+          f"shards in {out_dir} in {time.perf_counter() - t0:.1f} s.")
+    return index
+
+
+
+def shards_match(out_dir: str, dataset) -> bool :
+    """Whether the shards in a directory hold the current cached images of a
+    dataset, with its image size and spacing. Each image must have been packed
+    from the same cache manifest entry (source signature, crop centre, ...),
+    so shards are rewritten whenever the cache rebuilds a patient."""
+    try :
+        with open(os.path.join(out_dir, "shards.json"), "r") as f :
+            index = json.load(f)
+    except FileNotFoundError :
+        return False
+    if (index["version"] != SHARD_VERSION or
+            index["shape"] != [int(s) for s in dataset.cache_size[::-1]] or
+            not np.allclose(index["spacing"], dataset.img_spacing)) :
+        return False
+    for domain, ids in zip(DOMAINS, [dataset.x_ids, dataset.y_ids]) :
+        records = [r for s in index["domains"][domain] for r in s["records"]]
+        if sorted(r["patient_id"] for r in records) != sorted(str(id) for id in ids) :
+            return False
+        if any(r["cache_entry"] is None or
+               r["cache_entry"] != dataset.manifest.entries.get(r["patient_id"])
+               for r in records) :
+            return False
+    return True
+
+
+
+
+class ShardedUnpairedDataset(IterableDataset) :
+    """Streaming counterpart of UnpairedDataset, reading images from shards.
+
+    Instead of one small read per image, whole shards (see write_shards) are
+    read sequentially, which suits networked filesystems. The order of the
+    images is randomized at two levels: the shards of domain X are read in a
+    random order every epoch (and split between the DataLoader workers), and
+    their images go through a shuffle buffer from which a random one is taken
+    each time it is full.
+
+    As in UnpairedDataset, every image of domain X is paired with a random
+    image of domain Y. Each worker streams the shards of domain Y in its own
+    random order, without end, into a buffer of y_buffer images. An X image
+    takes a random image of the buffer, which is then replaced by the next Y
+    image of the stream.
+
+    The windows (see cache_size and crop_jitter in BaseDataset) and the
+    transform are applied as in UnpairedDataset. Use the samples with a
+    regular DataLoader (shuffle=False), e.g. with BatchCollate as collate_fn.
+    """
+    def __init__(self, shard_dir: str,
+                 image_size: Optional[Sequence[int]] = None,
+                 crop_jitter: Optional[Sequence[int]] = None,
+                 dim: int = 3,
+                 transform: Optional[Callable] = None,
+                 shuffle: bool = True,
+                 shuffle_buffer: int = 64,
+                 y_buffer: int = 32,
+                 seed: Optional[int] = None) :
+        """ Initialize the dataset.
+
+        Parameters
+        ----------
+        shard_dir : str
+            The directory containing the shards and their index.
+        image_size : Sequence[int]
+            The (z, y, x) size of the images, at most the size of the stored
+            images. If None, the size of the stored images.
+        crop_jitter : Sequence[int]
+            The maximum random (z, y, x) offset of the windows from the centre
+            of the stored images. If None, the windows are always centred.
+        dim : int
+            2 or 3, as in UnpairedDataset.
+        transform : Callable
+            The transform applied to each pair of images.
+        shuffle : bool
+            If False, the images of domain X are read in the order of the
+            shards and the shuffle buffer is not used.
+        shuffle_buffer : int
+            The number of images of domain X held in memory to be shuffled.
+        y_buffer : int
+            The number of images of domain Y held in memory to be paired with
+            the images of domain X.
+        seed : int
+            The seed of the shuffling, combined with the epoch (see
+            set_epoch). If None, the order is different every epoch.
+        """
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, "shards.json"), "r") as f :
+            self.index = json.load(f)
+        if self.index["version"] != SHARD_VERSION :
+            raise ValueError(f"The shards in {shard_dir} have version {self.index['version']}, "
+                             f"expected {SHARD_VERSION}. Write them again.")
+        self.shape = tuple(self.index["shape"]) # (z, y, x)
+        self.spacing = self.index["spacing"]    # (x, y, z)
+        self.size = self.shape if image_size is None else tuple(int(s) for s in image_size)
+        if np.any(np.array(self.shape) < np.array(self.size)) :
+            raise ValueError(f"image_size {self.size} is larger than the stored images {self.shape}.")
+        self.crop_jitter = None
+        if crop_jitter is not None :
+            if np.size(crop_jitter) not in [1, 3] :
+                raise ValueError(f"crop_jitter must be one value or 3 values (z, y, x), "
+                                 f"got {crop_jitter}.")
+            self.crop_jitter = np.broadcast_to(np.asarray(crop_jitter, dtype=np.int64), (3,))
+        self.dim = dim
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = max(int(shuffle_buffer), 1)
+        self.seed = seed
+        self.epoch = 0
+
+        self.x_shards = self.index["domains"]["x"]
+        self.y_shards = self.index["domains"]["y"]
+        self.x_size = sum(len(s["records"]) for s in self.x_shards)
+        self.y_size = sum(len(s["records"]) for s in self.y_shards)
+        self.y_buffer = max(min(int(y_buffer), self.y_size), 1)
+        if self.y_size == 0 :
+            raise ValueError(f"The shards in {shard_dir} have no images of domain Y.")
+
+
+    def set_epoch(self, epoch: int) :
+        """Set the epoch, which changes the order of the images if seed is set."""
+        self.epoch = epoch
+
+
+    def __len__(self) :
+        """The number of images in domain X, as in UnpairedDataset."""
+        return self.x_size
+
+
+    def _seeds(self) -> List[int] :
+        """Return the seed of the shard order, the same in every worker of an
+        epoch so that the workers read different shards."""
+        info = get_worker_info()
+        if self.seed is not None :
+            return [self.seed, self.epoch]
+        if info is not None : # The DataLoader draws a new base seed every epoch
+            return [(info.seed - info.id) % 2**32]
+        return [np.random.randint(2**31)]
+
+
+    def _read_shard(self, shard: Dict) -> List :
+        """Read a shard sequentially and return its (record, payload) pairs.
+        Each payload is read into its own buffer, so that the images held in
+        the shuffle buffers don't keep the whole shard in memory."""
+        items = []
+        with open(os.path.join(self.shard_dir, shard["file"]), "rb",
+                  buffering=READ_BUFFER_BYTES) as f :
+            if f.read(len(MAGIC)) != MAGIC :
+                raise ValueError(f"{shard['file']} is not a shard file.")
+            position = len(MAGIC)
+            for record in shard["records"] :
+                if record["offset"] != position :
+                    f.seek(record["offset"])
+                payload = f.read(record["nbytes"])
+                if len(payload) != record["nbytes"] :
+                    raise ValueError(f"{shard['file']} is truncated.")
+                items.append((record, payload))
+                position = record["offset"] + record["nbytes"]
+        return items
+
+
+    def _stream_y(self, rng: np.random.RandomState) -> Iterator :
+        """Stream the images of domain Y in a random order, without end."""
+        while True :
+            for i in rng.permutation(len(self.y_shards)) :
+                records = self._read_shard(self.y_shards[i])
+                for j in rng.permutation(len(records)) :
+                    yield records[j]
+
+
+    def _stream_x(self, shards: Sequence[Dict], rng: np.random.RandomState) -> Iterator :
+        """Stream the images of domain X of some shards through the shuffle buffer."""
+        buffer = []
+        for shard in shards :
+            for item in self._read_shard(shard) :
+                if not self.shuffle :
+                    yield item
+                    continue
+                buffer.append(item)
+                if len(buffer) >= self.shuffle_buffer :
+                    k = rng.randint(len(buffer))
+                    buffer[k], buffer[-1] = buffer[-1], buffer[k]
+                    yield buffer.pop()
+        for k in rng.permutation(len(buffer)) :
+            yield buffer[k]
+
+
+    def _window_start(self, rng: np.random.RandomState) -> Optional[np.ndarray] :
+        """Draw the (z, y, x) start of the window, as BaseDataset._window_start."""
+        margin = np.array(self.shape) - np.array(self.size)
+        if not margin.any() :
+            return None
+        start = margin // 2
+        if self.crop_jitter is not None :
+            start = start + rng.randint(-self.crop_jitter, self.crop_jitter + 1)
+        return np.clip(start, 0, margin)
+
+
+    def _image(self, record: Dict, payload, start: Optional[np.ndarray]) :
+        """Decode an image and take its window. SITK images, with the geometry
+        of the window, are made only for transforms that need them: anything
+        but a compiled chain without flips or affine transforms."""
+        array = np.frombuffer(decode(payload, self.index["codec"]),
+                              dtype=self.index["dtype"]).reshape(self.shape)
+        if start is not None :
+            stop = start + np.array(self.size)
+            array = array[start[0] : stop[0], start[1] : stop[1], start[2] : stop[2]]
+        if self.transform is None or not getattr(self.transform, "spatial", True) :
+            return array
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing(self.spacing)
+        image.SetDirection(record["direction"])
+        image.SetOrigin(record["origin"])
+        if start is not None : # Keep the physical position of the window
+            image.SetOrigin(image.TransformIndexToPhysicalPoint([int(s) for s in start[::-1]]))
+        return image
+
+
+    def __iter__(self) :
+        info = get_worker_info()
+        worker_id, n_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        seeds = self._seeds()
+        order = np.arange(len(self.x_shards))
+        if self.shuffle :
+            order = np.random.RandomState(seeds).permutation(order)
+        shards = [self.x_shards[i] for i in order[worker_id::n_workers]]
+        rng = np.random.RandomState(seeds + [worker_id + 1])
+
+        y_stream = self._stream_y(rng)
+        y_buffer = [next(y_stream) for _ in range(self.y_buffer)]
+        for x_item in self._stream_x(shards, rng) :
+            k = rng.randint(len(y_buffer))
+            y_item, y_buffer[k] = y_buffer[k], next(y_stream)
+            start = self._window_start(rng)
+            X, Y = self._image(*x_item, start), self._image(*y_item, start)
+            if self.transform is not None :
+                X, Y = self.transform((X, Y)) # Apply the same transform to both images
+            if self.dim == 2 : # Use the channels as third dimension
+                X, Y = X.reshape(self.size), Y.reshape(self.size)
+            yield X, Y
+
+
+    def __repr__(self) :
+        return (f"{self.__class__.__name__}({self.shard_dir}, {self.x_size} X images in "
+                f"{len(self.x_shards)} shards, {self.y_size} Y images in {len(self.y_shards)} shards)")
@@ -0,0 +1,334 @@
+import ctypes
+import hashlib
+import multiprocessing as mp
+import numpy as np
+from typing import Dict, Optional
+
+import SimpleITK as sitk
+
+from data.volume_codecs import check_codec, encode, decode
+
+
+
+
+class SharedVolumeCache :
+    """Byte-budgeted LRU cache of decoded images in shared memory.
+
+    The cache is allocated in the main process before the DataLoader workers
+    are started and is inherited by every worker, so an image decoded by one
+    worker is served to all of them without being read from disk or pickled
+    again.
+
+    Memory is split into fixed-size blocks. Each entry occupies a chain of
+    blocks (like a file allocation table), so entries of any size can be stored
+    and optionally compressed (see data.volume_codecs). When the budget is exhausted the least
+    recently used entries are evicted. All bookkeeping lives in shared arrays
+    protected by a single lock: a hash table from key to entry, a doubly
+    linked list of the entries from most to least recently used, and the
+    free lists of blocks and entries, so every lookup and eviction is O(1).
+
+    The lock is not held while pixels are copied. An entry is pinned while a
+    process copies it in or out, and pinned entries are never evicted.
+    """
+    # Positions in the shared header array
+    (FREE_HEAD, N_FREE, HITS, MISSES, EVICTIONS, INSERTIONS,
+     N_ENTRIES, FREE_ENTRY, LRU_HEAD, LRU_TAIL) = range(10)
+    HEADER_SIZE = 18 # shape (3), spacing (3), origin (3), direction (9)
+    WRITING = -1 # Pin count of an entry whose pixels are being copied in
+
+    def __init__(self,
+                 budget_bytes: int,
+                 block_bytes: int = 1 << 16,
+                 compression: Optional[str] = None) :
+        """ Initialize the cache.
+
+        Parameters
+        ----------
+        budget_bytes : int
+            The total size of the shared memory used to store images.
+        block_bytes : int
+            The size of a single allocation block. Smaller blocks waste less
+            memory per entry, larger blocks need less bookkeeping.
+        compression : str, None
+            The codec used to compress images before they are stored in the
+            cache, e.g. 'lz4'. If None, images are stored raw.
+        """
+        compression = "raw" if compression is None else compression
+        check_codec(compression)
+
+        self.compression = compression
+        self.block_bytes = int(block_bytes)
+        self.n_blocks = max(int(budget_bytes) // self.block_bytes, 1)
+        # Open addressing with linear probing, at most half full
+        self.table_size = 1 << (2 * self.n_blocks - 1).bit_length()
+
+        # Shared memory. Every entry needs at least one block, so there are
+        # never more entries than blocks.
+        self._raw_data   = mp.RawArray(ctypes.c_uint8, self.n_blocks * self.block_bytes)
+        self._raw_keys   = mp.RawArray(ctypes.c_int64, self.n_blocks) # 0 = unused
+        self._raw_first  = mp.RawArray(ctypes.c_int64, self.n_blocks) # First block
+        self._raw_nbytes = mp.RawArray(ctypes.c_int64, self.n_blocks)
+        self._raw_pins   = mp.RawArray(ctypes.c_int64, self.n_blocks) # Readers or WRITING
+        self._raw_prev   = mp.RawArray(ctypes.c_int64, self.n_blocks) # LRU list
+        self._raw_after  = mp.RawArray(ctypes.c_int64, self.n_blocks) # LRU / free entries
+        self._raw_next   = mp.RawArray(ctypes.c_int64, self.n_blocks) # Block chains
+        self._raw_table  = mp.RawArray(ctypes.c_int64, self.table_size) # Hash -> entry
+        self._raw_header = mp.RawArray(ctypes.c_int64, 16)
+        self._lock = mp.Lock()
+
+        self._views()
+        self._next[:] = np.arange(1, self.n_blocks + 1)
+        self._next[-1] = -1 # All blocks start in the free list
+        self._after[:] = np.arange(1, self.n_blocks + 1)
+        self._after[-1] = -1 # All entries start in the free list
+        self._table[:] = -1
+        self._header[self.FREE_HEAD] = 0
+        self._header[self.N_FREE] = self.n_blocks
+        self._header[self.FREE_ENTRY] = 0
+        self._header[self.LRU_HEAD] = -1
+        self._header[self.LRU_TAIL] = -1
+
+
+    _ARRAYS = ["data", "keys", "first", "nbytes", "pins", "prev", "after", "next",
+               "table", "header"]
+
+    def _views(self) :
+        """Create numpy views of the shared arrays in this process."""
+        self._data = np.frombuffer(self._raw_data, dtype=np.uint8)
+        for name in self._ARRAYS[1:] :
+            setattr(self, f"_{name}", np.frombuffer(getattr(self, f"_raw_{name}"), dtype=np.int64))
+
+
+    def __getstate__(self) :
+        # The shared arrays are passed to workers by inheritance, the numpy
+        # views are recreated on the other side.
+        state = self.__dict__.copy()
+        for name in self._ARRAYS :
+            del state[f"_{name}"]
+        return state
+
+    def __setstate__(self, state) :
+        self.__dict__.update(state)
+        self._views()
+
+
+    @staticmethod
+    def _hash(key: str) -> int :
+        h = int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(),
+                           "little", signed=True)
+        return h if h != 0 else 1
+
+
+    def _slot(self, h: int) -> int :
+        """Return the slot of the hash table holding h, or the empty slot
+        where it would go (lock held)."""
+        mask = self.table_size - 1
+        slot = h & mask
+        while True :
+            entry = int(self._table[slot])
+            if entry < 0 or self._keys[entry] == h :
+                return slot
+            slot = (slot + 1) & mask
+
+
+    def _find(self, h: int) -> int :
+        return int(self._table[self._slot(h)])
+
+
+    def _unmap(self, h: int) :
+        """Remove h from the hash table, moving back the entries probed past
+        it so no tombstones are needed (lock held)."""
+        mask = self.table_size - 1
+        hole = self._slot(h)
+        slot = hole
+        while True :
+            slot = (slot + 1) & mask
+            entry = int(self._table[slot])
+            if entry < 0 :
+                break
+            home = int(self._keys[entry]) & mask
+            # Move the entry into the hole unless its home lies after the hole
+            if (slot > hole and (home <= hole or home > slot)) or \
+               (slot < hole and (home <= hole and home > slot)) :
+                self._table[hole] = entry
+                hole = slot
+        self._table[hole] = -1
+
+
+    def _unlink(self, entry: int) :
+        """Remove an entry from the LRU list (lock held)."""
+        prev, after = int(self._prev[entry]), int(self._after[entry])
+        if prev >= 0 :
+            self._after[prev] = after
+        else :
+            self._header[self.LRU_HEAD] = after
+        if after >= 0 :
+            self._prev[after] = prev
+        else :
+            self._header[self.LRU_TAIL] = prev
+
+
+    def _push_front(self, entry: int) :
+        """Make an entry the most recently used (lock held)."""
+        head = int(self._header[self.LRU_HEAD])
+        self._prev[entry], self._after[entry] = -1, head
+        if head >= 0 :
+            self._prev[head] = entry
+        else :
+            self._header[self.LRU_TAIL] = entry
+        self._header[self.LRU_HEAD] = entry
+
+
+    def _free_entry(self, entry: int) :
+        """Return the blocks of an entry to the free list (lock held)."""
+        block, n = int(self._first[entry]), 0
+        while True :
+            n += 1
+            if self._next[block] == -1 :
+                break
+            block = int(self._next[block])
+        # Prepend the whole chain to the free list
+        self._next[block] = self._header[self.FREE_HEAD]
+        self._header[self.FREE_HEAD] = self._first[entry]
+        self._header[self.N_FREE] += n
+
+        self._unmap(int(self._keys[entry]))
+        self._unlink(entry)
+        self._keys[entry] = 0
+        self._pins[entry] = 0
+        self._after[entry] = self._header[self.FREE_ENTRY]
+        self._header[self.FREE_ENTRY] = entry
+        self._header[self.N_ENTRIES] -= 1
+
+
+    def _make_room(self, n_needed: int) -> bool :
+        """Evict the least recently used entries that are not pinned until
+        n_needed blocks are free. Return False if that is not possible
+        (lock held)."""
+        entry = int(self._header[self.LRU_TAIL])
+        while self._header[self.N_FREE] < n_needed :
+            while entry >= 0 and self._pins[entry] != 0 :
+                entry = int(self._prev[entry])
+            if entry < 0 :
+                return False
+            prev = int(self._prev[entry])
+            self._free_entry(entry)
+            self._header[self.EVICTIONS] += 1
+            entry = prev
+        return True
+
+
+    def _copy_chain(self, first: int, buffer: np.ndarray, into_cache: bool) :
+        """Copy a buffer into or out of a chain of blocks. Only called on a
+        pinned entry, whose chain can't change."""
+        nbytes = len(buffer)
+        block, pos = first, 0
+        while pos < nbytes :
+            n = min(self.block_bytes, nbytes - pos)
+            start = block * self.block_bytes
+            if into_cache :
+                self._data[start : start + n] = buffer[pos : pos + n]
+            else :
+                buffer[pos : pos + n] = self._data[start : start + n]
+            pos, block = pos + n, int(self._next[block])
+
+
+    def get_image(self, key: str) -> Optional[sitk.Image] :
+        """Return the cached image, or None if it is not in the cache."""
+        with self._lock :
+            entry = self._find(self._hash(key))
+            if entry < 0 or self._pins[entry] == self.WRITING :
+                self._header[self.MISSES] += 1
+                return None
+            self._header[self.HITS] += 1
+            self._unlink(entry)
+            self._push_front(entry)
+            # Pin the entry so it can't be evicted while it is copied
+            self._pins[entry] += 1
+            first, nbytes = int(self._first[entry]), int(self._nbytes[entry])
+
+        buffer = np.empty(nbytes, dtype=np.uint8)
+        try :
+            self._copy_chain(first, buffer, into_cache=False)
+        finally :
+            with self._lock :
+                self._pins[entry] -= 1
+
+        header  = np.frombuffer(buffer[:self.HEADER_SIZE * 8], dtype=np.float64)
+        payload = buffer[self.HEADER_SIZE * 8:]
+        if self.compression != "raw" :
+            payload = np.frombuffer(decode(payload.tobytes(), self.compression), dtype=np.uint8)
+        shape = header[0:3].astype(int)
+        array = payload.view(np.float32).reshape(shape)
+
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing(header[3:6].tolist())
+        image.SetOrigin(header[6:9].tolist())
+        image.SetDirection(header[9:18].tolist())
+        return image
+
+
+    def put_image(self, key: str, image: sitk.Image) :
+        """Add an image to the cache, evicting the least recently used images
+        if needed. Images larger than the whole budget, or than the space left
+        by the entries being copied, are not cached."""
+        array = sitk.GetArrayViewFromImage(image).astype(np.float32, copy=False)
+        header = np.concatenate([array.shape, image.GetSpacing(),
+                                 image.GetOrigin(), image.GetDirection()]).astype(np.float64)
+        payload = encode(array.tobytes(), self.compression)
+        buffer = np.frombuffer(header.tobytes() + payload, dtype=np.uint8)
+
+        nbytes = len(buffer)
+        n_needed = -(-nbytes // self.block_bytes) # Ceiling division
+        if n_needed > self.n_blocks :
+            return
+
+        h = self._hash(key)
+        with self._lock :
+            slot = self._slot(h)
+            if self._table[slot] >= 0 : # Another worker added it already
+                return
+            if not self._make_room(n_needed) :
+                return
+            slot = self._slot(h) # Evictions may have moved the probe sequence
+
+            # Detach the chain from the free list
+            first = block = int(self._header[self.FREE_HEAD])
+            for _ in range(n_needed - 1) :
+                block = int(self._next[block])
+            self._header[self.FREE_HEAD] = self._next[block]
+            self._header[self.N_FREE] -= n_needed
+            self._next[block] = -1
+
+            entry = int(self._header[self.FREE_ENTRY])
+            self._header[self.FREE_ENTRY] = self._after[entry]
+            self._header[self.N_ENTRIES] += 1
+            self._keys[entry] = h
+            self._first[entry] = first
+            self._nbytes[entry] = nbytes
+            self._pins[entry] = self.WRITING # Readers miss until it is copied
+            self._table[slot] = entry
+            self._push_front(entry)
+
+        try :
+            self._copy_chain(first, buffer, into_cache=True)
+        except BaseException :
+            with self._lock :
+                self._free_entry(entry)
+            raise
+        with self._lock :
+            self._pins[entry] = 0
+            self._header[self.INSERTIONS] += 1
+
+
+    def stats(self) -> Dict[str, int] :
+        """Return the hit/miss/eviction counters and memory usage."""
+        with self._lock :
+            n_used = self.n_blocks - int(self._header[self.N_FREE])
+            return {"hits": int(self._header[self.HITS]),
+                    "misses": int(self._header[self.MISSES]),
+                    "evictions": int(self._header[self.EVICTIONS]),
+                    "insertions": int(self._header[self.INSERTIONS]),
+                    "entries": int(self._header[self.N_ENTRIES]),
+                    "bytes_used": n_used * self.block_bytes,
+                    "bytes_total": self.n_blocks * self.block_bytes}
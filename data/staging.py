@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Sequence
+
+
+CHUNK_BYTES = 8 * 2**20
+
+
+
+
+def file_checksum(path: str) -> str :
+    """Return the BLAKE2b checksum of a file."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f :
+        for chunk in iter(lambda : f.read(CHUNK_BYTES), b"") :
+            h.update(chunk)
+    return h.hexdigest()
+
+
+
+def copy_with_checksum(src: str, dst: str) -> str :
+    """Copy a file and return the checksum of the bytes read, so that the
+    source is read only once."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(src, "rb") as fin, open(dst, "wb") as fout :
+        for chunk in iter(lambda : fin.read(CHUNK_BYTES), b"") :
+            h.update(chunk)
+            fout.write(chunk)
+    shutil.copystat(src, dst)
+    return h.hexdigest()
+
+
+
+
+class CacheStager :
+    """Copy cache files from the shared filesystem to node-local scratch.
+
+    At the start of a job, the cache files needed by a dataset are copied in
+    parallel into a local directory, and each file is then read from its local
+    copy instead of from the shared cache. Every copy is verified: the bytes
+    are hashed while they are read from the shared filesystem, compared with
+    the checksum recorded the first time the file was staged (in
+    `checksums.json` next to the shared files), and the local copy is hashed
+    again after it is written.
+
+    Files that already have a verified local copy (e.g. from a previous job on
+    the same node) are not copied again. By default such a copy is hashed
+    again once per job, when it is staged, and copied again if it no longer
+    matches the checksum recorded when it was made. When the local disk is
+    full, or a copy can't be verified, the file is read from the shared cache
+    instead, so staging never fails a job.
+    """
+    def __init__(self, shared_dir: str, local_dir: str,
+                 min_free_bytes: int = 2**30, num_workers: int = 8,
+                 verify_reused: bool = True) :
+        """ Initialize the stager.
+
+        Parameters
+        ----------
+        shared_dir : str
+            The cache directory on the shared filesystem.
+        local_dir : str
+            The directory on node-local scratch in which to copy the files.
+        min_free_bytes : int
+            The space to always leave free on the local disk. Files that don't
+            fit are read from the shared cache.
+        num_workers : int
+            The number of files copied (or verified) at once.
+        verify_reused : bool
+            Whether to hash the local copies left by previous jobs before
+            reusing them. If False, only their size is checked.
+        """
+        self.shared_dir = shared_dir
+        self.local_dir = local_dir
+        self.min_free_bytes = int(min_free_bytes)
+        self.num_workers = num_workers
+        self.verify_reused = verify_reused
+        self.checksums_path = os.path.join(shared_dir, "checksums.json")
+        self.staged_path = os.path.join(local_dir, "staged.json")
+        self._lock = threading.Lock()
+        os.makedirs(self.local_dir, exist_ok=True)
+
+        self.checksums = _load_json(self.checksums_path) # Of the shared files
+        self.staged = _load_json(self.staged_path)       # Of the local copies
+
+
+    def _is_staged(self, name: str, stat: os.stat_result) -> bool :
+        """Whether a verified local copy of the current shared file exists."""
+        entry = self.staged.get(name)
+        local_path = os.path.join(self.local_dir, name)
+        return (entry is not None and
+                entry["source_mtime"] == stat.st_mtime and
+                entry["source_size"] == stat.st_size and
+                os.path.exists(local_path) and
+                os.path.getsize(local_path) == stat.st_size)
+
+
+    def _is_intact(self, name: str) -> bool :
+        """Whether a local copy still has the checksum it had when it was
+        made, e.g. it was not corrupted on the local disk since."""
+        try :
+            return file_checksum(os.path.join(self.local_dir, name)) == self.staged[name]["checksum"]
+        except OSError :
+            return False
+
+
+    def _copy(self, name: str, stat: os.stat_result) -> bool :
+        """Copy and verify one file. Return whether the local copy can be used."""
+        src, dst = os.path.join(self.shared_dir, name), os.path.join(self.local_dir, name)
+        tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        recorded = self.checksums.get(name)
+        if recorded is not None and (recorded["source_mtime"] != stat.st_mtime or
+                                     recorded["source_size"] != stat.st_size) :
+            recorded = None # The shared file was rewritten since
+        try :
+            checksum = copy_with_checksum(src, tmp)
+            verified = (file_checksum(tmp) == checksum and
+                        (recorded is None or recorded["checksum"] == checksum))
+            if not verified :
+                print(f"Checksum of the local copy of {name} does not match, "
+                      "reading it from the shared cache.")
+                os.remove(tmp)
+                return False
+            os.replace(tmp, dst)
+        except OSError as e : # e.g. no space left on the device
+            print(f"Could not stage {name} ({e}), reading it from the shared cache.")
+            if os.path.exists(tmp) :
+                os.remove(tmp)
+            return False
+
+        entry = {"source_mtime": stat.st_mtime, "source_size": stat.st_size,
+                 "checksum": checksum}
+        with self._lock :
+            self.staged[name] = entry
+            if recorded is None :
+                self.checksums[name] = entry
+        return True
+
+
+    def stage(self, names: Sequence[str]) -> Dict[str, str] :
+        """ Stage cache files.
+
+        Parameters
+        ----------
+        names : Sequence[str]
+            The paths of the files relative to the shared cache directory.
+
+        Returns
+        -------
+        Dict[str, str]
+            The path to read each file from: its local copy, or the shared file
+            if it could not be staged.
+        """
+        t0 = time.perf_counter()
+        paths, to_copy, to_reuse = {}, [], []
+        missing = corrupt = 0
+        for name in names :
+            shared_path = os.path.join(self.shared_dir, name)
+            try :
+                stat = os.stat(shared_path)
+            except FileNotFoundError :
+                paths[name] = shared_path
+                missing += 1
+                continue
+            paths[name] = shared_path
+            if self._is_staged(name, stat) :
+                to_reuse.append((name, stat))
+            else :
+                to_copy.append((name, stat))
+
+        if self.verify_reused :
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor :
+                intact = list(executor.map(lambda task : self._is_intact(task[0]), to_reuse))
+        else :
+            intact = [True] * len(to_reuse)
+        reused = 0
+        for (name, stat), ok in zip(to_reuse, intact) :
+            if ok :
+                paths[name] = os.path.join(self.local_dir, name)
+                reused += 1
+            else :
+                print(f"The local copy of {name} does not match its checksum, copying it again.")
+                del self.staged[name]
+                to_copy.append((name, stat))
+                corrupt += 1
+
+        # Only copy the files that fit in the free space of the local disk
+        budget = shutil.disk_usage(self.local_dir).free - self.min_free_bytes
+        fits = []
+        for name, stat in to_copy :
+            if stat.st_size <= budget :
+                budget -= stat.st_size
+                fits.append((name, stat))
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor :
+            copied = list(executor.map(lambda task : self._copy(*task), fits))
+        n_copied, copied_bytes = 0, 0
+        for (name, stat), ok in zip(fits, copied) :
+            if ok :
+                paths[name] = os.path.join(self.local_dir, name)
+                n_copied += 1
+                copied_bytes += stat.st_size
+
+        _save_json(self.staged_path, self.staged)
+        if n_copied > 0 :
+            _save_json(self.checksums_path, {**_load_json(self.checksums_path), **self.checksums})
+
+        n_local = reused + n_copied
+        self.stats = {"files": len(names), "reused": reused, "copied": n_copied,
+                      "copied_bytes": copied_bytes, "shared": len(names) - n_local,
+                      "missing": missing, "corrupt": corrupt,
+                      "hit_ratio": n_local / max(len(names), 1),
+                      "seconds": time.perf_counter() - t0}
+        print(f"Staged {len(names)} cache files in {self.local_dir} in "
+              f"{self.stats['seconds']:.1f} s: {reused} already local, {n_copied} copied "
+              f"({copied_bytes / 2**20:.0f} MB), {len(names) - n_local} read from the "
+              f"shared cache. Local hit ratio {100 * self.stats['hit_ratio']:.1f}%.")
+        return paths
+
+
+    def __repr__(self) :
+        return f"{self.__class__.__name__}({self.shared_dir} -> {self.local_dir})"
+
+
+
+def _load_json(path: str) -> Dict :
+    try :
+        with open(path, "r") as f :
+            return json.load(f)
+    except (FileNotFoundError, ValueError) :
+        return {}
+
+
+
+def _save_json(path: str, data: Dict) :
+    """Atomically write a JSON file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try :
+        with open(tmp_path, "w") as f :
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e : # e.g. a read-only shared cache
+        print(f"Could not save {path}: {e}")
@@ -4,7 +4,7 @@ import os
 import numpy as np
 import pandas as pd
 
-from data_loader import load_image_data_frame
+from catalog import read_label_csv
 from sklearn.model_selection import train_test_split
 
 
@@ -13,9 +13,8 @@ def main(csv_path, save_dir="", test_size=0.10) :
     and output one DF for each train and test set, with same format as
     original dataframe."""
 
-    # Load data in a DataFrame
-    df = pd.read_csv(csv_path, dtype=str)
-    df.set_index("p_index", inplace=True) # Set index
+    # Load data in a DataFrame with typed columns
+    df = read_label_csv(csv_path).reset_index().set_index("p_index")
 
     # Split the patient IDs into a train and test set
     # Stratify the split based on number of each DA class
@@ -1,8 +1,31 @@
 import numpy as np
 import scipy.ndimage
 import torch
+import torch.nn.functional as F
 import SimpleITK as sitk
-from typing import Tuple
+from typing import Dict, Optional, Sequence, Tuple
+
+from util.profiling import profiled
+
+
+# Largest difference (in HU) between a compiled chain that flips the images
+# before the affine transform and the same chain run step by step. The
+# interpolation weights round differently, which can change the float32
+# pixels by about one unit in the last place.
+FLIP_TOLERANCE = 1e-3
+
+
+
+
+def _check_images(image_xy, step) :
+    """Raise a TypeError if a transform that needs SimpleITK images is given
+    arrays, e.g. the output of Normalize."""
+    for image in image_xy :
+        if not isinstance(image, sitk.Image) :
+            raise TypeError(f"{type(step).__name__} needs SimpleITK images but got "
+                            f"{type(image).__name__}. Normalize returns arrays, so "
+                            "spatial transforms must come before it in the chain.")
+
 
 
 
@@ -75,6 +98,7 @@ class AffineTransform:
         self.max_pixels = max_pixels
         self.fill_value = fill_value
 
+    @profiled()
     def __call__(self, image_xy : Tuple[sitk.Image, sitk.Image]) -> Tuple[sitk.Image, sitk.Image] :
         """Apply the transform.
 
@@ -88,25 +112,33 @@ class AffineTransform:
         Tuple[sitk.Image, sitk.Image]
             The transformed images from domain X and Y.
         """
+        _check_images(image_xy, self)
         image_x, image_y = image_xy
-        angle = -self.max_angle + 2 * self.max_angle * torch.rand(1).item()
-        rotation_centre = np.array(image_x.GetSize()) / 2
-        rotation_centre = image_x.TransformContinuousIndexToPhysicalPoint(rotation_centre)
+        rotation = self.get_transform(image_x, *self.sample_params())
+        image_x = sitk.Resample(image_x, image_x, rotation, sitk.sitkLinear, self.fill_value)
+        image_y = sitk.Resample(image_y, image_y, rotation, sitk.sitkLinear, self.fill_value)
 
+        return image_x, image_y
+
+    def sample_params(self) -> Tuple[float, np.ndarray] :
+        """Draw a random rotation angle (radians) and (x, y) translation."""
+        angle = -self.max_angle + 2 * self.max_angle * torch.rand(1).item()
         max_pixel = torch.Tensor([self.max_pixels[0], self.max_pixels[1]])
         pixel = (-max_pixel + 2 * max_pixel * torch.rand(2)).numpy().astype(np.float64)
-
-        rotation = sitk.Euler3DTransform(
+        return angle, pixel
+
+    def get_transform(self, image: sitk.Image, angle: float, pixel: np.ndarray) -> sitk.Transform :
+        """Return the rotation about the centre of an image followed by the
+        translation. Only the geometry of the image is used."""
+        rotation_centre = np.array(image.GetSize()) / 2
+        rotation_centre = image.TransformContinuousIndexToPhysicalPoint(rotation_centre)
+        return sitk.Euler3DTransform(
             rotation_centre,
             0,      # the angle of rotation around the x-axis, in radians -> coronal rotation
             0,      # the angle of rotation around the y-axis, in radians -> saggittal rotation
             angle,  # the angle of rotation around the z-axis, in radians -> axial rotation
             (pixel[0], pixel[1], 0.0)  # translation
         )
-        image_x = sitk.Resample(image_x, image_x, rotation, sitk.sitkLinear, self.fill_value)
-        image_y = sitk.Resample(image_y, image_y, rotation, sitk.sitkLinear, self.fill_value)
-
-        return image_x, image_y
 
     def __repr__(self):
         return f"{self.__class__.__name__}(max_angle={self.max_angle}, fill_value={self.fill_value})"
@@ -115,11 +147,174 @@ class AffineTransform:
 
 
 
+class BatchAffineTransform :
+    """Randomly flip, rotate and translate a whole batch of image tensors.
+
+    This is the batched equivalent of HorizontalFlip followed by
+    AffineTransform. Every sample gets its own random parameters, the same
+    for its X and Y images, and all of them are applied in a single
+    `grid_sample` pass over the batch instead of one `sitk.Resample` per image.
+    Use it on images in HU, before Normalize, like AffineTransform.
+    """
+    def __init__(self,
+                 max_angle: float = 20.0,
+                 max_pixels=[20, 20],
+                 fill_value: float = -1050.0,
+                 flip: bool = True,
+                 spacing: Sequence[float] = [1.0, 1.0]) :
+        """Initialize the transform class.
+
+        Parameters
+        ----------
+        max_angle
+            The maximum absolute angle of the rotation in the axial plane, in
+            degrees.
+        max_pixels
+            The maximum translation in the x and y axes. Like in AffineTransform,
+            it is applied in physical units (mm).
+        fill_value
+            The pixel value to fill in the rotations/translations.
+        flip
+            Whether to also flip half of the samples about the vertical axis.
+        spacing
+            The (x, y) voxel spacing of the images in mm, used to convert the
+            translation to voxels.
+        """
+        self.max_angle = max_angle * (np.pi / 180.0) # Convert to radians
+        self.max_pixels = max_pixels
+        self.fill_value = fill_value
+        self.flip = flip
+        self.spacing = np.array(spacing[:2], dtype=np.float64)
+
+    def sample_params(self, n: int) -> Dict[str, np.ndarray] :
+        """Draw the random flip, angle and translation of n samples."""
+        flip = torch.rand(n) > 0.5 if self.flip else torch.zeros(n, dtype=torch.bool)
+        angle = -self.max_angle + 2 * self.max_angle * torch.rand(n)
+        max_pixel = torch.Tensor([self.max_pixels[0], self.max_pixels[1]])
+        pixel = -max_pixel + 2 * max_pixel * torch.rand(n, 2)
+        return {"flip": flip.numpy(),
+                "angle": angle.numpy().astype(np.float64),
+                "translation": pixel.numpy().astype(np.float64)}
+
+    def get_theta(self, params: Dict[str, np.ndarray], size: Sequence[int]) -> torch.Tensor :
+        """ Return the (n, 2, 3) matrices mapping the normalized (x, y)
+        coordinates of the output voxels to the input voxels, as used by
+        `affine_grid`. The transform is the same for every axial slice.
+
+        Follows sitk.Resample with the Euler3DTransform of AffineTransform: the
+        output voxel at continuous index i samples the input at
+        S^-1 R S (i - c) + c + S^-1 t, where c = size / 2 is the rotation centre,
+        S the voxel spacing, R the rotation and t the translation. sitk.Flip
+        keeps the physical position of the voxels and only reverses their
+        order, so a flip mirrors the x index of the output and moves the
+        rotation centre to index size - 1 - size / 2 along x.
+
+        Parameters
+        ----------
+        params
+            The parameters returned by `sample_params`.
+        size
+            The (x, y) size of the images.
+        """
+        size = np.array(size[:2], dtype=np.float64)
+        half = (size - 1) / 2   # Index to normalized coordinates: i = half * (u + 1)
+        centre = size / 2
+        n = len(params["angle"])
+        theta = np.zeros((n, 2, 3))
+        for k in range(n) :
+            cos, sin = np.cos(params["angle"][k]), np.sin(params["angle"][k])
+            M = np.array([[cos, -sin], [sin, cos]]) * self.spacing[None, :] / self.spacing[:, None]
+            d = params["translation"][k] / self.spacing
+            c = centre.copy()
+            if params["flip"][k] :
+                c[0] = size[0] - 1 - centre[0]
+            theta[k, :, :2] = M * half[None, :] / half[:, None]
+            theta[k, :, 2] = (M @ (half - c) + c - half + d) / half
+            if params["flip"][k] :
+                theta[k, :, 0] *= -1
+        return torch.from_numpy(theta)
+
+    @profiled()
+    def apply_batch(self, batch_xy : Tuple[torch.Tensor, torch.Tensor],
+                    params: Optional[Dict[str, np.ndarray]] = None) -> Tuple[torch.Tensor, torch.Tensor] :
+        """Apply random transforms to a batch of images from each domain.
+
+        Parameters
+        ----------
+        batch_xy
+            A tuple containing the float tensors of the images from domain X and
+            Y, of shape (batch_size, 1, z_size, y_size, x_size) or
+            (batch_size, z_size, y_size, x_size).
+        params
+            The parameters of the transforms. If None, they are drawn at random.
+
+        Returns
+        -------
+        Tuple[torch.Tensor, torch.Tensor]
+            The transformed images from domain X and Y.
+        """
+        X, Y = batch_xy
+        shape = X.shape
+        n, depth, size = shape[0], shape[-3], shape[:-3:-1] # size is (x, y)
+        if params is None :
+            params = self.sample_params(n)
+
+        # The z-index is unchanged, so the slices of X and Y are transformed
+        # together as the channels of one 2D bilinear interpolation
+        XY = torch.cat([X.reshape(n, depth, size[1], size[0]),
+                        Y.reshape(n, depth, size[1], size[0])], dim=1)
+        theta = self.get_theta(params, size).to(X.dtype)
+        grid = F.affine_grid(theta, [n, 2 * depth, size[1], size[0]], align_corners=True)
+
+        # Like sitk.Resample, voxels mapped more than half a voxel outside the
+        # input are filled, the others are interpolated
+        inside = torch.ones(grid.shape[:-1], dtype=torch.bool)
+        for axis in range(2) :
+            index = (grid[..., axis] + 1) * ((size[axis] - 1) / 2)
+            inside &= (index >= -0.5) & (index < size[axis] - 0.5)
+
+        XY = F.grid_sample(XY, grid, mode="bilinear", padding_mode="border",
+                           align_corners=True)
+        XY.masked_fill_(~inside.unsqueeze(1), self.fill_value)
+        return XY[:, :depth].reshape(shape), XY[:, depth:].reshape(shape)
+
+    def __call__(self, image_xy : Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor] :
+        """Apply the transform to a single pair of (1, z, y, x) image tensors."""
+        X, Y = self.apply_batch((image_xy[0].unsqueeze(0), image_xy[1].unsqueeze(0)))
+        return X[0], Y[0]
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(max_angle={self.max_angle}, "
+                f"fill_value={self.fill_value}, flip={self.flip})")
+
+
+
+
+
+def _array_view(image) -> np.ndarray :
+    """Return the (z, y, x) pixels of an SITK image, tensor or array without
+    copying them. The view of an SITK image is only valid while the image is
+    alive."""
+    if isinstance(image, sitk.Image) :
+        return sitk.GetArrayViewFromImage(image)
+    elif torch.is_tensor(image) :
+        return image.numpy()
+    return np.asarray(image)
+
+
+
+
+
 class ToTensor:
-    """Convert a SimpleITK image to torch.Tensor."""
+    """Convert a SimpleITK image (or a NumPy array) to torch.Tensor."""
+    @profiled()
     def __call__(self, image_xy : Tuple[sitk.Image, sitk.Image]) -> Tuple[torch.Tensor, torch.Tensor]:
         """Apply the transform.
 
+        SimpleITK images are copied once into a new float32 tensor. Writable
+        float32 arrays, e.g. the output of Normalize, are wrapped without
+        copying.
+
         Parameters
         ----------
         image_xy
@@ -127,15 +322,29 @@ class ToTensor:
 
         Returns
         -------
-        Tuple[sitk.Image, sitk.Image]
-            The transformed images from domain X and Y.
+        Tuple[torch.Tensor, torch.Tensor]
+            The transformed images from domain X and Y, of shape
+            (1, z_size, y_size, x_size).
         """
         image_x, image_y = image_xy
-        X, Y = sitk.GetArrayFromImage(image_x), sitk.GetArrayFromImage(image_y)
-        X = torch.from_numpy(X).unsqueeze(0).float()
-        Y = torch.from_numpy(Y).unsqueeze(0).float()
-
-        return X, Y
+        return self._to_tensor(image_x), self._to_tensor(image_y)
+
+    @staticmethod
+    def _to_tensor(image) -> torch.Tensor :
+        if torch.is_tensor(image) :
+            return image.float().reshape((1,) + image.shape[-3:])
+        if (isinstance(image, np.ndarray) and image.dtype == np.float32
+                and image.flags.writeable and image.base is None) :
+            return torch.from_numpy(image).unsqueeze(0) # Owns its pixels, no copy
+        array = _array_view(image)
+        out = np.empty((1,) + array.shape, dtype=np.float32)
+        np.copyto(out[0], array, casting="unsafe")
+        return torch.from_numpy(out)
+
+    @profiled(allocates=False)
+    def apply_batch(self, batch_xy : Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor] :
+        """Batches are already (B, 1, D, H, W) float tensors."""
+        return batch_xy
 
     def __repr__(self):
         return f"{self.__class__.__name__}()"
@@ -147,29 +356,58 @@ class ToTensor:
 class Normalize :
     """ Normalize the pixel intensities in the image"""
     def __init__(self, min_hu: float = -1000.0, max_hu: float = 1000.0) :
-        self.f = sitk.ClampImageFilter()
-        self.f.SetLowerBound(min_hu)
-        self.f.SetUpperBound(max_hu)
+        self.min_hu, self.max_hu = min_hu, max_hu
         self.scale = 1000.0
 
-    def __call__(self, image_xy : Tuple[sitk.Image, sitk.Image]) -> Tuple[sitk.Image, sitk.Image]:
+    @profiled()
+    def __call__(self, image_xy : Tuple[sitk.Image, sitk.Image]) -> Tuple[np.ndarray, np.ndarray]:
         """Apply the transform.
 
+        The pixels are clamped and scaled while being copied once into a new
+        float32 array, without intermediate images.
+
         Parameters
         ----------
         image_xy
-            A tuple containing the image from domain X and Y to transform.
+            A tuple containing the image (SITK image or array) from domain X and
+            Y to transform.
 
         Returns
         -------
-        Tuple[sitk.Image, sitk.Image]
-            The transformed images from domain X and Y.
+        Tuple[np.ndarray, np.ndarray]
+            The transformed images from domain X and Y, (z, y, x). Use ToTensor
+            to convert them to tensors without copying. The SimpleITK
+            transforms (HorizontalFlip, AffineTransform) must come before
+            Normalize, and raise a TypeError if given its arrays.
         """
         image_x, image_y = image_xy
-        image_x = (self.f.Execute(image_x)) / self.scale
-        image_y = (self.f.Execute(image_y)) / self.scale
+        return self._normalize(image_x), self._normalize(image_y)
 
-        return image_x, image_y
+    def _normalize(self, image) -> np.ndarray :
+        array = _array_view(image)
+        out = np.empty(array.shape, dtype=np.float32)
+        np.clip(array, self.min_hu, self.max_hu, out=out, casting="unsafe")
+        np.divide(out, self.scale, out=out)
+        return out
+
+    @profiled(allocates=False)
+    def apply_batch(self, batch_xy : Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor] :
+        """Normalize a batch of images from each domain in place.
+
+        Parameters
+        ----------
+        batch_xy
+            A tuple containing the float tensors of the images from domain X and
+            Y, with the batch as first dimension.
+
+        Returns
+        -------
+        Tuple[torch.Tensor, torch.Tensor]
+            The same tensors, normalized.
+        """
+        for batch in batch_xy :
+            batch.clamp_(self.min_hu, self.max_hu).div_(self.scale)
+        return batch_xy
 
 
 
@@ -177,6 +415,7 @@ class Normalize :
 class HorizontalFlip:
     """Flip the image about the vertical axis.
     """
+    @profiled()
     def __call__(self, image_xy : Tuple[sitk.Image, sitk.Image]) -> Tuple[sitk.Image, sitk.Image] :
         """Apply the transform.
 
@@ -190,10 +429,179 @@ class HorizontalFlip:
         Tuple[sitk.Image, sitk.Image]
             The transformed images from domain X and Y.
         """
+        _check_images(image_xy, self)
         x, y = image_xy
 
         # Randomly perform the flip (50% of the time)
-        if np.random.random() > 0.5 :
+        if self.sample_params() :
             x = sitk.Flip(x, [True, False, False])
             y = sitk.Flip(y, [True, False, False])
         return x, y
+
+    def sample_params(self) -> bool :
+        """Randomly decide whether to flip."""
+        return np.random.random() > 0.5
+
+
+
+
+
+class _FlippedGeometry :
+    """The geometry of an image flipped about the x axis with sitk.Flip,
+    without copying its pixels. Only what AffineTransform.get_transform needs
+    is provided."""
+    def __init__(self, image: sitk.Image) :
+        self.image = image
+
+    def GetSize(self) :
+        return self.image.GetSize()
+
+    def TransformContinuousIndexToPhysicalPoint(self, index) :
+        index = [float(i) for i in index]
+        index[0] = self.image.GetSize()[0] - 1 - index[0]
+        return self.image.TransformContinuousIndexToPhysicalPoint(index)
+
+
+
+class FusedTransform :
+    """A chain of HorizontalFlip, AffineTransform, Normalize and ToTensor
+    compiled into at most one resampling and a single clamp-and-scale pass.
+
+    Every step draws its random parameters in the same order as in the chain,
+    and consecutive flips cancel out. If the chain flips the image before the
+    affine transform, it is resampled once onto the flipped grid: sitk.Flip
+    keeps the physical position of the pixels and only reverses their order,
+    so this is the same resampling with the rotation centre of the flipped
+    image, read in reverse. Flips only move pixels: they are done by reading
+    the pixels in reverse order while they are clamped and scaled into the
+    output tensor (or a slot of a batch).
+
+    Without a flip before the affine transform, the result is bit-identical
+    to running the chain step by step. With one, the grid points are computed
+    from the other end of the image, which changes the rounding of the
+    interpolation weights: the results differ from the chain by at most
+    FLIP_TOLERANCE (in HU, before Normalize). Create it with
+    `compile_transform`.
+    """
+    def __init__(self, steps: Sequence) :
+        self.steps = list(steps)
+        self.spatial = [t for t in self.steps if isinstance(t, (HorizontalFlip, AffineTransform))]
+        self.affine = next((t for t in self.steps if isinstance(t, AffineTransform)), None)
+        self.normalize = next((t for t in self.steps if isinstance(t, Normalize)), None)
+
+    def _sample_params(self) :
+        """Draw the random parameters of the chain. Return whether to flip
+        before and after the affine transform and its parameters."""
+        flip_before, flip_after, params = False, False, None
+        for step in self.spatial :
+            if isinstance(step, AffineTransform) :
+                params = step.sample_params()
+            elif step.sample_params() :
+                if params is None :
+                    flip_before = not flip_before
+                else :
+                    flip_after = not flip_after
+        return flip_before, params, flip_after
+
+    def _write(self, image, out: np.ndarray, flipped: bool = False) :
+        """Clamp and scale an image like Normalize while copying it into out,
+        flipping it about the x axis like sitk.Flip if flipped."""
+        array = _array_view(image)
+        if flipped :
+            array = array[..., ::-1]
+        out = out.reshape(array.shape)
+        if self.normalize is None :
+            np.copyto(out, array, casting="unsafe")
+        else :
+            np.clip(array, self.normalize.min_hu, self.normalize.max_hu, out=out,
+                    casting="unsafe")
+            np.divide(out, self.normalize.scale, out=out)
+
+    @profiled(allocates=False)
+    def apply_into(self, image_xy : Tuple[sitk.Image, sitk.Image],
+                   out_xy : Tuple[np.ndarray, np.ndarray]) :
+        """Apply the transforms and write the results into preallocated arrays,
+        e.g. the slots of a batch.
+
+        Parameters
+        ----------
+        image_xy
+            A tuple containing the image from domain X and Y to transform.
+            Arrays are accepted if the chain has no AffineTransform.
+        out_xy
+            The float32 arrays in which to write the transformed images from
+            domain X and Y. They must have as many elements as the images.
+        """
+        self._apply_into(image_xy, out_xy)
+
+    def _apply_into(self, image_xy, out_xy) :
+        image_x, image_y = image_xy
+        flip_before, params, flip_after = self._sample_params()
+        if params is None : # Flips alone only move pixels
+            flip_before, flip_after = False, flip_before
+        geometry = image_x
+        if flip_before : # Resample onto the flipped grid, i.e. read the result in reverse
+            geometry, flip_after = _FlippedGeometry(image_x), not flip_after
+        if params is not None :
+            transform = self.affine.get_transform(geometry, *params)
+            fill_value = self.affine.fill_value
+            image_x = sitk.Resample(image_x, image_x, transform, sitk.sitkLinear, fill_value)
+            image_y = sitk.Resample(image_y, image_y, transform, sitk.sitkLinear, fill_value)
+        self._write(image_x, out_xy[0], flip_after)
+        self._write(image_y, out_xy[1], flip_after)
+
+    @profiled()
+    def __call__(self, image_xy : Tuple[sitk.Image, sitk.Image]) -> Tuple[torch.Tensor, torch.Tensor] :
+        """Apply the transform.
+
+        Parameters
+        ----------
+        image_xy
+            A tuple containing the image from domain X and Y to transform.
+
+        Returns
+        -------
+        Tuple[torch.Tensor, torch.Tensor]
+            The transformed images from domain X and Y, like ToTensor.
+        """
+        X = np.empty((1,) + _array_view(image_xy[0]).shape, dtype=np.float32)
+        Y = np.empty((1,) + _array_view(image_xy[1]).shape, dtype=np.float32)
+        self._apply_into(image_xy, (X, Y))
+        return torch.from_numpy(X), torch.from_numpy(Y)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.steps})"
+
+
+
+def compile_transform(transform) -> FusedTransform :
+    """ Compile a chain of transforms into a FusedTransform.
+
+    Supported chains are any number of HorizontalFlip and at most one
+    AffineTransform, optionally followed by Normalize, and ending with
+    ToTensor, like the chains used to train the GAN.
+
+    Parameters
+    ----------
+    transform
+        A torchvision.transforms.Compose or a list of transforms.
+
+    Returns
+    -------
+    FusedTransform
+        The compiled transform.
+    """
+    steps = list(getattr(transform, "transforms", transform))
+    names = [type(t).__name__ for t in steps]
+    n = 0
+    while n < len(steps) and isinstance(steps[n], (HorizontalFlip, AffineTransform)) :
+        n += 1
+    spatial, tail = steps[:n], steps[n:]
+    if (len(tail) == 0 or len(tail) > 2 or not isinstance(tail[-1], ToTensor) or
+            (len(tail) == 2 and not isinstance(tail[0], Normalize))) :
+        raise ValueError(f"Can't compile {names}. The chain must be spatial "
+                         "transforms, then at most one Normalize, then ToTensor "
+                         "(Normalize returns arrays, not SimpleITK images).")
+    if sum(isinstance(t, AffineTransform) for t in spatial) > 1 :
+        raise ValueError(f"Can't compile {names} with more than one AffineTransform.")
+    return FusedTransform(steps)
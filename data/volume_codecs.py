@@ -0,0 +1,134 @@
+import os
+import json
+import gzip
+import struct
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+import SimpleITK as sitk
+
+try :
+    import zstandard
+except ImportError :
+    zstandard = None
+
+try :
+    import lz4.frame
+except ImportError :
+    lz4 = None
+
+
+CODECS = ["raw", "gzip", "zstd", "lz4"]
+DEFAULT_LEVELS = {"raw": None, "gzip": 6, "zstd": 3, "lz4": 0}
+
+# Cached volume file layout: magic, header length (uint32), JSON header, payload
+MAGIC = b"DAVOL1\n"
+
+
+
+
+def check_codec(codec: str) :
+    """Raise an error if a codec is unknown or its package is not installed."""
+    if codec not in CODECS :
+        raise ValueError(f"codec {codec} not accepted. Use one of {CODECS}.")
+    if codec == "zstd" and zstandard is None :
+        raise ImportError("The zstd codec requires the zstandard package.")
+    if codec == "lz4" and lz4 is None :
+        raise ImportError("The lz4 codec requires the lz4 package.")
+
+
+
+def encode(data: bytes, codec: str, level: Optional[int] = None) -> bytes :
+    """Compress bytes with a codec. If level is None, the codec's default
+    level is used."""
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == "raw" :
+        return data
+    elif codec == "gzip" :
+        return gzip.compress(data, compresslevel=level)
+    elif codec == "zstd" :
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    elif codec == "lz4" :
+        return lz4.frame.compress(data, compression_level=level)
+    raise ValueError(f"codec {codec} not accepted.")
+
+
+
+def decode(data: bytes, codec: str) -> bytes :
+    """Decompress bytes compressed with a codec."""
+    if codec == "raw" :
+        return data
+    elif codec == "gzip" :
+        return gzip.decompress(data)
+    elif codec == "zstd" :
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "lz4" :
+        return lz4.frame.decompress(data)
+    raise ValueError(f"codec {codec} not accepted.")
+
+
+
+def write_volume(path: str, image: sitk.Image, codec: str = "raw",
+                 level: Optional[int] = None) :
+    """ Save an image in the cached volume format: a short JSON header with
+    the geometry of the image followed by the pixels compressed with a codec.
+    The file is written under a temporary name and then renamed, so readers
+    never see a partly written volume.
+
+    Parameters
+    ----------
+    path : str
+        The file to write (by convention ending in '.vol').
+    image : sitk.Image
+        The image to save.
+    codec : str
+        One of 'raw', 'gzip', 'zstd' or 'lz4'.
+    level : int
+        The compression level. If None, the codec's default is used.
+    """
+    array = sitk.GetArrayViewFromImage(image)
+    header = json.dumps({"shape": list(array.shape),
+                         "dtype": array.dtype.str,
+                         "spacing": list(image.GetSpacing()),
+                         "origin": list(image.GetOrigin()),
+                         "direction": list(image.GetDirection()),
+                         "codec": codec}).encode()
+    payload = encode(np.ascontiguousarray(array).tobytes(), codec, level)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try :
+        with open(tmp_path, "wb") as f :
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException :
+        if os.path.exists(tmp_path) :
+            os.remove(tmp_path)
+        raise
+
+
+
+def read_volume_array(path: str) -> Tuple[np.ndarray, Dict] :
+    """Load the pixels (z, y, x) and the header of a cached volume file."""
+    with open(path, "rb") as f :
+        data = f.read()
+    if not data.startswith(MAGIC) :
+        raise ValueError(f"{path} is not a cached volume file.")
+    start = len(MAGIC) + 4
+    header_len, = struct.unpack("<I", data[len(MAGIC) : start])
+    header = json.loads(data[start : start + header_len])
+    payload = decode(memoryview(data)[start + header_len:], header["codec"])
+    array = np.frombuffer(payload, dtype=np.dtype(header["dtype"])).reshape(header["shape"])
+    return array, header
+
+
+
+def read_volume(path: str) -> sitk.Image :
+    """Load a cached volume file as an SITK image."""
+    array, header = read_volume_array(path)
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(header["spacing"])
+    image.SetOrigin(header["origin"])
+    image.SetDirection(header["direction"])
+    return image
@@ -0,0 +1,211 @@
+import os
+import json
+import numpy as np
+from typing import Dict, Iterable, Optional, Sequence
+
+import SimpleITK as sitk
+
+
+
+
+class VolumeStore :
+    """Memory-mapped store holding every preprocessed subvolume of a cache in
+    a single fixed-stride array file.
+
+    All subvolumes in a cache have the same size and spacing, so they are
+    packed one after the other in `volumes.dat` (one 'slot' per patient). A
+    small JSON index maps each patient ID to its slot, and a second memory-
+    mapped file holds the origin and direction of each slot so that the
+    SimpleITK geometry can be restored when needed.
+
+    Reading a volume returns a view into the memory map, so no file is opened,
+    no header is parsed and nothing is decoded in `__getitem__`. Since every
+    DataLoader worker maps the same file, the OS page cache keeps the whole
+    cohort in memory across workers and epochs.
+    """
+    GEOM_COLS = 13 # origin (3), direction (9), valid flag (1)
+
+    def __init__(self, root: str, shape: Sequence[int],
+                 spacing: Sequence[float], dtype: str = "float32") :
+        """ Initialize the store.
+
+        Parameters
+        ----------
+        root : str
+            The directory containing the store files.
+        shape : Sequence[int]
+            The shape of every subvolume in numpy (z, y, x) order.
+        spacing : Sequence[float]
+            The voxel spacing of every subvolume in SITK (x, y, z) order.
+        dtype : str
+            The pixel type of the stored volumes.
+        """
+        self.root = root
+        self.shape = tuple(int(s) for s in shape)
+        self.spacing = [float(s) for s in spacing]
+        self.dtype = np.dtype(dtype)
+        self.slot_size = int(np.prod(self.shape))
+
+        self.data_path  = os.path.join(root, "volumes.dat")
+        self.geom_path  = os.path.join(root, "volumes.geom")
+        self.index_path = os.path.join(root, "volumes.json")
+
+        self.slots = {} # patient_id -> slot number
+        self._data, self._geom = None, None # Opened lazily in each process
+
+        if os.path.exists(self.index_path) :
+            self._load_index()
+
+
+    def _load_index(self) :
+        with open(self.index_path, "r") as f :
+            index = json.load(f)
+        if (tuple(index["shape"]) != self.shape or
+                index["dtype"] != self.dtype.name or
+                not np.allclose(index["spacing"], self.spacing)) :
+            # A cache with a different configuration. Start from scratch.
+            print(f"Volume store {self.root} has shape {index['shape']} and "
+                  f"spacing {index['spacing']}, expected {self.shape} and "
+                  f"{self.spacing}. It will be rebuilt.")
+            self.reset()
+            return
+        self.slots = {str(k): int(v) for k, v in index["slots"].items()}
+
+
+    def save_index(self) :
+        """Atomically write the patient ID -> slot index to disk."""
+        index = {"shape": list(self.shape),
+                 "dtype": self.dtype.name,
+                 "spacing": self.spacing,
+                 "slots": self.slots}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f :
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+
+    def reset(self) :
+        """Remove every volume from the store."""
+        for path in [self.data_path, self.geom_path, self.index_path] :
+            if os.path.exists(path) :
+                os.remove(path)
+        self.slots = {}
+        self._close()
+
+
+    def reserve(self, patient_ids: Iterable[str]) :
+        """Assign a slot to every patient that does not have one yet and grow
+        the files on disk to hold them. Must be called in the main process
+        before any worker writes to the store.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        for patient_id in patient_ids :
+            patient_id = str(patient_id)
+            if patient_id not in self.slots :
+                self.slots[patient_id] = len(self.slots)
+
+        n_slots = len(self.slots)
+        self._resize(self.data_path, n_slots * self.slot_size * self.dtype.itemsize)
+        self._resize(self.geom_path, n_slots * self.GEOM_COLS * 8)
+        self._close()
+        self.save_index()
+
+
+    @staticmethod
+    def _resize(path: str, nbytes: int) :
+        mode = "r+b" if os.path.exists(path) else "w+b"
+        with open(path, mode) as f :
+            f.seek(0, os.SEEK_END)
+            if f.tell() < nbytes : # Only ever grow the file
+                f.truncate(nbytes)
+
+
+    def _open(self, mode: str = "r") :
+        n_slots = max(len(self.slots), 1)
+        self._data = np.memmap(self.data_path, dtype=self.dtype, mode=mode,
+                               shape=(n_slots,) + self.shape)
+        self._geom = np.memmap(self.geom_path, dtype=np.float64, mode=mode,
+                               shape=(n_slots, self.GEOM_COLS))
+        self._mode = mode
+
+
+    def _close(self) :
+        self._data, self._geom = None, None
+
+
+    def __contains__(self, patient_id) -> bool :
+        """Whether a fully written volume exists for this patient."""
+        slot = self.slots.get(str(patient_id))
+        if slot is None or not os.path.exists(self.geom_path) :
+            return False
+        if self._geom is None :
+            self._open()
+        return bool(self._geom[slot, -1] == 1.0)
+
+
+    def __len__(self) :
+        return len(self.slots)
+
+
+    def write(self, patient_id: str, image: sitk.Image) :
+        """Write a preprocessed subvolume into its slot. Safe to call from
+        several worker processes at once since every patient has its own slot.
+        """
+        if self._data is None or self._mode != "r+" :
+            self._open(mode="r+")
+        slot = self.slots[str(patient_id)]
+        array = sitk.GetArrayViewFromImage(image)
+        if array.shape != self.shape :
+            raise ValueError(f"Image of {patient_id} has shape {array.shape}, "
+                             f"store expects {self.shape}.")
+        self._data[slot] = array
+        self._data.flush()
+
+        geom = np.zeros(self.GEOM_COLS)
+        geom[0:3]  = image.GetOrigin()
+        geom[3:12] = image.GetDirection()
+        geom[12]   = 1.0 # Mark the slot as valid only after the data is flushed
+        self._geom[slot] = geom
+        self._geom.flush()
+
+
+    def get_array(self, patient_id: str) -> np.ndarray :
+        """Return a read-only view of a patient's subvolume, (z, y, x)."""
+        if self._data is None :
+            self._open()
+        return self._data[self.slots[str(patient_id)]]
+
+
+    def get_image(self, patient_id: str, start: Optional[Sequence[int]] = None,
+                  size: Optional[Sequence[int]] = None) -> sitk.Image :
+        """ Return a patient's subvolume as an SITK image with its geometry.
+
+        Parameters
+        ----------
+        patient_id : str
+            The patient to load.
+        start, size : Sequence[int]
+            If given, only the window of this (z, y, x) size starting at this
+            (z, y, x) index is read from the memory map.
+        """
+        array = self.get_array(patient_id)
+        geom  = self._geom[self.slots[str(patient_id)]]
+        origin, direction = geom[0:3], geom[3:12]
+        if start is not None :
+            stop = np.asarray(start) + np.asarray(size)
+            array = array[start[0] : stop[0], start[1] : stop[1], start[2] : stop[2]]
+            # Origin of the window, i.e. the physical position of its first voxel
+            offset = np.asarray(start[::-1], dtype=np.float64) * self.spacing
+            origin = origin + direction.reshape(3, 3) @ offset
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing(self.spacing)
+        image.SetOrigin(origin.tolist())
+        image.SetDirection(direction.tolist())
+        return image
+
+
+    def __getstate__(self) :
+        # Memory maps can't be pickled; each process reopens its own
+        state = self.__dict__.copy()
+        state["_data"], state["_geom"] = None, None
+        return state
@@ -36,6 +36,18 @@ def get_seq_out_shape(network, in_shape=[8, 256, 256], in_channels=1) :
 
 
 
+def conv_out_shape(in_shape, kernel_size=3, stride=1, padding=0, dilation=1) :
+    """Calculate the output shape [depth, height, width] of a convolutional
+    layer without running it. kernel_size, stride, padding and dilation can be
+    integers or one value per dimension."""
+    in_shape = np.array(in_shape)
+    ks, s, p, d = [np.broadcast_to(v, in_shape.shape) for v in
+                   (kernel_size, stride, padding, dilation)]
+    out_shape = (in_shape + 2 * p - d * (ks - 1) - 1) // s + 1
+    return [int(o) for o in out_shape]
+
+
+
 
 
 
@@ -262,10 +274,9 @@ class VGG2D(nn.Module):
 
     def forward(self, X) :
         X = self.network(X)
-        X = X.view(-1, 512 * 8 * 8)
+        X = X.view(-1, self.fc1.in_features)
         X = self.fc1(X)
-        X = self.sigmoid(X)
-        return X
+        return X # Logits, for nn.BCEWithLogitsLoss
 
 
 
@@ -386,10 +397,10 @@ class PatchGAN_NLayer(nn.Module) :
             # Calculate shape of output tensor from this layer
             out_shape = conv_out_shape(out_shape, kernel_size=ks, stride=s, padding=pads)
 
-        # Add final conv layer
+        # Add final conv layer, covering the whole output of the last layer
+        # (kernel [16, 18, 18] for the default input shape)
         net_list += [nn.Conv3d(in_channels=out_filters, out_channels=1,
-                               kernel_size=[16, 18,  18], stride=s, padding=0, bias=use_bias)]
-        out_shape = conv_out_shape(out_shape, kernel_size=ks, stride=s, padding=pads)
+                               kernel_size=out_shape, stride=s, padding=0, bias=use_bias)]
 
 
 
@@ -16,6 +16,7 @@ from pytorch_lightning.callbacks import ModelCheckpoint
 
 from cycleGAN import GAN
 from data.data_loader import load_image_data_frame, UnpairedDataset
+from data.catalog import PatientCatalog, is_catalog, read_label_csv
 from data.transforms import ToTensor, Normalize
 from data.postprocessing import PostProcessor
 
@@ -29,10 +30,14 @@ from cycleGAN for DA reduction.
 """
 
 
-def prepare_data(img_list_csv) :
-    """Get a list of patient IDs to be cleaned
+def prepare_data(img_list_csv, cohort=None) :
+    """Get a list of patient IDs to be cleaned, from a label CSV or from a
+    cohort of a patient catalog.
     """
-    df = pd.read_csv(img_list_csv, dtype=str).set_index("patient_id")
+    if is_catalog(img_list_csv) :
+        df = PatientCatalog(img_list_csv).cohort(cohort)
+    else :
+        df = read_label_csv(img_list_csv)
     x_df = df[df["has_artifact"].isin(["2", "1"])] # Limit df to 'dirty' images
     y_df = df[df["has_artifact"].isin(["0"])] # Limit df to 'dirty' images
     return x_df, y_df
@@ -57,7 +62,7 @@ def main(args) :
 
 
     # Get list of patient IDs
-    x_df, y_df = prepare_data(args.csv_path) # X is DA+, Y is DA-
+    x_df, y_df = prepare_data(args.csv_path, args.cohort) # X is DA+, Y is DA-
 
     # Define transforms to normalize input data
     transform = torchvision.transforms.Compose([
@@ -125,12 +130,10 @@ def main(args) :
             # This re-inserts the generated image back into the full DICOM and
             # saves it in NRRD format
             patient_id = dataset.x_ids[i]
-            img_center_x = float(x_df.at[patient_id, "img_center_x"])
-            img_center_y = float(x_df.at[patient_id, "img_center_y"])
-            img_center_z = float(x_df.at[patient_id, "img_center_z"])
+            img_center = dataset.metadata.centre(patient_id) # Physical (x, y, z)
             postprocess(gen_y.to(torch.device('cpu')),
                         patient_id,
-                        [img_center_x, img_center_y, img_center_z])
+                        img_center.tolist())
 
             print(f"Image {patient_id} processed in {time.time() - t0} s.")
 
@@ -158,7 +161,9 @@ if __name__ == '__main__':
 
     # Paths to data and logs
     parser.add_argument("--csv_path", type=str, default=csv_path,
-        help="Path to the CSV containing all image DA statuses and DA locations")
+        help="Path to the CSV containing all image DA statuses and DA locations, or to a patient catalog")
+    parser.add_argument("--cohort", type=str, default="radcure_challenge_test",
+                        help="Cohort of the catalog to clean. Ignored for CSVs.")
     parser.add_argument("--in_img_dir", default=img_dir, type=str,
                         help="Path to the input image data (DICOM).")
     parser.add_argument("--cache_dir", default=cache, type=str,
@@ -44,6 +44,24 @@ class TensorBoardCustom(TensorBoardLogger):
         self.experiment.add_scalars("val_loss/", val_metrics, step)
 
 
+    @rank_zero_only
+    def log_pipeline_stats(self, stats, step) :
+        """ Plot the per-stage counters of the data pipeline, as returned by
+        util.profiling.StageProfiler.delta, with one curve per stage:
+        - the time per call (ms) and the total time (s) of each stage, summed
+          over the DataLoader workers
+        - the MB of cached pixels read and the MB allocated by each stage
+        """
+        if len(stats) == 0 :
+            return
+        for field, tag in [("ms_per_call", "pipeline/ms_per_call"),
+                           ("seconds", "pipeline/seconds"),
+                           ("mb_read", "pipeline/mb_read"),
+                           ("mb_allocated", "pipeline/mb_allocated")] :
+            self.experiment.add_scalars(tag, {stage: s[field] for stage, s in stats.items()},
+                                        step)
+
+
     def add_mpl_img(self, tag, X, step, clip_vals=False) :
         """ Creates a matplotlib image out of a 4D tensor or list of
         2D tensors:
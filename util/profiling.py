@@ -0,0 +1,215 @@
+import time
+import functools
+import threading
+import multiprocessing as mp
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import torch
+import SimpleITK as sitk
+from torch.utils.data import get_worker_info
+
+
+# The stages recorded by the datasets, transforms and collate functions
+STAGES = ["sample", "batch", "read", "HorizontalFlip", "AffineTransform",
+          "Normalize", "ToTensor", "FusedTransform", "BatchAffineTransform",
+          "collate", "other"]
+
+# The profiler of the sample being loaded in this thread, if any. Per thread,
+# as batches may be loaded in a background thread (see data.prefetch) while
+# the main thread runs the validation transforms
+_local = threading.local()
+
+
+
+
+def _buffers(obj) :
+    """Yield the (address, size in bytes) of the pixels of an image, array,
+    tensor or of a tuple or list of them."""
+    if torch.is_tensor(obj) :
+        yield obj.data_ptr(), obj.element_size() * obj.nelement()
+    elif isinstance(obj, np.ndarray) :
+        yield obj.__array_interface__["data"][0], obj.nbytes
+    elif isinstance(obj, sitk.Image) :
+        array = sitk.GetArrayViewFromImage(obj)
+        yield array.__array_interface__["data"][0], array.nbytes
+    elif isinstance(obj, (tuple, list)) :
+        for o in obj :
+            yield from _buffers(o)
+
+
+
+def nbytes(obj) -> int :
+    """Return the size in bytes of the pixels of an image, array, tensor or of
+    a tuple or list of them."""
+    return sum(size for _, size in _buffers(obj))
+
+
+
+def new_bytes(out, inputs) -> int :
+    """Return the size in bytes of the outputs of a function whose pixels are
+    not those of one of its inputs, e.g. not counting an image returned
+    unchanged or a tensor sharing the memory of an input array."""
+    addresses = {address for address, _ in _buffers(inputs)}
+    return sum(size for address, size in _buffers(out) if address not in addresses)
+
+
+
+
+class StageProfiler :
+    """Per-stage counters of the data pipeline, shared by all DataLoader
+    workers.
+
+    For every stage (reading cached images, each transform, collation, ...)
+    the number of calls, the wall time, the bytes of cached pixels read and the
+    bytes of new images or tensors allocated are accumulated. The counters live
+    in shared memory created before the workers are started. Each process
+    writes its own row, the main process in row 0 and worker k in row k + 1,
+    so only the threads of the main process (e.g. a prefetch thread) share a
+    row, guarded by a thread lock. Reading the counters sums the rows.
+
+    Recording is opt-in: pass the profiler to the dataset (and BatchCollate).
+    The transforms record into the profiler of the dataset that calls them.
+    """
+    FIELDS = ["calls", "seconds", "bytes_read", "bytes_allocated"]
+
+    def __init__(self, stages: Sequence[str] = STAGES, max_workers: int = 64) :
+        """ Initialize the profiler. Must be created before the DataLoader
+        workers are started.
+
+        Parameters
+        ----------
+        stages : Sequence[str]
+            The names of the stages. Unknown stages are recorded as 'other'.
+        max_workers : int
+            The maximum number of DataLoader workers.
+        """
+        self.stages = list(stages)
+        if "other" not in self.stages :
+            self.stages.append("other")
+        self.index = {s: i for i, s in enumerate(self.stages)}
+        self.shape = (max_workers + 1, len(self.stages), len(self.FIELDS))
+        self._counters = mp.RawArray("d", int(np.prod(self.shape)))
+        self._view = None
+        self._last = None # Totals at the previous call to delta()
+        self._lock = threading.Lock()
+
+
+    def _counts(self) -> np.ndarray :
+        if self._view is None :
+            self._view = np.frombuffer(self._counters, dtype=np.float64).reshape(self.shape)
+        return self._view
+
+
+    def add(self, stage: str, seconds: float, bytes_read: int = 0, bytes_allocated: int = 0) :
+        """Record one call of a stage in the row of this process."""
+        info = get_worker_info()
+        if info is None :
+            row = 0
+        elif info.num_workers >= self.shape[0] :
+            raise ValueError(f"The DataLoader has {info.num_workers} workers but the "
+                             f"profiler was created with max_workers={self.shape[0] - 1}.")
+        else :
+            row = info.id + 1
+        counts = self._counts()[row, self.index.get(stage, self.index["other"])]
+        with self._lock :
+            counts[0] += 1
+            counts[1] += seconds
+            counts[2] += bytes_read
+            counts[3] += bytes_allocated
+
+
+    def totals(self) -> np.ndarray :
+        """Return the (stage, field) counters summed over all processes."""
+        return self._counts().sum(axis=0)
+
+
+    def _summary(self, totals: np.ndarray) -> Dict[str, Dict[str, float]] :
+        summary = {}
+        for stage, (calls, seconds, bytes_read, bytes_allocated) in zip(self.stages, totals) :
+            if calls == 0 :
+                continue
+            summary[stage] = {"calls": calls,
+                              "seconds": seconds,
+                              "ms_per_call": 1000 * seconds / calls,
+                              "mb_read": bytes_read / 2**20,
+                              "mb_allocated": bytes_allocated / 2**20}
+        return summary
+
+
+    def snapshot(self) -> Dict[str, Dict[str, float]] :
+        """Return the counters of every stage since the start, summed over all
+        processes, and the time per call. Stages never called are left out."""
+        return self._summary(self.totals())
+
+
+    def delta(self) -> Dict[str, Dict[str, float]] :
+        """Like snapshot, but only since the previous call to delta."""
+        totals = self.totals()
+        delta = totals if self._last is None else totals - self._last
+        self._last = totals
+        return self._summary(delta)
+
+
+    def reset(self) :
+        """Zero every counter. Only call it while no worker is running."""
+        self._counts()[:] = 0
+        self._last = None
+
+
+    def __getstate__(self) :
+        # The shared memory itself is inherited by the workers, not the view
+        state = self.__dict__.copy()
+        state["_view"] = None
+        del state["_lock"]
+        return state
+
+
+    def __setstate__(self, state) :
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+
+
+@contextmanager
+def profile(profiler: Optional[StageProfiler], stage: str, bytes_read: int = 0) :
+    """ Record the wall time of a block as one call of a stage, and make the
+    profiler active for the transforms called in it. Does nothing if the
+    profiler is None.
+    """
+    if profiler is None :
+        yield
+        return
+    previous = getattr(_local, "active", None)
+    _local.active = profiler
+    t0 = time.perf_counter()
+    try :
+        yield
+    finally :
+        profiler.add(stage, time.perf_counter() - t0, bytes_read=bytes_read)
+        _local.active = previous
+
+
+
+def profiled(allocates: bool = True) :
+    """ Decorate a transform method to record its wall time in the active
+    profiler, under the name of the transform class. If allocates is True,
+    the size of the outputs that do not reuse the memory of an input is
+    recorded as allocated bytes (use False for methods working in place).
+    Costs one thread-local lookup when no profiler is active.
+    """
+    def decorator(method) :
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs) :
+            profiler = getattr(_local, "active", None)
+            if profiler is None :
+                return method(self, *args, **kwargs)
+            t0 = time.perf_counter()
+            out = method(self, *args, **kwargs)
+            profiler.add(type(self).__name__, time.perf_counter() - t0,
+                         bytes_allocated=new_bytes(out, args) if allocates else 0)
+            return out
+        return wrapper
+    return decorator